@@ -1,37 +1,115 @@
 from django.contrib import admin
-from .models import Book, Transaction, UserProfile
+from .models import Book, FineLedger, ImportChunk, ImportJob, Notification, Transaction, UserProfile
+from .notices import send_overdue_notices
 
 # Customize Book admin
 class BookAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'isbn', 'copies_available')
     search_fields = ('title', 'author', 'isbn')  # Enable searching by title, author, and ISBN
-    list_filter = ('author', 'published_date')  # Add a filter by author and publication date
+    list_filter = ('author', 'published_date', ('archived_at', admin.EmptyFieldListFilter))  # Add a filter by author, publication date and archived state
+
+# Filter transactions on the overdue status computed by the database
+class OverdueFilter(admin.SimpleListFilter):
+    title = 'overdue'
+    parameter_name = 'overdue'
+
+    def lookups(self, request, model_admin):
+        return (('yes', 'Yes'), ('no', 'No'))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'yes':
+            return queryset.filter(is_overdue=True)
+        if self.value() == 'no':
+            return queryset.filter(is_overdue=False)
+        return queryset
+
 
 # Customize Transaction admin
 class TransactionAdmin(admin.ModelAdmin):
-    list_display = ('user', 'book', 'date_checked_out', 'date_returned', 'is_overdue')
+    list_display = ('user', 'book', 'date_checked_out', 'date_returned', 'is_overdue', 'overdue_days')
     search_fields = ('user__username', 'book__title')  # Enable searching by username and book title
-    list_filter = ('date_checked_out', 'date_returned')  # Filter by date
+    list_filter = (OverdueFilter, 'date_checked_out', 'date_returned')  # Filter by overdue status and date
     readonly_fields = ('date_checked_out', 'date_returned')  # Make these fields read-only
+    list_select_related = ('user', 'book')  # The user and book columns would otherwise cost a query per row
 
-    # Custom method to display if a transaction is overdue
+    actions = ['check_overdue']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_overdue()
+
+    @admin.action(description='Email overdue notices for selected transactions')
+    def check_overdue(self, request, queryset):
+        emails_sent, loans_notified = send_overdue_notices(queryset)
+        self.message_user(request, f'Sent {emails_sent} overdue notices covering {loans_notified} loans.')
+
+    # Custom methods to display the annotated overdue status
     def is_overdue(self, obj):
-        return obj.is_overdue()
+        return obj.is_overdue
     is_overdue.boolean = True  # Show a boolean icon for overdue status
     is_overdue.short_description = 'Overdue'
+    is_overdue.admin_order_field = 'is_overdue'
+
+    def overdue_days(self, obj):
+        return obj.overdue_days
+    overdue_days.short_description = 'Days overdue'
+    overdue_days.admin_order_field = 'overdue_days'
 
 # Customize UserProfile admin
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'date_of_membership', 'is_active')
     search_fields = ('user__username', 'user__email')  # Enable searching by username and email
     list_filter = ('is_active',)  # Add a filter for active/inactive users
+    list_select_related = ('user',)
 
     # To view related User details in the UserProfile admin panel
     def get_user_email(self, obj):
         return obj.user.email
     get_user_email.short_description = 'User Email'
 
+# Fine ledger rows are written by the fine jobs, so they're read-only here
+class FineLedgerAdmin(admin.ModelAdmin):
+    list_display = ('transaction', 'user', 'book_title', 'overdue_days', 'fine', 'is_final', 'updated_at')
+    search_fields = ('user__username', 'book_title')
+    list_filter = ('is_final',)
+    list_select_related = ('transaction__user', 'transaction__book', 'user')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+# Customize Notification admin
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('user', 'message', 'is_read', 'created_at')
+    search_fields = ('user__username', 'message')
+    list_filter = ('is_read',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user', 'transaction')
+
+# Import jobs are created by uploads and advanced by the import workers
+class ImportChunkInline(admin.TabularInline):
+    model = ImportChunk
+    fields = ('first_row', 'last_row', 'status', 'attempts', 'leased_by', 'lease_expires', 'rows_imported', 'rows_failed')
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file', 'status', 'total_rows', 'rows_done', 'rows_failed', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('status', 'file_format')
+    list_select_related = ('created_by',)
+    readonly_fields = ('fieldnames', 'total_rows', 'rows_done', 'rows_imported', 'rows_failed', 'started_at', 'finished_at', 'error')
+    raw_id_fields = ('created_by',)
+    inlines = [ImportChunkInline]
+
 # Register your models and custom admin classes
 admin.site.register(Book, BookAdmin)
 admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(UserProfile, UserProfileAdmin)
+admin.site.register(FineLedger, FineLedgerAdmin)
+admin.site.register(Notification, NotificationAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
@@ -1,7 +1,24 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_index(sender, using, **kwargs):
+    # Later migrations that rebuild library_book on SQLite drop the FTS sync
+    # triggers, so restore them once the schema is up to date.
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+    from .search import install_search_index
+
+    connection = connections[using]
+    recorder = MigrationRecorder(connection)
+    if recorder.has_table() and ('library', '0005_book_search_index') in recorder.applied_migrations():
+        with connection.schema_editor() as schema_editor:
+            install_search_index(schema_editor)
 
 
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
- 
\ No newline at end of file
+
+    def ready(self):
+        post_migrate.connect(ensure_search_index, sender=self)
@@ -0,0 +1,176 @@
+"""
+JWT authentication without a per-request ``User`` query.
+
+Tokens issued by login, ``/api/token/`` and ``/api/token/refresh/`` carry
+the user's ``username``, ``is_staff``, ``is_superuser`` and ``is_active``
+claims. ``ClaimsJWTAuthentication`` builds ``request.user`` from them as a
+``User`` instance whose other fields are deferred: filters and foreign keys
+work on its id, and a field outside the claims is loaded on first access.
+
+Claims can be stale for at most one access token lifetime. Refreshing
+re-reads the user, and ``forget_user`` (called when a user is updated or
+deleted through the API) makes this process load older tokens' users from
+the database. Tokens without the claims, and tokens of forgotten users,
+are served from a small per-process TTL cache of full users.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import router
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .blacklist import BlacklistRefreshToken
+
+USER_CLAIMS = ('username', 'is_staff', 'is_superuser', 'is_active')
+
+
+def user_cache_seconds():
+    """How long a user loaded from the database is reused (``LIBRARY_AUTH_USER_CACHE_SECONDS``)."""
+    return getattr(settings, 'LIBRARY_AUTH_USER_CACHE_SECONDS', 60)
+
+
+def login_sessions():
+    """Whether login also starts a Django session (``LIBRARY_LOGIN_SESSIONS``); JWT clients don't need one."""
+    return getattr(settings, 'LIBRARY_LOGIN_SESSIONS', False)
+
+
+class TTLCache:
+    """Thread-safe per-process mapping whose entries expire, oldest evicted past ``maxsize``."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# user id -> full User loaded from the database
+_users = TTLCache()
+# user id -> time.time() of the user's last change through the API
+_changed = TTLCache()
+
+
+def add_user_claims(token, user):
+    for claim in USER_CLAIMS:
+        token[claim] = getattr(user, claim)
+    return token
+
+
+def user_refresh_token(user):
+    """A refresh token for ``user`` whose access tokens carry the user claims, recorded as outstanding."""
+    token = add_user_claims(BlacklistRefreshToken.for_user(user), user)
+    token.outstand()
+    return token
+
+
+def claims_user(user_id, token):
+    """A ``User`` built from ``token``'s claims without a query."""
+    values = {'id': user_id, **{claim: token[claim] for claim in USER_CLAIMS}}
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+    return User.from_db(router.db_for_read(User), names, [values[name] for name in names])
+
+
+def cached_user(user_id):
+    user = _users.get(user_id)
+    if user is None:
+        try:
+            user = User.objects.get(id=user_id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        _users.set(user_id, user, user_cache_seconds())
+    # Each request gets its own copy to read and change
+    return copy.copy(user)
+
+
+def forget_user(user_id):
+    """Stop trusting claims issued to ``user_id`` until now, in this process."""
+    _users.pop(user_id)
+    _changed.set(user_id, time.time(), api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        try:
+            # simplejwt writes the id as a string
+            user_id = User._meta.pk.to_python(validated_token[api_settings.USER_ID_CLAIM])
+        except (KeyError, ValidationError):
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        changed = _changed.get(user_id)
+        if all(claim in validated_token for claim in USER_CLAIMS) and (changed is None or validated_token['iat'] > changed):
+            user = claims_user(user_id, validated_token)
+        else:
+            user = cached_user(user_id)
+
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return user
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = BlacklistRefreshToken
+
+    @classmethod
+    def get_token(cls, user):
+        return user_refresh_token(user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Re-reads the user on every refresh, so role changes reach the next
+    access token instead of riding along in rotated refresh tokens.
+    """
+    token_class = BlacklistRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+        add_user_claims(refresh, user)
+
+        data = {'access': str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+        return data
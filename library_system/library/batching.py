@@ -0,0 +1,31 @@
+"""
+Helpers for walking large querysets in bounded batches.
+"""
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """Split ``iterable`` into lists of at most ``size`` items."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def keyset_batches(queryset, size, field='pk'):
+    """
+    Yield ``values_list`` batches of ``queryset`` ordered by ``field``.
+
+    Each batch is a fresh ``WHERE field > last ... LIMIT size`` query whose
+    first column must be ``field``, so callers may write to the tables the
+    query reads between batches and no cursor stays open across them.
+    """
+    last = None
+    while True:
+        page = queryset.order_by(field)
+        if last is not None:
+            page = page.filter(**{f'{field}__gt': last})
+        batch = list(page[:size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1][0]
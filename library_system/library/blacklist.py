@@ -0,0 +1,234 @@
+"""
+Refresh-token blacklist in front of simplejwt's ``token_blacklist`` tables.
+
+simplejwt asks the database on every refresh whether the token is
+blacklisted, and blacklisting or outstanding a token fetches the user and
+runs ``get_or_create``. ``BlacklistRefreshToken`` instead:
+
+- answers "not blacklisted" from a per-process Bloom filter of the jtis of
+  unexpired blacklisted tokens, built on first use, and only asks the
+  database when the filter says "maybe";
+- blacklists with one lookup and one ``INSERT``, and outstands a rotated
+  token with one ``INSERT``.
+
+A process adds its own new entries to its filter as they commit. Entries
+from other processes arrive one of two ways:
+
+- with ``LIBRARY_TOKEN_BLACKLIST_CACHE`` set to a cache all processes share
+  (Redis, Memcached), through a numbered log in it. Whenever the log can't
+  be followed (cache flushed, entries evicted, a process far behind) the
+  filter is rebuilt from the database;
+- otherwise by reading the entries blacklisted since the last read, at
+  most every ``LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS``. Another process's
+  logout can go unnoticed for that long; 0 reads before every check.
+
+``manage.py prune_tokens`` deletes expired tokens, which keeps the tables
+and the rebuilds small.
+"""
+import hashlib
+import math
+import secrets
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import BlacklistMixin, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .batching import keyset_batches
+
+LOG_KEY = 'token-blacklist:{}'
+COUNT_KEY = LOG_KEY.format('count')
+# A process further behind the log than this rebuilds instead of catching up
+MAX_CATCH_UP = 1000
+MIN_CAPACITY = 10000
+# Entries are read again this long after their blacklisted_at, covering
+# transactions that commit after a later one was read
+POLL_OVERLAP = timedelta(seconds=60)
+PRUNE_CHUNK_SIZE = 1000
+
+
+class BloomFilter:
+    """Set of strings with no false negatives and about ``error_rate`` false positives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, step = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + n * step) % self.size for n in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def blacklist_cache():
+    """The shared cache new entries are logged to (``LIBRARY_TOKEN_BLACKLIST_CACHE``), or ``None``."""
+    alias = getattr(settings, 'LIBRARY_TOKEN_BLACKLIST_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def poll_seconds():
+    """How often a process without the shared cache reads new entries (``LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS``)."""
+    return getattr(settings, 'LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS', 5)
+
+
+def _start_log(cache):
+    """Start the log unless another process just did, and return its count."""
+    # At a random number, so no process mistakes it for a flushed log
+    cache.add(COUNT_KEY, secrets.randbits(48), None)
+    return cache.get(COUNT_KEY)
+
+
+def _in_database(jti):
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+class TokenBlacklist:
+    """The per-process filter and how far it has followed the other processes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._seen = None
+        self._polled = None
+
+    def contains(self, jti):
+        cache = blacklist_cache()
+        with self._lock:
+            if cache is None:
+                self._poll()
+            else:
+                self._sync(cache)
+            maybe = jti in self._filter
+        return maybe and _in_database(jti)
+
+    def publish(self, jti):
+        """Add ``jti`` to this filter and log it for other processes; call once its blacklist entry is committed."""
+        with self._lock:
+            if self._filter is not None:
+                self._add(jti)
+        cache = blacklist_cache()
+        if cache is None:
+            return
+        try:
+            number = cache.incr(COUNT_KEY)
+        except ValueError:
+            _start_log(cache)
+            number = cache.incr(COUNT_KEY)
+        cache.set(LOG_KEY.format(number), jti, api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+
+    def _sync(self, cache):
+        count = cache.get(COUNT_KEY)
+        if count is None:
+            count = _start_log(cache)
+        if count == self._seen and self._filter is not None and self._filter.count < self._filter.capacity:
+            return
+        if self._filter is not None and self._seen is not None and 0 < count - self._seen <= MAX_CATCH_UP:
+            keys = [LOG_KEY.format(number) for number in range(self._seen + 1, count + 1)]
+            entries = cache.get_many(keys)
+            if len(entries) == len(keys) and self._filter.count + len(keys) < self._filter.capacity:
+                for jti in entries.values():
+                    self._add(jti)
+                self._seen = count
+                return
+        # Entries are logged after they commit, so the database has every one up to count
+        self._rebuild()
+        self._seen = count
+
+    def _poll(self):
+        now = timezone.now()
+        if self._filter is None or self._polled is None or self._filter.count >= self._filter.capacity:
+            self._rebuild()
+        elif now - self._polled >= timedelta(seconds=poll_seconds()):
+            new = BlacklistedToken.objects.filter(blacklisted_at__gte=self._polled - POLL_OVERLAP)
+            for jti in new.values_list('token__jti', flat=True):
+                self._add(jti)
+        else:
+            return
+        self._polled = now
+
+    def _add(self, jti):
+        # Entries seen twice (the overlap, our own published ones) don't fill the filter
+        if jti not in self._filter:
+            self._filter.add(jti)
+
+    def _rebuild(self):
+        jtis = list(
+            BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+            .values_list('token__jti', flat=True)
+        )
+        self._filter = BloomFilter(max(2 * len(jtis), MIN_CAPACITY))
+        for jti in jtis:
+            self._filter.add(jti)
+
+
+token_blacklist = TokenBlacklist()
+
+
+class BlacklistRefreshToken(RefreshToken):
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Unlike simplejwt's, the token isn't recorded as outstanding: add any
+        claims first, then call ``outstand()`` so the stored token is the one
+        issued.
+        """
+        return super(BlacklistMixin, cls).for_user(user)
+
+    def check_blacklist(self):
+        if token_blacklist.contains(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+    def blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        token_id = OutstandingToken.objects.filter(jti=jti).values_list('id', flat=True).first()
+        if token_id is None:
+            # Issued before the blacklist app; simplejwt resolves its user
+            token_id = super().outstand()[0].id
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token_id=token_id)], ignore_conflicts=True)
+        transaction.on_commit(lambda: token_blacklist.publish(jti))
+
+    def outstand(self):
+        """Record the token as outstanding; its user must exist."""
+        OutstandingToken.objects.bulk_create([OutstandingToken(
+            jti=self.payload[api_settings.JTI_CLAIM],
+            user_id=self.payload.get(api_settings.USER_ID_CLAIM),
+            token=str(self),
+            created_at=self.current_time,
+            expires_at=datetime_from_epoch(self.payload['exp']),
+        )], ignore_conflicts=True)
+
+
+def prune_expired_tokens(chunk_size=PRUNE_CHUNK_SIZE, now=None):
+    """
+    Delete expired outstanding tokens and their blacklist entries,
+    ``chunk_size`` tokens per transaction. Returns the tokens deleted.
+    """
+    now = now or timezone.now()
+    deleted = 0
+    expired = OutstandingToken.objects.filter(expires_at__lte=now).values_list('id')
+    for batch in keyset_batches(expired, chunk_size):
+        ids = [token_id for token_id, in batch]
+        # The collector loads at most chunk_size tokens and deletes their
+        # blacklist entries with one statement
+        _, per_model = OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += per_model.get(OutstandingToken._meta.label, 0)
+    return deleted
@@ -0,0 +1,223 @@
+"""
+Borrowing and returning books.
+
+Stock changes are made with conditional UPDATE statements so that the
+database, not a Python read-then-write, decides whether a copy is free.
+"""
+from collections import Counter, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from .counters import adjust_counters
+from .fines import finalize_fines
+from .models import Book, Transaction
+
+# Upper bound on ids accepted by one bulk borrow/return request
+MAX_BULK_ITEMS = 100
+
+
+class CirculationError(Exception):
+    status_code = 400
+
+
+class BookNotFound(CirculationError):
+    status_code = 404
+
+    def __init__(self):
+        super().__init__('Book does not exist')
+
+
+class NoCopiesAvailable(CirculationError):
+    def __init__(self):
+        super().__init__('No copies available for this book')
+
+
+class AlreadyBorrowed(CirculationError):
+    def __init__(self):
+        super().__init__('You have already checked out this book.')
+
+
+class BorrowConflict(CirculationError):
+    status_code = 409
+
+    def __init__(self):
+        super().__init__('The book could not be borrowed, please try again.')
+
+
+class LoanNotFound(CirculationError):
+    status_code = 404
+
+    def __init__(self):
+        super().__init__('Transaction does not exist')
+
+
+class AlreadyReturned(CirculationError):
+    def __init__(self):
+        super().__init__('Book already returned')
+
+
+def borrow_book(user, book_id):
+    """
+    Check out one copy of ``book_id`` to ``user`` and return the new loan.
+
+    The stock decrement is a single ``UPDATE ... WHERE copies_available > 0``
+    run in the same database transaction as the loan insert, so concurrent
+    borrows can never take the count below zero. A second open loan of the
+    same book is refused by the ``transaction_one_open_loan`` constraint,
+    which rolls the decrement back.
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            taken = Book.objects.active().filter(id=book_id, copies_available__gt=0).update(
+                copies_available=F('copies_available') - 1, updated_at=now,
+            )
+            if not taken:
+                # Only the failure path pays for telling "missing" from "out of stock"
+                if Book.objects.active().filter(id=book_id).exists():
+                    raise NoCopiesAvailable()
+                raise BookNotFound()
+            loan = Transaction.objects.create(user=user, book_id=book_id, date_checked_out=now)
+            adjust_counters(total_books_borrowed=1)
+            return loan
+    except IntegrityError:
+        # Only the one-open-loan constraint means "already borrowed"; other
+        # violations (e.g. a user deleted meanwhile) are real errors
+        if Transaction.objects.filter(user=user, book_id=book_id, date_returned__isnull=True).exists():
+            raise AlreadyBorrowed()
+        raise
+
+
+def return_loan(user, transaction_id):
+    """
+    Mark loan ``transaction_id`` returned and put its copy back in stock.
+
+    Only the ``UPDATE`` guarded on ``date_returned IS NULL`` can succeed, so
+    of two racing returns exactly one restocks the book. Staff may return any
+    loan, other users only their own. Returns the loan with its book loaded.
+    """
+    loans = Transaction.objects.all() if user.is_staff else Transaction.objects.filter(user=user)
+    now = timezone.now()
+    with transaction.atomic():
+        returned = loans.filter(id=transaction_id, date_returned__isnull=True).update(date_returned=now, updated_at=now)
+        if not returned:
+            if loans.filter(id=transaction_id).exists():
+                raise AlreadyReturned()
+            raise LoanNotFound()
+        Book.objects.filter(transaction=transaction_id).update(copies_available=F('copies_available') + 1, updated_at=now)
+        loan = Transaction.objects.select_related('book', 'user').get(id=transaction_id)
+        # Late returns also fix their fine in the ledger (one more query)
+        finalize_fines([(loan.id, loan.user_id, loan.book.title, loan.date_checked_out, loan.date_returned)])
+        adjust_counters(total_books_borrowed=-1)
+        return loan
+
+
+def borrow_books(user, book_ids):
+    """
+    Check out several books to ``user`` at once.
+
+    Returns one result dict per requested id, in request order. Available
+    books the user doesn't already hold are locked, decremented with one
+    ``UPDATE`` and their loans written with one ``bulk_create``, all in a
+    single database transaction.
+    """
+    requested = list(dict.fromkeys(book_ids))
+    try:
+        return _borrow_books(user, requested)
+    except IntegrityError:
+        pass
+    # A concurrent request lent one of the books to the same user after our
+    # check; the retry sees that loan and refuses the book
+    try:
+        return _borrow_books(user, requested)
+    except IntegrityError:
+        # Nothing was borrowed; report it per item rather than fail the request
+        held = set(
+            Transaction.objects.filter(user=user, book_id__in=requested, date_returned__isnull=True)
+            .values_list('book_id', flat=True)
+        )
+        return [
+            {'book_id': book_id, 'error': str(AlreadyBorrowed() if book_id in held else BorrowConflict())}
+            for book_id in requested
+        ]
+
+
+def _borrow_books(user, requested):
+    results = {}
+    held = Exists(Transaction.objects.filter(book=OuterRef('pk'), user=user, date_returned__isnull=True))
+    with transaction.atomic():
+        available = set(
+            Book.objects.active().select_for_update()
+            .filter(~held, id__in=requested, copies_available__gt=0)
+            .values_list('id', flat=True)
+        )
+        if available:
+            now = timezone.now()
+            Book.objects.filter(id__in=available).update(copies_available=F('copies_available') - 1, updated_at=now)
+            loans = Transaction.objects.bulk_create(
+                Transaction(user=user, book_id=book_id, date_checked_out=now)
+                for book_id in requested if book_id in available
+            )
+            for loan in loans:
+                results[loan.book_id] = {'book_id': loan.book_id, 'transaction_id': loan.id, 'status': 'borrowed'}
+            adjust_counters(total_books_borrowed=len(loans))
+
+        refused = [book_id for book_id in requested if book_id not in available]
+        if refused:
+            existing = dict(Book.objects.active().filter(id__in=refused).annotate(held=held).values_list('id', 'held'))
+            for book_id in refused:
+                if book_id not in existing:
+                    error = BookNotFound()
+                else:
+                    error = AlreadyBorrowed() if existing[book_id] else NoCopiesAvailable()
+                results[book_id] = {'book_id': book_id, 'error': str(error)}
+
+    return [results[book_id] for book_id in requested]
+
+
+def return_loans(user, transaction_ids):
+    """
+    Return several loans at once, with the same access rules as ``return_loan``.
+
+    Returns one result dict per requested id, in request order. Open loans are
+    locked and closed with one ``UPDATE``, late ones fined with one upsert,
+    and their books restocked with one ``UPDATE`` per distinct number of
+    copies coming back.
+    """
+    results = {}
+    requested = list(dict.fromkeys(transaction_ids))
+    loans = Transaction.objects.all() if user.is_staff else Transaction.objects.filter(user=user)
+    with transaction.atomic():
+        open_loans = {
+            loan[0]: loan for loan in
+            loans.select_for_update()
+            .filter(id__in=requested, date_returned__isnull=True)
+            .values_list('id', 'book_id', 'user_id', 'book__title', 'date_checked_out')
+        }
+        if open_loans:
+            now = timezone.now()
+            Transaction.objects.filter(id__in=open_loans).update(date_returned=now, updated_at=now)
+            finalize_fines(
+                (transaction_id, user_id, title, date_checked_out, now)
+                for transaction_id, _, user_id, title, date_checked_out in open_loans.values()
+            )
+            copies_by_book = Counter(loan[1] for loan in open_loans.values())
+            books_by_count = defaultdict(list)
+            for book_id, copies in copies_by_book.items():
+                books_by_count[copies].append(book_id)
+            for copies, book_ids in books_by_count.items():
+                Book.objects.filter(id__in=book_ids).update(copies_available=F('copies_available') + copies, updated_at=now)
+            for transaction_id, book_id, *_ in open_loans.values():
+                results[transaction_id] = {'transaction_id': transaction_id, 'book_id': book_id, 'status': 'returned'}
+            adjust_counters(total_books_borrowed=-len(open_loans))
+
+        refused = [transaction_id for transaction_id in requested if transaction_id not in open_loans]
+        if refused:
+            existing = set(loans.filter(id__in=refused).values_list('id', flat=True))
+            for transaction_id in refused:
+                error = AlreadyReturned() if transaction_id in existing else LoanNotFound()
+                results[transaction_id] = {'transaction_id': transaction_id, 'error': str(error)}
+
+    return [results[transaction_id] for transaction_id in requested]
@@ -0,0 +1,107 @@
+"""
+Running totals for the admin stats.
+
+Counting books, users and open loans scans whole tables, so
+``AdminStatsView`` reads them from ``StatCounter`` rows instead. The write
+paths call ``adjust_counters`` inside their own database transaction, so a
+rolled-back borrow never counts. Changes made elsewhere (the Django admin,
+``createsuperuser``, raw SQL) drift the totals until ``reconcile_counters``
+(``manage.py reconcile_counters``, run periodically) resets them to the
+true counts.
+
+Every borrow and return adjusts ``total_books_borrowed``, and the row
+lock an adjustment takes is held until its transaction commits. Each
+counter is therefore split over ``LIBRARY_COUNTER_SHARDS`` rows summed on
+read, and an adjustment goes to a random one, so concurrent checkouts
+rarely queue on the same row.
+"""
+import random
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Min, Sum
+from django.utils import timezone
+
+from .models import Book, StatCounter, Transaction
+
+# Counter name -> the rows it counts; the names are the stats response keys
+COUNTERS = {
+    'total_books': lambda: Book.objects.all(),
+    'total_users': lambda: User.objects.all(),
+    'total_books_borrowed': lambda: Transaction.objects.filter(date_returned__isnull=True),
+}
+
+
+def counter_shards():
+    """Rows each counter is spread over (``LIBRARY_COUNTER_SHARDS``)."""
+    return max(getattr(settings, 'LIBRARY_COUNTER_SHARDS', 8), 1)
+
+
+def adjust_counters(**deltas):
+    """
+    Add ``deltas`` to a random shard of the named counters, one ``UPDATE``
+    per non-zero delta.
+
+    Call it last in the transaction making the change: the shard stays
+    locked until that transaction commits.
+    """
+    for name, delta in deltas.items():
+        if delta:
+            shard = StatCounter.objects.filter(name=name, shard=random.randrange(counter_shards()))
+            if not shard.update(value=F('value') + delta):
+                # Shards added to the setting since the last reconcile don't exist yet
+                StatCounter.objects.filter(name=name, shard=0).update(value=F('value') + delta)
+
+
+def reconcile_counters(now=None):
+    """Reset every counter to its true count and return the drift found per counter."""
+    now = now or timezone.now()
+    shards = counter_shards()
+    current = Counter()
+    with transaction.atomic():
+        # Locked before counting, so a write path in flight adjusts either
+        # before the count sees its rows or after the reset
+        for name, value in StatCounter.objects.select_for_update().values_list('name', 'value'):
+            current[name] += value
+        counts = {name: rows().count() for name, rows in COUNTERS.items()}
+        # The true count goes to shard 0 and the other shards start over
+        StatCounter.objects.bulk_create(
+            [
+                StatCounter(name=name, shard=shard, value=value if shard == 0 else 0, reconciled_at=now)
+                for name, value in counts.items()
+                for shard in range(shards)
+            ],
+            update_conflicts=True,
+            unique_fields=['name', 'shard'],
+            update_fields=['value', 'reconciled_at'],
+        )
+        StatCounter.objects.filter(shard__gte=shards).delete()
+    return {name: value - current[name] for name, value in counts.items() if name in current}
+
+
+def read_counters(now=None):
+    """
+    The counters as ``{name: value}``, plus ``reconciled_at`` (the oldest
+    reconcile) and ``stale_seconds`` since then. Counters that don't exist
+    yet are counted first.
+    """
+    now = now or timezone.now()
+    totals = (
+        StatCounter.objects.filter(name__in=COUNTERS)
+        .values('name')
+        .annotate(total=Sum('value'), reconciled=Min('reconciled_at'))
+        .values_list('name', 'total', 'reconciled')
+        .order_by()
+    )
+    rows = list(totals)
+    if len(rows) < len(COUNTERS):
+        reconcile_counters(now)
+        rows = list(totals.all())
+    values = {name: value for name, value, _ in rows}
+    stats = {name: values[name] for name in COUNTERS}
+    reconciled_at = min(reconciled for _, _, reconciled in rows)
+    stats['reconciled_at'] = reconciled_at
+    stats['stale_seconds'] = max(round((now - reconciled_at).total_seconds()), 0)
+    return stats
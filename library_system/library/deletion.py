@@ -0,0 +1,119 @@
+"""
+Bulk removal of books from the catalog.
+
+Deleting is done in bounded chunks of book ids, each in its own database
+transaction, with ``QuerySet.delete()``. With no delete signal receivers
+in the cascade, Django's collector loads a chunk's books and only the
+primary keys of their loans, and empties the tables without children
+(notifications, fine ledger rows) with one ``DELETE`` each without
+loading them, so memory stays bounded by the chunk size.
+
+Dry runs walk the cascade on the models instead and count each table with
+a subquery, falling back to the collector for cascades the walk can't
+express in SQL.
+
+Archiving marks books as withdrawn instead, keeping their loan history.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import CASCADE, DO_NOTHING, SET_NULL, signals
+from django.db.models.deletion import Collector
+from django.utils import timezone
+
+from .batching import chunked
+from .counters import adjust_counters
+from .models import Book, Transaction
+
+DELETE_CHUNK_SIZE = 500
+
+
+class UnsafeCascade(Exception):
+    pass
+
+
+def cascade_plan(model, queryset):
+    """
+    Return the ``(action, model, queryset)`` steps that delete ``queryset``
+    and what cascades from it, children first.
+
+    ``action`` is ``'delete'`` or ``'set_null:<field>'``. Raises
+    ``UnsafeCascade`` when a model in the tree has delete signal receivers
+    or a relation that isn't ``CASCADE``, ``SET_NULL`` or ``DO_NOTHING``.
+    """
+    if signals.pre_delete.has_listeners(model) or signals.post_delete.has_listeners(model) or model._meta.many_to_many:
+        raise UnsafeCascade(model._meta.label)
+
+    steps = []
+    for relation in model._meta.related_objects:
+        if relation.on_delete is DO_NOTHING:
+            continue
+        if relation.many_to_many:
+            raise UnsafeCascade(relation.related_model._meta.label)
+        related = relation.related_model._base_manager.filter(**{f'{relation.field.name}__in': queryset})
+        if relation.on_delete is CASCADE:
+            steps += cascade_plan(relation.related_model, related)
+        elif relation.on_delete is SET_NULL:
+            steps.append((f'set_null:{relation.field.name}', relation.related_model, related))
+        else:
+            raise UnsafeCascade(relation.related_model._meta.label)
+    steps.append(('delete', model, queryset))
+    return steps
+
+
+def _delete_chunk(book_ids, dry_run):
+    books = Book.objects.filter(id__in=book_ids)
+    counts = Counter({'open_loans': Transaction.objects.filter(book__in=books, date_returned__isnull=True).count()})
+    if not dry_run:
+        counts.update(books.delete()[1])
+        return counts
+    try:
+        steps = cascade_plan(Book, books)
+    except UnsafeCascade:
+        collector = Collector(using=books.db)
+        collector.collect(books)
+        counts.update({model._meta.label: len(instances) for model, instances in collector.data.items()})
+        for queryset in collector.fast_deletes:
+            counts[queryset.model._meta.label] += queryset.count()
+        return counts
+
+    for action, model, queryset in steps:
+        if action == 'delete':
+            counts[model._meta.label] += queryset.count()
+    return counts
+
+
+def delete_books(book_ids, chunk_size=DELETE_CHUNK_SIZE, dry_run=False):
+    """
+    Delete ``book_ids`` and everything that cascades from them, ``chunk_size``
+    books per transaction. Returns the rows deleted (or, with ``dry_run``,
+    that would be) per model label, plus the loans that were still open.
+    """
+    counts = Counter()
+    for chunk in chunked(sorted(set(book_ids)), chunk_size):
+        with transaction.atomic():
+            deleted = _delete_chunk(chunk, dry_run)
+            if not dry_run:
+                adjust_counters(total_books=-deleted[Book._meta.label], total_books_borrowed=-deleted['open_loans'])
+        counts.update(deleted)
+    return dict(counts)
+
+
+def archive_books(book_ids, chunk_size=DELETE_CHUNK_SIZE, dry_run=False, now=None):
+    """
+    Withdraw ``book_ids`` from the catalog without touching their loans.
+
+    Archived books are hidden from listing and search and can't be
+    borrowed; copies still out can be returned. Returns the books archived
+    (or that would be) and the loans still open on them.
+    """
+    now = now or timezone.now()
+    counts = Counter()
+    for chunk in chunked(sorted(set(book_ids)), chunk_size):
+        books = Book.objects.active().filter(id__in=chunk)
+        counts['open_loans'] += Transaction.objects.filter(book__in=books, date_returned__isnull=True).count()
+        if dry_run:
+            counts[Book._meta.label] += books.count()
+        else:
+            counts[Book._meta.label] += books.update(archived_at=now, updated_at=now)
+    return dict(counts)
@@ -0,0 +1,95 @@
+"""
+Server-Sent Events stream of a user's notifications.
+
+Served as an async view by the ASGI application in ``library_system/asgi.py``
+so an idle client costs one held connection. The stream wakes as soon as
+``library.pubsub`` announces a new notification for the user and otherwise
+re-checks the notification index every ``LIBRARY_NOTIFICATION_STREAM_POLL``
+seconds, which also picks up rows written by other processes.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .authentication import ClaimsJWTAuthentication
+from .models import Notification
+from .pubsub import get_broker
+
+STREAM_BATCH_SIZE = 100
+
+
+def notification_channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def publish_notifications(user_ids):
+    """Wake the streams of ``user_ids``; call once the notifications are committed."""
+    broker = get_broker()
+    for user_id in set(user_ids):
+        broker.publish(notification_channel(user_id))
+
+
+def _authenticate(request):
+    try:
+        result = ClaimsJWTAuthentication().authenticate(request)
+    except (AuthenticationFailed, InvalidToken):
+        return None
+    return result[0] if result else None
+
+
+def _last_notification_id(user):
+    return Notification.objects.filter(user=user).aggregate(last=Max('id'))['last'] or 0
+
+
+def _notifications_after(user, last_id):
+    return list(
+        Notification.objects.filter(user=user, id__gt=last_id)
+        .order_by('id')
+        .values('id', 'message', 'is_read', 'created_at')[:STREAM_BATCH_SIZE]
+    )
+
+
+async def notification_stream(request):
+    user = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    last_id = request.headers.get('Last-Event-ID') or request.GET.get('last_id')
+    try:
+        last_id = int(last_id)
+    except (TypeError, ValueError):
+        last_id = await sync_to_async(_last_notification_id)(user)
+
+    response = StreamingHttpResponse(_events(user, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+async def _events(user, last_id):
+    poll = getattr(settings, 'LIBRARY_NOTIFICATION_STREAM_POLL', 15)
+    broker = get_broker()
+    channel = notification_channel(user.id)
+    queue = broker.subscribe(channel)
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            notifications = await sync_to_async(_notifications_after)(user, last_id)
+            for notification in notifications:
+                last_id = notification['id']
+                data = json.dumps(notification, cls=DjangoJSONEncoder)
+                yield f'id: {last_id}\nevent: notification\ndata: {data}\n\n'
+            if len(notifications) == STREAM_BATCH_SIZE:
+                continue
+            try:
+                await asyncio.wait_for(queue.get(), timeout=poll)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+    finally:
+        broker.unsubscribe(channel, queue)
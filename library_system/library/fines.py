@@ -0,0 +1,198 @@
+"""
+Overdue fines.
+
+Fines are derived in SQL from the ``overdue_days`` annotation of
+``TransactionQuerySet.with_overdue()`` so that a patron's fines, or every
+patron's fines at once, cost a single aggregated query. ``FineLedger``
+materializes them so reads don't touch loan history at all.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Q, Sum, Value, When, Window
+from django.utils import timezone
+
+from .batching import chunked, keyset_batches
+from .models import FineLedger, Transaction, loan_period
+
+FINE_FIELD = DecimalField(max_digits=12, decimal_places=2)
+LEDGER_CHUNK_SIZE = 1000
+
+
+def fine_rate():
+    """Fine charged per overdue day (``LIBRARY_FINE_PER_DAY``)."""
+    return Decimal(str(getattr(settings, 'LIBRARY_FINE_PER_DAY', 2)))
+
+
+def fine_cap():
+    """Most a single loan can be fined (``LIBRARY_FINE_CAP``), ``None`` for no cap."""
+    cap = getattr(settings, 'LIBRARY_FINE_CAP', None)
+    return None if cap is None else Decimal(str(cap))
+
+
+def fine_expression():
+    """SQL expression for the fine of one loan annotated by ``with_overdue()``."""
+    fine = F('overdue_days') * Value(fine_rate(), output_field=FINE_FIELD)
+    cap = fine_cap()
+    if cap is None or not fine_rate():
+        # With no daily rate every fine is zero and the cap never applies
+        return fine
+    capped = Value(cap, output_field=FINE_FIELD)
+    return Case(When(overdue_days__gt=cap / fine_rate(), then=capped), default=fine, output_field=FINE_FIELD)
+
+
+def loans_with_fines(queryset=None, now=None):
+    """Overdue loans from ``queryset`` annotated with their ``fine``."""
+    queryset = Transaction.objects.all() if queryset is None else queryset
+    return queryset.overdue(now).annotate(fine=fine_expression())
+
+
+def user_fines(user, now=None):
+    """
+    Return ``(total, loans)`` for ``user``, where ``loans`` is a list of dicts
+    with the book title, overdue days and fine of every overdue loan.
+
+    The total is a window ``SUM`` over the same rows, so it is one query.
+    """
+    loans = list(
+        loans_with_fines(Transaction.objects.filter(user=user), now)
+        .annotate(total_fine=Window(Sum('fine')))
+        .values('id', 'book_id', 'book__title', 'overdue_days', 'fine', 'total_fine')
+        .order_by('date_checked_out', 'id')
+    )
+    total = loans[0]['total_fine'] if loans else Decimal('0')
+    return total, loans
+
+
+def fines_by_user(now=None):
+    """
+    Total fines for every patron with overdue loans, in one grouped query.
+
+    Yields dicts with ``user_id``, ``overdue_loans`` and ``total_fine``.
+    """
+    return (
+        Transaction.objects.overdue(now)
+        .values('user_id')
+        .annotate(overdue_loans=Count('id'), total_fine=Sum(fine_expression(), output_field=FINE_FIELD))
+        .order_by('user_id')
+    )
+
+
+def overdue_days_at(date_checked_out, when):
+    """Python twin of the ``overdue_days`` annotation, ``None`` if not overdue at ``when``."""
+    elapsed = when - date_checked_out
+    if elapsed <= loan_period():
+        return None
+    return max(elapsed.days - loan_period().days, 0)
+
+
+def compute_fine(overdue_days):
+    """Python twin of ``fine_expression()``."""
+    fine = overdue_days * fine_rate()
+    cap = fine_cap()
+    return fine if cap is None else min(fine, cap)
+
+
+def finalize_fines(loans):
+    """
+    Fix the ledger fine of returned loans.
+
+    ``loans`` yields ``(transaction_id, user_id, book_title, date_checked_out,
+    date_returned)``. Loans that were returned on time cost nothing; the rest
+    are written with one upsert.
+    """
+    entries = []
+    for transaction_id, user_id, book_title, date_checked_out, date_returned in loans:
+        overdue_days = overdue_days_at(date_checked_out, date_returned)
+        if overdue_days is None:
+            continue
+        entries.append(FineLedger(
+            transaction_id=transaction_id, user_id=user_id, book_title=book_title,
+            overdue_days=overdue_days, fine=compute_fine(overdue_days),
+            is_final=True, updated_at=date_returned,
+        ))
+    if entries:
+        FineLedger.objects.bulk_create(
+            entries,
+            update_conflicts=True,
+            unique_fields=['transaction'],
+            update_fields=['overdue_days', 'fine', 'is_final', 'updated_at'],
+        )
+
+
+def advance_fine_ledger(now=None, chunk_size=LEDGER_CHUNK_SIZE):
+    """
+    Bring the ledger up to date as of ``now`` and return the number of rows written.
+
+    Only open overdue loans whose ledger row is missing or whose overdue days
+    have moved on are rewritten, so returned history is never scanned. Loans
+    returned without going through ``finalize_fines`` are finalized as a
+    backstop.
+    """
+    now = now or timezone.now()
+    written = 0
+
+    stale = (
+        loans_with_fines(now=now)
+        .filter(
+            Q(fine_ledger__isnull=True)
+            | Q(fine_ledger__overdue_days__lt=F('overdue_days'))
+            | Q(fine_ledger__overdue_days__gt=F('overdue_days'))
+        )
+        .values_list('id', 'user_id', 'book__title', 'overdue_days', 'fine')
+    )
+    for chunk in keyset_batches(stale, chunk_size, 'id'):
+        with transaction.atomic():
+            FineLedger.objects.bulk_create(
+                [
+                    FineLedger(
+                        transaction_id=transaction_id, user_id=user_id, book_title=book_title,
+                        overdue_days=overdue_days, fine=fine, updated_at=now,
+                    )
+                    for transaction_id, user_id, book_title, overdue_days, fine in chunk
+                ],
+                update_conflicts=True,
+                unique_fields=['transaction'],
+                update_fields=['overdue_days', 'fine', 'updated_at'],
+            )
+        written += len(chunk)
+
+    returned = (
+        FineLedger.objects.filter(is_final=False, transaction__date_returned__isnull=False)
+        .values_list('transaction_id', 'user_id', 'book_title', 'transaction__date_checked_out', 'transaction__date_returned')
+    )
+    for chunk in keyset_batches(returned, chunk_size, 'transaction_id'):
+        with transaction.atomic():
+            finalize_fines(chunk)
+        written += len(chunk)
+
+    return written
+
+
+def rebuild_fine_ledger(now=None, chunk_size=LEDGER_CHUNK_SIZE):
+    """Recompute the whole ledger from ``Transaction`` history (initial backfill)."""
+    with transaction.atomic():
+        FineLedger.objects.all().delete()
+        history = (
+            Transaction.objects.filter(date_returned__isnull=False)
+            .values_list('id', 'user_id', 'book__title', 'date_checked_out', 'date_returned')
+            .iterator(chunk_size=chunk_size)
+        )
+        for chunk in chunked(history, chunk_size):
+            finalize_fines(chunk)
+    return advance_fine_ledger(now, chunk_size)
+
+
+def ledger_fines(user):
+    """
+    Return ``(total, entries)`` for ``user`` from the ledger, where ``entries``
+    are dicts with the book title, overdue days, fine and whether it is final.
+    """
+    entries = list(
+        FineLedger.objects.filter(user=user)
+        .values('transaction_id', 'book_title', 'overdue_days', 'fine', 'is_final')
+        .order_by('transaction_id')
+    )
+    return sum((entry['fine'] for entry in entries), Decimal('0')), entries
+
@@ -0,0 +1,224 @@
+"""
+Streaming bulk import of books from CSV or JSON Lines.
+
+Rows are parsed one at a time from the uploaded file, validated in memory
+and upserted on ISBN with one ``bulk_create`` per chunk, each chunk in its
+own transaction. Memory use depends on the chunk size, not the file size.
+
+Large files can also be split into row ranges with ``plan_row_ranges`` and
+imported range by range, possibly by several workers (see ``library.jobs``).
+"""
+import csv
+import io
+import json
+import time
+from contextlib import contextmanager
+from datetime import date
+from itertools import takewhile
+
+from django.conf import settings
+from django.db import transaction
+
+from .batching import chunked
+from .counters import adjust_counters
+from .models import Book
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+@contextmanager
+def readable_file():
+    """Report undecodable bytes and malformed CSV in the block as ``ImportFormatError``."""
+    try:
+        yield
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f'The file is not valid UTF-8 text ({e.reason} at byte {e.start}).') from e
+    except csv.Error as e:
+        raise ImportFormatError(f'The file is not valid CSV ({e}).') from e
+
+
+def import_chunk_size():
+    return getattr(settings, 'LIBRARY_IMPORT_CHUNK_SIZE', 2000)
+
+
+def detect_format(filename, requested=None):
+    if requested:
+        if requested not in FORMATS.values():
+            raise ImportFormatError(f"Unsupported format '{requested}', use csv or jsonl.")
+        return requested
+    for extension, name in FORMATS.items():
+        if (filename or '').lower().endswith(extension):
+            return name
+    raise ImportFormatError('Cannot tell the file format, name it .csv or .jsonl or pass file_format=csv|jsonl.')
+
+
+def iter_records(file, file_format, fieldnames=None, first_row=1):
+    """
+    Yield ``(row_number, record)`` pairs without reading the whole file.
+
+    To read from the middle of a file, seek it to a row's byte offset and
+    pass that row's number as ``first_row``, plus the CSV header as
+    ``fieldnames`` since it won't be read again.
+    """
+    # Wrap the underlying binary file so Django uploads decode incrementally
+    text = io.TextIOWrapper(getattr(file, 'file', file), encoding='utf-8-sig', newline='')
+    try:
+        with readable_file():
+            if file_format == 'csv':
+                for number, record in enumerate(csv.DictReader(text, fieldnames=fieldnames), start=first_row):
+                    yield number, record
+            else:
+                for number, line in enumerate(text, start=first_row):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    yield number, record
+    finally:
+        text.detach()
+
+
+def validate_record(record):
+    """Return ``(book, None)`` for a valid record or ``(None, errors)``."""
+    if not isinstance(record, dict):
+        return None, {'row': 'Not a valid record.'}
+
+    errors = {}
+    values = {}
+    for field in ('title', 'author', 'isbn'):
+        value = str(record.get(field) or '').strip()
+        limit = Book._meta.get_field(field).max_length
+        if not value:
+            errors[field] = 'This field is required.'
+        elif len(value) > limit:
+            errors[field] = f'Ensure this field has no more than {limit} characters.'
+        values[field] = value
+
+    try:
+        values['published_date'] = date.fromisoformat(str(record.get('published_date') or '').strip())
+    except ValueError:
+        errors['published_date'] = 'Date has wrong format. Use YYYY-MM-DD.'
+
+    try:
+        values['copies_available'] = int(record.get('copies_available'))
+        if values['copies_available'] < 0:
+            errors['copies_available'] = 'Ensure this value is greater than or equal to 0.'
+    except (TypeError, ValueError):
+        errors['copies_available'] = 'A valid integer is required.'
+
+    if errors:
+        return None, errors
+    return Book(**values), None
+
+
+def _tracked_lines(file, position):
+    """Yield the decoded lines of binary ``file``, keeping ``position[0]`` at the end of the last one."""
+    for number, raw in enumerate(getattr(file, 'file', file)):
+        position[0] += len(raw)
+        yield raw.decode('utf-8-sig' if number == 0 else 'utf-8')
+
+
+def plan_row_ranges(file, file_format, rows_per_range):
+    """
+    Split ``file`` into ranges of ``rows_per_range`` rows in one streaming pass.
+
+    Returns ``(fieldnames, ranges)`` where ``fieldnames`` is the CSV header
+    (``None`` for JSON Lines) and ``ranges`` is a list of ``(first_row,
+    last_row, offset)`` tuples, ``offset`` being the byte offset of
+    ``first_row``. Rows are counted by the same ``DictReader`` that
+    ``iter_records`` reads them with, so records spanning several lines
+    and skipped blank lines number the same in both.
+    """
+    position = [0]
+    lines = _tracked_lines(file, position)
+    with readable_file():
+        fieldnames = None
+        if file_format == 'csv':
+            rows = csv.DictReader(lines)
+            fieldnames = rows.fieldnames
+        else:
+            rows = lines
+
+        starts = []
+        row_offset = position[0]
+        total = 0
+        for total, _ in enumerate(rows, start=1):
+            if (total - 1) % rows_per_range == 0:
+                starts.append((total, row_offset))
+            # The reader has consumed exactly this row's lines, so the next row starts here
+            row_offset = position[0]
+
+    last_rows = [first_row - 1 for first_row, _ in starts[1:]] + [total]
+    return fieldnames, [
+        (first_row, last_row, offset) for (first_row, offset), last_row in zip(starts, last_rows)
+    ]
+
+
+def import_records(records, chunk_size=None, report=None):
+    """
+    Upsert ``(row_number, record)`` pairs on ISBN and return the report
+    counts, adding to ``report`` if one is given.
+    """
+    chunk_size = chunk_size or import_chunk_size()
+    report = report if report is not None else {'rows': 0, 'imported': 0, 'failed': 0, 'errors': []}
+
+    for chunk in chunked(records, chunk_size):
+        books = {}
+        for number, record in chunk:
+            book, errors = validate_record(record)
+            if errors:
+                report['failed'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'row': number, 'errors': errors})
+            else:
+                report['imported'] += 1
+                # A repeated ISBN within one chunk keeps the last row, as a
+                # single upsert can't touch the same row twice
+                books[book.isbn] = book
+        report['rows'] += len(chunk)
+        if books:
+            with transaction.atomic():
+                # The upsert can't tell inserts from updates, so count the known ISBNs first
+                known = Book.objects.filter(isbn__in=list(books)).count()
+                Book.objects.bulk_create(
+                    books.values(),
+                    update_conflicts=True,
+                    unique_fields=['isbn'],
+                    update_fields=['title', 'author', 'published_date', 'copies_available', 'updated_at'],
+                )
+                adjust_counters(total_books=len(books) - known)
+    return report
+
+
+def import_row_range(file, file_format, first_row, last_row, offset, fieldnames=None, chunk_size=None):
+    """Import rows ``first_row`` to ``last_row`` of ``file``, starting at byte ``offset``."""
+    file.seek(offset)
+    records = takewhile(
+        lambda item: item[0] <= last_row,
+        iter_records(file, file_format, fieldnames, first_row),
+    )
+    return import_records(records, chunk_size)
+
+
+def import_books(file, file_format, chunk_size=None):
+    """
+    Upsert the books in ``file`` on ISBN and return a report.
+
+    The report has row counts, throughput and up to ``MAX_REPORTED_ERRORS``
+    row-level errors.
+    """
+    started = time.perf_counter()
+    report = import_records(iter_records(file, file_format), chunk_size)
+
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows'] / elapsed) if elapsed else report['rows']
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    return report
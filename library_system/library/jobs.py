@@ -0,0 +1,253 @@
+"""
+Background book imports.
+
+An upload is stored and queued as an ``ImportJob``. Workers started with
+``manage.py run_import_worker`` split a queued job into ``ImportChunk`` row
+ranges and lease the ranges one at a time, so several workers, in one or
+many processes, can import the same file. A lease that isn't completed
+before it expires, e.g. because its worker died, is taken over by another
+worker; rows are upserted on ISBN, so importing a range twice is harmless.
+The stored file is deleted once its job is done or has failed.
+"""
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Value, When
+from django.utils import timezone
+
+from .importer import MAX_REPORTED_ERRORS, ImportFormatError, import_chunk_size, import_row_range, plan_row_ranges
+from .models import ImportChunk, ImportJob
+
+# Leases of a range are given up on after this many expire
+MAX_ATTEMPTS = 3
+
+
+def rows_per_range():
+    """Rows per leased range (``LIBRARY_IMPORT_RANGE_SIZE``)."""
+    return getattr(settings, 'LIBRARY_IMPORT_RANGE_SIZE', 50000)
+
+
+def lease_duration():
+    """How long a worker may hold a range (``LIBRARY_IMPORT_LEASE_SECONDS``)."""
+    return timedelta(seconds=getattr(settings, 'LIBRARY_IMPORT_LEASE_SECONDS', 300))
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue_import(file, file_format, user=None, range_size=None, chunk_size=None):
+    """Store the uploaded ``file`` and queue it for import, returning the job."""
+    job = ImportJob(
+        file_format=file_format, rows_per_chunk=range_size or rows_per_range(), chunk_size=chunk_size, created_by=user,
+    )
+    job.file.save(os.path.basename(file.name), file, save=False)
+    job.save()
+    return job
+
+
+def plan_next_job(now=None):
+    """
+    Split the oldest queued job into row ranges and return it, or ``None``.
+
+    A job is claimed with a conditional ``UPDATE`` so only one worker plans
+    it. Jobs whose planner vanished are claimed again once a lease expires.
+    """
+    now = now or timezone.now()
+    claimable = Q(status=ImportJob.QUEUED) | Q(status=ImportJob.PLANNING, started_at__lt=now - lease_duration())
+    for job_id in ImportJob.objects.filter(claimable).order_by('created_at', 'id').values_list('id', flat=True)[:10]:
+        if ImportJob.objects.filter(claimable, id=job_id).update(status=ImportJob.PLANNING, started_at=now):
+            job = ImportJob.objects.get(id=job_id)
+            _plan_job(job, claimed_at=now)
+            return job
+    return None
+
+
+def _plan_job(job, claimed_at):
+    try:
+        with job.file.open('rb') as file:
+            fieldnames, ranges = plan_row_ranges(file, job.file_format, job.rows_per_chunk)
+    except (OSError, ImportFormatError) as e:
+        failed = ImportJob.objects.filter(id=job.id, status=ImportJob.PLANNING, started_at=claimed_at).update(
+            status=ImportJob.FAILED, error=str(e), finished_at=timezone.now(),
+        )
+        if failed:
+            _delete_file(job.file.name)
+        return
+
+    total_rows = ranges[-1][1] if ranges else 0
+    with transaction.atomic():
+        # Only the latest claim may publish its plan
+        planned = ImportJob.objects.filter(id=job.id, status=ImportJob.PLANNING, started_at=claimed_at).update(
+            status=ImportJob.RUNNING if ranges else ImportJob.DONE,
+            fieldnames=fieldnames,
+            total_rows=total_rows,
+            finished_at=None if ranges else timezone.now(),
+        )
+        if planned:
+            ImportChunk.objects.bulk_create(
+                ImportChunk(job=job, first_row=first_row, last_row=last_row, offset=offset)
+                for first_row, last_row, offset in ranges
+            )
+        if planned and not ranges:
+            _delete_file(job.file.name)
+
+
+def lease_chunk(worker_id, now=None):
+    """
+    Lease the next pending (or abandoned) range of a running job and return
+    it with its job loaded, or ``None`` if there is nothing to do.
+    """
+    now = now or timezone.now()
+    _give_up_abandoned(now)
+    leasable = Q(status=ImportChunk.PENDING) | Q(status=ImportChunk.LEASED, lease_expires__lt=now)
+    candidates = (
+        ImportChunk.objects.filter(leasable, job__status=ImportJob.RUNNING)
+        .order_by('job_id', 'first_row')
+        .values_list('id', flat=True)[:10]
+    )
+    for chunk_id in candidates:
+        leased = ImportChunk.objects.filter(leasable, id=chunk_id).update(
+            status=ImportChunk.LEASED,
+            leased_by=worker_id,
+            lease_expires=now + lease_duration(),
+            attempts=F('attempts') + 1,
+        )
+        if leased:
+            return ImportChunk.objects.select_related('job').get(id=chunk_id)
+    return None
+
+
+def _give_up_abandoned(now):
+    abandoned = ImportChunk.objects.filter(
+        status=ImportChunk.LEASED, lease_expires__lt=now, attempts__gte=MAX_ATTEMPTS,
+    )
+    job_ids = set(abandoned.values_list('job_id', flat=True))
+    if job_ids:
+        abandoned.update(
+            status=ImportChunk.FAILED,
+            errors=[{'row': None, 'errors': {'lease': 'Abandoned by its workers too many times.'}}],
+        )
+        for job_id in job_ids:
+            _finish_job(job_id)
+
+
+def process_chunk(chunk, worker_id):
+    """Import a leased range and record the outcome. Returns ``False`` if the lease was lost."""
+    job = chunk.job
+    try:
+        with job.file.open('rb') as file:
+            report = import_row_range(
+                file, job.file_format, chunk.first_row, chunk.last_row, chunk.offset,
+                fieldnames=job.fieldnames, chunk_size=job.chunk_size or import_chunk_size(),
+            )
+    except (OSError, ImportFormatError) as e:
+        return _release(chunk, worker_id, status=ImportChunk.FAILED, errors=[{'row': None, 'errors': {'file': str(e)}}])
+    return _release(
+        chunk, worker_id,
+        status=ImportChunk.DONE,
+        rows_imported=report['imported'],
+        rows_failed=report['failed'],
+        errors=report['errors'],
+    )
+
+
+def _release(chunk, worker_id, status, rows_imported=0, rows_failed=0, errors=()):
+    with transaction.atomic():
+        released = ImportChunk.objects.filter(
+            id=chunk.id, status=ImportChunk.LEASED, leased_by=worker_id, attempts=chunk.attempts,
+        ).update(
+            status=status, lease_expires=None,
+            rows_imported=rows_imported, rows_failed=rows_failed, errors=list(errors),
+        )
+        if not released:
+            # The lease expired and another worker owns the range now
+            return False
+        ImportJob.objects.filter(id=chunk.job_id).update(
+            rows_done=F('rows_done') + (chunk.last_row - chunk.first_row + 1),
+            rows_imported=F('rows_imported') + rows_imported,
+            rows_failed=F('rows_failed') + rows_failed,
+        )
+        _finish_job(chunk.job_id)
+    return True
+
+
+def _finish_job(job_id):
+    """Mark a running job done (or failed) once none of its ranges are left."""
+    ranges = ImportChunk.objects.filter(job=OuterRef('pk'))
+    finished = ImportJob.objects.filter(id=job_id, status=ImportJob.RUNNING).exclude(
+        Exists(ranges.filter(status__in=[ImportChunk.PENDING, ImportChunk.LEASED])),
+    ).update(
+        status=Case(
+            When(Exists(ranges.filter(status=ImportChunk.FAILED)), then=Value(ImportJob.FAILED)),
+            default=Value(ImportJob.DONE),
+        ),
+        finished_at=timezone.now(),
+    )
+    if finished:
+        _delete_file(ImportJob.objects.filter(id=job_id).values_list('file', flat=True).get())
+
+
+def _delete_file(name):
+    """Delete a finished job's stored upload once the transaction finishing it commits."""
+    storage = ImportJob._meta.get_field('file').storage
+    transaction.on_commit(lambda: storage.delete(name))
+
+
+def run_worker(worker_id=None, poll_interval=5.0, exit_when_idle=False):
+    """
+    Plan queued jobs and import leased ranges until stopped, or until there
+    is no work left if ``exit_when_idle``. Returns the ranges processed.
+    """
+    worker_id = worker_id or default_worker_id()
+    processed = 0
+    while True:
+        job = plan_next_job()
+        chunk = lease_chunk(worker_id)
+        if chunk is not None:
+            process_chunk(chunk, worker_id)
+            processed += 1
+        elif job is None:
+            # A job another worker is still planning will have ranges shortly
+            planning = ImportJob.objects.filter(status__in=[ImportJob.QUEUED, ImportJob.PLANNING]).exists()
+            if exit_when_idle and not planning:
+                return processed
+            time.sleep(poll_interval)
+
+
+def job_progress(job, now=None):
+    """Progress report for ``job``: row counts, throughput, range states and errors."""
+    now = now or timezone.now()
+    elapsed = ((job.finished_at or now) - job.started_at).total_seconds() if job.started_at else 0
+    ranges = dict(job.chunks.values_list('status').annotate(count=Count('id')).order_by())
+
+    errors = []
+    with_errors = job.chunks.filter(Q(rows_failed__gt=0) | Q(status=ImportChunk.FAILED)).order_by('first_row')
+    for chunk_errors in with_errors.values_list('errors', flat=True):
+        errors.extend(chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+        if len(errors) >= MAX_REPORTED_ERRORS:
+            break
+
+    return {
+        'id': job.id,
+        'status': job.status,
+        'file_format': job.file_format,
+        'total_rows': job.total_rows,
+        'rows_done': job.rows_done,
+        'imported': job.rows_imported,
+        'failed': job.rows_failed,
+        'percent': round(100 * job.rows_done / job.total_rows, 1) if job.total_rows else None,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(job.rows_done / elapsed) if elapsed else 0,
+        'ranges': {state: ranges.get(state, 0) for state, _ in ImportChunk.STATUS_CHOICES},
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'error': job.error,
+        'errors': errors,
+        'errors_truncated': job.rows_failed > len(errors),
+    }
@@ -0,0 +1,72 @@
+"""
+Helpers shared by the ``bench_*`` management commands.
+
+Benchmarks run against a throwaway test database so they never touch the
+development data in ``db.sqlite3``.
+"""
+import os
+import random
+import statistics
+import string
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from django.db import connection
+
+from library.models import Book
+
+
+@contextmanager
+def scratch_database(on_disk=False):
+    """
+    Run the block against a freshly migrated test database.
+
+    ``on_disk`` puts a SQLite test database in a temporary file instead of
+    memory so that worker threads get their own connections to it.
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    with tempfile.TemporaryDirectory() as directory:
+        if on_disk and connection.vendor == 'sqlite':
+            test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = old_test_name
+
+
+def timed(func, repeat):
+    """Run ``func`` ``repeat`` times and return the median wall time in ms."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def make_vocabulary(size, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(size)]
+
+
+def seed_books(count, start=0, vocabulary=None, batch_size=5000, seed=0):
+    """Insert ``count`` synthetic books with ISBNs numbered from ``start``."""
+    rng = random.Random(seed + start)
+    vocabulary = vocabulary or make_vocabulary(5000)
+    for offset in range(start, start + count, batch_size):
+        Book.objects.bulk_create([
+            Book(
+                title=' '.join(rng.choices(vocabulary, k=rng.randint(2, 6))).title(),
+                author=' '.join(rng.choices(vocabulary, k=2)).title(),
+                isbn=f'{n:013d}',
+                published_date=date(2000, 1, 1),
+                copies_available=rng.randint(0, 5),
+            )
+            for n in range(offset, min(offset + batch_size, start + count))
+        ])
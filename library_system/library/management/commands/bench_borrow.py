@@ -0,0 +1,68 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from library.circulation import NoCopiesAvailable, borrow_book
+from library.models import Book, Transaction
+
+from ._bench import scratch_database
+
+
+class Command(BaseCommand):
+    help = 'Fire concurrent borrows at a single title and check that it is never oversold.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--borrows', type=int, default=2000, help='Total borrow attempts.')
+        parser.add_argument('--copies', type=int, default=500, help='Copies of the title in stock.')
+        parser.add_argument('--threads', type=int, default=32, help='Concurrent borrowers.')
+
+    def handle(self, *args, **options):
+        borrows, copies = options['borrows'], options['copies']
+        with scratch_database(on_disk=True):
+            book = Book.objects.create(
+                title='Stress Test', author='Bench', isbn='0000000000000',
+                published_date=date(2000, 1, 1), copies_available=copies,
+            )
+            User.objects.bulk_create(User(username=f'bench{n}') for n in range(borrows))
+            user_ids = list(User.objects.values_list('id', flat=True))
+            outcomes = {'borrowed': 0, 'refused': 0}
+            lock = threading.Lock()
+
+            def attempt(user_id):
+                try:
+                    borrow_book(User(id=user_id), book.id)
+                    outcome = 'borrowed'
+                except NoCopiesAvailable:
+                    outcome = 'refused'
+                with lock:
+                    outcomes[outcome] += 1
+
+            def run_worker(ids):
+                for user_id in ids:
+                    attempt(user_id)
+                connection.close()
+
+            chunks = [user_ids[n::options['threads']] for n in range(options['threads'])]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                list(pool.map(run_worker, chunks))
+            elapsed = time.perf_counter() - start
+
+            book.refresh_from_db()
+            loans = Transaction.objects.filter(book=book).count()
+
+        self.stdout.write(f"attempts:        {borrows}")
+        self.stdout.write(f"borrowed:        {outcomes['borrowed']}")
+        self.stdout.write(f"refused:         {outcomes['refused']}")
+        self.stdout.write(f"loans recorded:  {loans}")
+        self.stdout.write(f"copies left:     {book.copies_available}")
+        self.stdout.write(f"throughput:      {borrows / elapsed:.0f} borrows/s")
+
+        if loans != copies - book.copies_available or loans > copies:
+            raise CommandError('Oversold: loans recorded do not match the stock taken.')
+        self.stdout.write(self.style.SUCCESS('No oversell.'))
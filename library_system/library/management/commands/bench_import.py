@@ -0,0 +1,55 @@
+import os
+import random
+import resource
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from library.importer import import_books, import_chunk_size
+from library.models import Book
+
+from ._bench import make_vocabulary, scratch_database
+
+
+class Command(BaseCommand):
+    help = 'Import a synthetic publisher feed through the streaming importer and report throughput.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Rows in the synthetic feed.')
+        parser.add_argument('--chunk-size', type=int, default=import_chunk_size(), help='Rows per upsert transaction.')
+        parser.add_argument('--file-format', choices=['csv', 'jsonl'], default='csv')
+
+    def handle(self, *args, **options):
+        rows, file_format = options['rows'], options['file_format']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f'feed.{file_format}')
+            self.write_feed(path, rows, file_format)
+            size_mb = os.path.getsize(path) / 2 ** 20
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            with scratch_database(on_disk=True), open(path, 'rb') as feed:
+                report = import_books(feed, file_format, chunk_size=options['chunk_size'])
+                books = Book.objects.count()
+
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        self.stdout.write(f'feed:            {rows} rows, {size_mb:.1f} MiB {file_format}')
+        self.stdout.write(f"imported:        {report['imported']} rows ({report['failed']} rejected), {books} books stored")
+        self.stdout.write(f"elapsed:         {report['seconds']:.1f} s")
+        self.stdout.write(f"throughput:      {report['rows_per_second']} rows/s")
+        self.stdout.write(f'peak RSS growth: {(rss_after - rss_before) / 1024:.1f} MiB')
+
+    def write_feed(self, path, rows, file_format):
+        rng = random.Random(0)
+        vocabulary = make_vocabulary(5000)
+        with open(path, 'w', encoding='utf-8') as feed:
+            if file_format == 'csv':
+                feed.write('title,author,isbn,published_date,copies_available\n')
+            for n in range(rows):
+                title = ' '.join(rng.choices(vocabulary, k=3)).title()
+                author = ' '.join(rng.choices(vocabulary, k=2)).title()
+                copies = rng.randint(0, 9)
+                if file_format == 'csv':
+                    feed.write(f'{title},{author},{n:013d},2001-01-01,{copies}\n')
+                else:
+                    feed.write(f'{{"title": "{title}", "author": "{author}", "isbn": "{n:013d}", "published_date": "2001-01-01", "copies_available": {copies}}}\n')
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import time
+
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from library.passwords import averify_credentials, hash_workers
+
+from ._bench import scratch_database
+
+STOCK_HASHER = 'django.contrib.auth.hashers.PBKDF2PasswordHasher'
+PASSWORD = 'bench-password'
+
+
+class Command(BaseCommand):
+    help = 'Compare login throughput of the old inline PBKDF2 check with the pooled check of the configured hasher.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=40, help='Logins per measurement.')
+
+    def handle(self, *args, **options):
+        logins = options['logins']
+        cores = min(hash_workers(), os.cpu_count() or 1)
+        with scratch_database(on_disk=True):
+            # As UserLoginView did: authenticate() on the request thread with Django's stock hasher
+            with override_settings(PASSWORD_HASHERS=[STOCK_HASHER]):
+                self.seed('before', logins)
+                start = time.perf_counter()
+                users = [authenticate(username=f'before{n}', password=PASSWORD) for n in range(logins)]
+                before = logins / (time.perf_counter() - start)
+
+            self.seed('after', logins)
+            start = time.perf_counter()
+            users += asyncio.run(self.pooled_logins(logins))
+            after = logins / (time.perf_counter() - start)
+
+        if None in users:
+            raise CommandError('A benchmark login was refused.')
+
+        self.stdout.write(f"{'path':<36} {'logins/s':>9} {'per core':>9}")
+        self.stdout.write(f"{'before: inline, pbkdf2_sha256':<36} {before:>9.1f} {before:>9.1f}")
+        self.stdout.write(f"{f'after: pool of {hash_workers()}, {get_hasher().algorithm}':<36} {after:>9.1f} {after / cores:>9.1f}")
+
+    def seed(self, prefix, count):
+        encoded = make_password(PASSWORD)
+        User.objects.bulk_create(User(username=f'{prefix}{n}', password=encoded) for n in range(count))
+
+    async def pooled_logins(self, count):
+        return await asyncio.gather(*(averify_credentials(f'after{n}', PASSWORD) for n in range(count)))
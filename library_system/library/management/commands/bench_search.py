@@ -0,0 +1,43 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from library.models import Book
+from library.search import search_books
+
+from ._bench import make_vocabulary, scratch_database, seed_books, timed
+
+
+class Command(BaseCommand):
+    help = 'Compare catalog search latency of the full-text index against title__icontains.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000', help='Comma separated catalog sizes.')
+        parser.add_argument('--queries', type=int, default=20, help='Distinct search terms per size.')
+        parser.add_argument('--limit', type=int, default=20, help='Rows fetched per query, like one results page.')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        vocabulary = make_vocabulary(5000)
+        rng = random.Random(1)
+        limit = options['limit']
+
+        self.stdout.write(f"{'books':>10} {'icontains ms':>14} {'index ms':>10} {'speedup':>8}")
+        with scratch_database():
+            seeded = 0
+            for size in sizes:
+                seed_books(size - seeded, start=seeded, vocabulary=vocabulary)
+                seeded = size
+                terms = rng.sample(vocabulary, options['queries'])
+
+                def scan():
+                    for term in terms:
+                        list(Book.objects.filter(title__icontains=term).order_by('title', 'id')[:limit])
+
+                def indexed():
+                    for term in terms:
+                        list(search_books(Book.objects.all(), term).order_by('rank', 'id')[:limit])
+
+                scan_ms = timed(scan, 3) / len(terms)
+                index_ms = timed(indexed, 3) / len(terms)
+                self.stdout.write(f'{size:>10} {scan_ms:>14.2f} {index_ms:>10.2f} {scan_ms / index_ms:>7.1f}x')
@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from library.models import Book, Transaction
+from library.serializers import BookSerializer, FastBookSerializer, FastTransactionSerializer, TransactionSerializer
+
+from ._bench import scratch_database, seed_books, timed
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-row cost of the fast values() serializers against the ModelSerializers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Rows serialized per run, like one large list page.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (median is reported).')
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        with scratch_database():
+            seed_books(rows)
+            user = User.objects.create_user(username='bench', password='bench')
+            now = timezone.now()
+            Transaction.objects.bulk_create(
+                Transaction(user=user, book_id=book_id, date_checked_out=now)
+                for book_id in Book.objects.values_list('id', flat=True)
+            )
+
+            books = Book.objects.order_by('id')[:rows]
+            loans = Transaction.objects.with_overdue().order_by('id')[:rows]
+            cases = [
+                ('BookSerializer', lambda: BookSerializer(books.all(), many=True).data),
+                ('FastBookSerializer', lambda: FastBookSerializer().many(books.values(*FastBookSerializer.lookups()))),
+                # As TransactionViewSet listed before: one query per row for book and user
+                ('TransactionSerializer', lambda: TransactionSerializer(loans.all(), many=True).data),
+                ('TransactionSerializer+joins', lambda: TransactionSerializer(loans.select_related('book', 'user'), many=True).data),
+                ('FastTransactionSerializer', lambda: FastTransactionSerializer().many(loans.values(*FastTransactionSerializer.lookups()))),
+            ]
+
+            self.stdout.write(f"{'serializer':<28} {'ms/run':>9} {'us/row':>8}")
+            for name, run in cases:
+                ms = timed(run, repeat)
+                self.stdout.write(f'{name:<28} {ms:>9.2f} {ms * 1000 / rows:>8.1f}')
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from library.models import Book, FineLedger, ImportChunk, Notification, Transaction
+from library.search import search_books
+
+# Statements that aren't part of the hot path itself
+SKIPPED = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK', 'BEGIN', 'COMMIT')
+
+
+def hot_queries(user_id, book_id):
+    """``(name, run)`` pairs, ``run`` executing the same SQL as the live code path."""
+    now = timezone.now()
+    return [
+        ('catalog page', lambda: list(Book.objects.active().order_by('title', 'id')[:10])),
+        ('catalog search', lambda: list(search_books(Book.objects.active(), 'history').order_by('rank', 'id')[:10])),
+        ('borrow stock update', lambda: Book.objects.active().filter(id=book_id, copies_available__gt=0).update(
+            copies_available=F('copies_available') - 1, updated_at=now,
+        )),
+        ('patron active loans', lambda: list(
+            Transaction.objects.filter(user_id=user_id, date_returned__isnull=True).order_by('-date_checked_out', '-id')[:10]
+        )),
+        ('open loan count', lambda: Transaction.objects.filter(date_returned__isnull=True).count()),
+        ('overdue scan', lambda: list(Transaction.objects.overdue(now).order_by('user_id', 'date_checked_out', 'id')[:100])),
+        ('most borrowed', lambda: list(
+            Transaction.objects.values('book').annotate(count=Count('book')).order_by('-count')[:10]
+        )),
+        ('fine ledger', lambda: list(FineLedger.objects.filter(user_id=user_id))),
+        ('unread notifications', lambda: list(
+            Notification.objects.filter(user_id=user_id, is_read=False).order_by('-created_at', '-id')[:10]
+        )),
+        ('incremental export', lambda: list(Book.objects.filter(updated_at__gte=now).order_by('updated_at', 'id')[:10])),
+        ('import lease', lambda: list(
+            ImportChunk.objects.filter(Q(status=ImportChunk.PENDING) | Q(status=ImportChunk.LEASED, lease_expires__lt=now))
+            .order_by('job_id', 'first_row').values_list('id', flat=True)[:10]
+        )),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Print the EXPLAIN plan of each hot query to check that the indexes are used.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, default=1, help='Patron the per-user queries are run for.')
+        parser.add_argument('--book-id', type=int, default=1, help='Book the borrow update is run for.')
+        parser.add_argument('--sql', action='store_true', help='Also print the SQL of each statement.')
+        parser.add_argument('--only', help='Only explain hot queries whose name contains this text.')
+
+    def handle(self, *args, **options):
+        prefix = connection.ops.explain_query_prefix()
+        for name, run in hot_queries(options['user_id'], options['book_id']):
+            if options['only'] and options['only'] not in name:
+                continue
+            # Writes are rolled back, only their SQL is kept
+            with transaction.atomic(), CaptureQueriesContext(connection) as captured:
+                run()
+                transaction.set_rollback(True)
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for query in captured:
+                sql = query['sql']
+                if sql.upper().startswith(SKIPPED):
+                    continue
+                if options['sql']:
+                    self.stdout.write(f'  {sql}')
+                with connection.cursor() as cursor:
+                    cursor.execute(f'{prefix} {sql}')
+                    for row in cursor.fetchall():
+                        self.stdout.write('    ' + ' '.join(str(column) for column in row))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from library.notices import NOTIFICATION_CHUNK_SIZE, generate_overdue_notifications
+
+
+class Command(BaseCommand):
+    help = 'Store an in-app notification for every newly overdue loan.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=NOTIFICATION_CHUNK_SIZE, help='Notifications inserted per batch.')
+
+    def handle(self, *args, **options):
+        created = generate_overdue_notifications(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{created} notifications created.'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library.importer import ImportFormatError, detect_format
+from library.provisioning import provision_chunk_size, provision_patrons, provision_processes
+
+
+class Command(BaseCommand):
+    help = 'Register the patrons in a CSV or JSON Lines file, hashing passwords across processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File with username, password and optional email per row.')
+        parser.add_argument('--file-format', choices=['csv', 'jsonl'], help='Format when the extension does not tell.')
+        parser.add_argument('--chunk-size', type=int, default=provision_chunk_size(), help='Patrons per transaction.')
+        parser.add_argument('--processes', type=int, default=provision_processes(), help='Processes hashing passwords.')
+
+    def handle(self, *args, **options):
+        try:
+            file_format = detect_format(options['path'], options['file_format'])
+        except ImportFormatError as e:
+            raise CommandError(str(e))
+        with open(options['path'], 'rb') as file:
+            try:
+                report = provision_patrons(
+                    file, file_format, chunk_size=max(options['chunk_size'], 1), processes=max(options['processes'], 1),
+                )
+            except ImportFormatError as e:
+                raise CommandError(f'{e} Patrons of earlier chunks were created.')
+
+        for error in report['errors']:
+            self.stdout.write(self.style.WARNING(f"row {error['row']}: {error['errors']}"))
+        self.stdout.write(f"rows:        {report['rows']}")
+        self.stdout.write(f"created:     {report['created']}")
+        self.stdout.write(f"failed:      {report['failed']}")
+        self.stdout.write(f"throughput:  {report['rows_per_second']} rows/s in {report['seconds']}s")
+        self.stdout.write(self.style.SUCCESS('Patrons provisioned.'))
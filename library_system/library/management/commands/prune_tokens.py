@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from library.blacklist import PRUNE_CHUNK_SIZE, prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = 'Delete expired refresh tokens and their blacklist entries (run daily).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=PRUNE_CHUNK_SIZE, help='Tokens deleted per transaction.')
+
+    def handle(self, *args, **options):
+        deleted = prune_expired_tokens(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{deleted} expired tokens pruned.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from library.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Reset the admin stats counters to the true counts (run periodically, e.g. hourly).'
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters()
+        for name, delta in drift.items():
+            if delta:
+                self.stdout.write(self.style.WARNING(f'{name} was off by {-delta:+d}.'))
+        self.stdout.write(self.style.SUCCESS('Stats counters reconciled.'))
@@ -0,0 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from library.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Process queued book imports, splitting each file into row ranges leased by worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to run.')
+        parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds to wait when there is no work.')
+        parser.add_argument('--exit-when-idle', action='store_true', help='Stop once no queued work is left.')
+
+    def handle(self, *args, **options):
+        kwargs = {'poll_interval': options['poll_interval'], 'exit_when_idle': options['exit_when_idle']}
+        processes = max(options['processes'], 1)
+        if processes == 1:
+            processed = run_worker(**kwargs)
+        else:
+            # Children must open their own database connections
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=processes, initializer=django.setup) as pool:
+                futures = [pool.submit(run_worker, **kwargs) for _ in range(processes)]
+                processed = sum(future.result() for future in futures)
+        self.stdout.write(self.style.SUCCESS(f'{processed} row ranges imported.'))
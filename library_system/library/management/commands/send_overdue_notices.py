@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from library.notices import NOTICE_BATCH_SIZE, send_overdue_notices
+
+
+class Command(BaseCommand):
+    help = 'Email every borrower with overdue loans one digest of their overdue books.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=NOTICE_BATCH_SIZE, help='Emails handed to the mail connection at once.')
+
+    def handle(self, *args, **options):
+        emails_sent, loans_notified = send_overdue_notices(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Sent {emails_sent} overdue notices covering {loans_notified} loans.'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from library.fines import advance_fine_ledger, rebuild_fine_ledger
+
+
+class Command(BaseCommand):
+    help = 'Advance the fine ledger for loans whose overdue state changed (run nightly).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recompute the whole ledger from loan history.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Ledger rows written per transaction.')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            written = rebuild_fine_ledger(chunk_size=options['chunk_size'])
+        else:
+            written = advance_fine_ledger(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{written} fine ledger rows updated.'))
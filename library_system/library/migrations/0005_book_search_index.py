@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from library.search import drop_search_index, install_search_index
+
+
+def create_search_index(apps, schema_editor):
+    install_search_index(schema_editor)
+
+
+def remove_search_index(apps, schema_editor):
+    drop_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_alter_book_copies_available'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchEntry',
+            fields=[
+                ('book', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='library.book')),
+                ('title', models.TextField()),
+                ('author', models.TextField()),
+                ('isbn', models.TextField()),
+            ],
+            options={
+                'db_table': 'library_book_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_search_index, remove_search_index),
+    ]
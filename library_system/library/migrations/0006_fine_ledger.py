@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_book_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FineLedger',
+            fields=[
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='fine_ledger', serialize=False, to='library.transaction')),
+                ('book_title', models.CharField(max_length=255)),
+                ('overdue_days', models.PositiveIntegerField()),
+                ('fine', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('is_final', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fine_ledger', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'is_final'], name='fine_ledger_user_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_import_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
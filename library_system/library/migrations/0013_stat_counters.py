@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:57
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def seed_counters(apps, schema_editor):
+    # Start from the true counts so the stats are right before the first reconcile
+    Book = apps.get_model('library', 'Book')
+    Transaction = apps.get_model('library', 'Transaction')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    StatCounter = apps.get_model('library', 'StatCounter')
+    now = timezone.now()
+    StatCounter.objects.bulk_create([
+        StatCounter(name='total_books', value=Book.objects.count(), reconciled_at=now),
+        StatCounter(name='total_users', value=User.objects.count(), reconciled_at=now),
+        StatCounter(name='total_books_borrowed', value=Transaction.objects.filter(date_returned__isnull=True).count(), reconciled_at=now),
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0012_hot_path_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+                ('reconciled_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
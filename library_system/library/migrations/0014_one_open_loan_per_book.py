@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F
+from django.utils import timezone
+
+
+def close_duplicate_open_loans(apps, schema_editor):
+    # Racing checkouts could leave a patron two open loans of one book, which
+    # the constraint rejects. The oldest stays open; the others are closed as
+    # returned when they were made, their copies go back in stock and their
+    # running fines are dropped.
+    Book = apps.get_model('library', 'Book')
+    FineLedger = apps.get_model('library', 'FineLedger')
+    StatCounter = apps.get_model('library', 'StatCounter')
+    Transaction = apps.get_model('library', 'Transaction')
+    now = timezone.now()
+    duplicated = (
+        Transaction.objects.filter(date_returned__isnull=True)
+        .values('user_id', 'book_id')
+        .annotate(open_loans=Count('id'))
+        .filter(open_loans__gt=1)
+        .order_by()
+    )
+    closed = 0
+    for pair in list(duplicated):
+        extra = list(
+            Transaction.objects.filter(user_id=pair['user_id'], book_id=pair['book_id'], date_returned__isnull=True)
+            .order_by('date_checked_out', 'id')
+            .values_list('id', flat=True)[1:]
+        )
+        Transaction.objects.filter(id__in=extra).update(date_returned=F('date_checked_out'), updated_at=now)
+        FineLedger.objects.filter(transaction_id__in=extra, is_final=False).delete()
+        Book.objects.filter(id=pair['book_id']).update(copies_available=F('copies_available') + len(extra), updated_at=now)
+        closed += len(extra)
+    StatCounter.objects.filter(name='total_books_borrowed').update(value=F('value') - closed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_stat_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_open_loans, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('date_returned__isnull', True)), fields=('user', 'book'), name='transaction_one_open_loan'),
+        ),
+    ]
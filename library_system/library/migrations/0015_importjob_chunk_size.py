@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0014_one_open_loan_per_book'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='chunk_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
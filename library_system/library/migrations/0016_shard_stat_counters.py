@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def seed_counters(apps, schema_editor):
+    # The true counts in shard 0, and the shards the write paths spread over
+    Book = apps.get_model('library', 'Book')
+    Transaction = apps.get_model('library', 'Transaction')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    StatCounter = apps.get_model('library', 'StatCounter')
+    now = timezone.now()
+    counts = {
+        'total_books': Book.objects.count(),
+        'total_users': User.objects.count(),
+        'total_books_borrowed': Transaction.objects.filter(date_returned__isnull=True).count(),
+    }
+    shards = max(getattr(settings, 'LIBRARY_COUNTER_SHARDS', 8), 1)
+    StatCounter.objects.bulk_create([
+        StatCounter(name=name, shard=shard, value=value if shard == 0 else 0, reconciled_at=now)
+        for name, value in counts.items()
+        for shard in range(shards)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0015_importjob_chunk_size'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # The counters are recounted, so the table is recreated rather than
+        # having its primary key changed in place
+        migrations.DeleteModel(
+            name='StatCounter',
+        ),
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('value', models.BigIntegerField(default=0)),
+                ('reconciled_at', models.DateTimeField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'shard'), name='stat_counter_name_shard_uniq')],
+            },
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
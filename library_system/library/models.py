@@ -1,15 +1,40 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 from django.core.exceptions import ValidationError
 
+class BookQuerySet(models.QuerySet):
+
+    def active(self):
+        """Books still in the catalog, i.e. not archived."""
+        return self.filter(archived_at__isnull=True)
+
+
 class Book(models.Model):
     title = models.CharField(max_length=255)
     author = models.CharField(max_length=255)
     isbn = models.CharField(max_length=13, unique=True)
     published_date = models.DateField()
     copies_available = models.PositiveIntegerField()  # Using PositiveIntegerField to avoid negative values
+    archived_at = models.DateTimeField(null=True, blank=True)  # Withdrawn from the catalog, loan history kept
+    updated_at = models.DateTimeField(auto_now=True)  # Also set by every bulk UPDATE, it drives incremental exports
+
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='book_updated_idx'),
+            # Catalog listing and title-ordered search pages skip archived books
+            models.Index(fields=['title', 'id'], name='book_catalog_idx', condition=models.Q(archived_at__isnull=True)),
+            models.Index(fields=['author'], name='book_author_idx'),
+        ]
+        constraints = [
+            # Also enforced by the conditional UPDATEs in library.circulation
+            models.CheckConstraint(condition=models.Q(copies_available__gte=0), name='book_copies_available_gte_0'),
+        ]
 
     def __str__(self):
         return self.title
@@ -29,15 +54,251 @@ class UserProfile(models.Model):
         return self.user.username
 
 
+def loan_period():
+    """How long a book may be kept before it is overdue (``LIBRARY_LOAN_PERIOD_DAYS``)."""
+    return timedelta(days=getattr(settings, 'LIBRARY_LOAN_PERIOD_DAYS', 14))
+
+
+class ElapsedDays(models.Func):
+    """Whole days elapsed between a datetime ``expression`` and ``now``, in SQL."""
+    output_field = models.IntegerField()
+
+    def __init__(self, expression, now):
+        super().__init__(models.Value(now, output_field=models.DateTimeField()), expression)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='CAST(julianday(%(expressions)s) AS INTEGER)', arg_joiner=') - julianday(', **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='EXTRACT(DAY FROM %(expressions)s)::integer', arg_joiner=' - ', **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        clone = self.copy()
+        clone.set_source_expressions(self.get_source_expressions()[::-1])
+        return clone.as_sql(compiler, connection, template='TIMESTAMPDIFF(DAY, %(expressions)s)', **extra_context)
+
+
+class TransactionQuerySet(models.QuerySet):
+    def with_overdue(self, now=None):
+        """
+        Annotate ``is_overdue`` and ``overdue_days`` (whole days past the due
+        date) computed by the database, as of ``now``.
+        """
+        now = now or timezone.now()
+        late = models.Q(date_returned__isnull=True, date_checked_out__lt=now - loan_period())
+        return self.annotate(
+            is_overdue=models.Case(models.When(late, then=True), default=False, output_field=models.BooleanField()),
+            overdue_days=models.Case(
+                models.When(late, then=Greatest(ElapsedDays('date_checked_out', now) - loan_period().days, 0)),
+                default=0,
+                output_field=models.IntegerField(),
+            ),
+        )
+
+    def overdue(self, now=None):
+        """Open loans past their due date, with the ``with_overdue`` annotations."""
+        now = now or timezone.now()
+        return self.with_overdue(now).filter(date_returned__isnull=True, date_checked_out__lt=now - loan_period())
+
+
 class Transaction(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     date_checked_out = models.DateTimeField(auto_now_add=True)
     date_returned = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Also set by every bulk UPDATE, it drives incremental exports
+
+    objects = TransactionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='transaction_updated_idx'),
+            # Serves a patron's own loan list, filtered on active/returned, newest first
+            models.Index(fields=['user', 'date_returned', 'date_checked_out'], name='transaction_user_loans_idx'),
+            # Only open loans: the open-loan count and the overdue scans
+            models.Index(fields=['date_checked_out'], name='transaction_open_loans_idx', condition=models.Q(date_returned__isnull=True)),
+        ]
+        constraints = [
+            # A patron holds at most one copy of a title at a time; the borrow
+            # paths rely on it instead of looking for an open loan first
+            models.UniqueConstraint(fields=['user', 'book'], condition=models.Q(date_returned__isnull=True), name='transaction_one_open_loan'),
+        ]
 
+    # is_overdue and overdue_days come from TransactionQuerySet.with_overdue()
+    # when annotated; the Python fallbacks only cover single loaded instances.
+    @property
     def is_overdue(self):
-        overdue_period = timedelta(days=14)
-        return (timezone.now() - self.date_checked_out) > overdue_period and self.date_returned is None
+        if '_is_overdue' in self.__dict__:
+            return self._is_overdue
+        if self.date_returned is not None or self.date_checked_out is None:
+            return False
+        return timezone.now() - self.date_checked_out > loan_period()
+
+    @is_overdue.setter
+    def is_overdue(self, value):
+        self._is_overdue = value
+
+    @property
+    def overdue_days(self):
+        if '_overdue_days' in self.__dict__:
+            return self._overdue_days
+        if not self.is_overdue:
+            return 0
+        return max((timezone.now() - self.date_checked_out).days - loan_period().days, 0)
+
+    @overdue_days.setter
+    def overdue_days(self, value):
+        self._overdue_days = value
 
     def __str__(self):
         return f"{self.user.username} - {self.book.title}"
+
+
+class BookSearchEntry(models.Model):
+    """
+    Read-only view of the SQLite FTS5 catalog index (see ``library.search``).
+
+    The table is created and kept in sync by ``install_search_index`` and only
+    exists on SQLite; PostgreSQL searches an expression index on ``Book``.
+    """
+    book = models.OneToOneField(Book, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid', related_name='search_entry')
+    title = models.TextField()
+    author = models.TextField()
+    isbn = models.TextField()
+
+    class Meta:
+        managed = False
+        db_table = 'library_book_fts'
+
+
+class FineLedger(models.Model):
+    """
+    Materialized fine of every loan that has been overdue.
+
+    Open loans are advanced by ``library.fines.advance_fine_ledger`` (run
+    nightly by ``manage.py update_fine_ledger``) and fixed for good with
+    ``is_final`` when the book comes back.
+    """
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, primary_key=True, related_name='fine_ledger')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='fine_ledger')
+    book_title = models.CharField(max_length=255)
+    overdue_days = models.PositiveIntegerField()
+    fine = models.DecimalField(max_digits=12, decimal_places=2)
+    is_final = models.BooleanField(default=False)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Covers FineView's per-patron read without touching Transaction
+            models.Index(fields=['user', 'is_final'], name='fine_ledger_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.book_title}: {self.fine}"
+
+
+class Notification(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, null=True, blank=True)
+    message = models.CharField(max_length=255)
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Serves the inbox listing, unread filter and unread count per user
+            models.Index(fields=['user', 'is_read', 'created_at'], name='notification_inbox_idx'),
+            # is_read=False compiles to NOT "is_read", which SQLite only matches against a partial index
+            models.Index(fields=['user', 'created_at'], name='notification_unread_idx', condition=models.Q(is_read=False)),
+        ]
+        constraints = [
+            # The batch job notifies each overdue loan once
+            models.UniqueConstraint(fields=['transaction'], condition=models.Q(transaction__isnull=False), name='notification_once_per_loan'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.message}"
+
+
+class ImportJob(models.Model):
+    QUEUED = 'queued'
+    PLANNING = 'planning'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (PLANNING, 'Planning'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    file = models.FileField(upload_to='imports/%Y/%m/')
+    file_format = models.CharField(max_length=10)
+    fieldnames = models.JSONField(null=True, blank=True)  # CSV header, so chunks can start mid-file
+    rows_per_chunk = models.PositiveIntegerField()
+    chunk_size = models.PositiveIntegerField(null=True, blank=True)  # Rows per transaction, LIBRARY_IMPORT_CHUNK_SIZE if unset
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    rows_imported = models.PositiveIntegerField(default=0)
+    rows_failed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)  # Why the file itself couldn't be read
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='import_job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"Import {self.id} ({self.status})"
+
+
+class ImportChunk(models.Model):
+    """A row range of an ``ImportJob`` that one worker leases at a time."""
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (LEASED, 'Leased'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name='chunks')
+    first_row = models.PositiveIntegerField()
+    last_row = models.PositiveIntegerField()
+    offset = models.PositiveBigIntegerField()  # Byte offset of first_row in the file
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    leased_by = models.CharField(max_length=100, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    rows_imported = models.PositiveIntegerField(default=0)
+    rows_failed = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires'], name='import_chunk_lease_idx'),
+        ]
+
+    def __str__(self):
+        return f"Import {self.job_id} rows {self.first_row}-{self.last_row} ({self.status})"
+
+
+class StatCounter(models.Model):
+    """
+    One shard of a running total behind the admin stats, e.g. ``total_books``.
+
+    A total is the sum of its shards. The write paths adjust a random shard
+    in their own transaction and ``library.counters.reconcile_counters``
+    resets the shards to the true count.
+    """
+    name = models.CharField(max_length=50)
+    shard = models.PositiveSmallIntegerField(default=0)
+    value = models.BigIntegerField(default=0)
+    reconciled_at = models.DateTimeField()  # Last time the value was checked against a true count
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'shard'], name='stat_counter_name_shard_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.name}[{self.shard}]: {self.value}"
@@ -0,0 +1,117 @@
+"""
+Overdue notices.
+
+Overdue loans are streamed from one query ordered by borrower, folded into
+one digest email per borrower and sent in batches over a single reused
+mail connection. The same loans are also stored as in-app ``Notification``
+rows by a batch job, so the notifications API never recomputes them.
+"""
+from functools import partial
+from itertools import groupby
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .batching import chunked, keyset_batches
+from .events import publish_notifications
+from .models import Notification, Transaction
+
+NOTICE_BATCH_SIZE = 500
+# Loans listed in the check_overdue response; the rest are only counted
+MAX_REPORTED_LOANS = 100
+NOTIFICATION_CHUNK_SIZE = 1000
+
+
+def overdue_digests(queryset=None, now=None, chunk_size=2000):
+    """
+    Yield ``(user, loans)`` for every borrower with overdue loans.
+
+    Rows come from a server-side iterator, so only one borrower's loans are
+    held in memory at a time.
+    """
+    queryset = Transaction.objects.all() if queryset is None else queryset
+    loans = (
+        queryset.overdue(now)
+        .select_related('user', 'book')
+        .only('date_checked_out', 'date_returned', 'user__username', 'user__email', 'book__title')
+        .order_by('user_id', 'date_checked_out', 'id')
+        .iterator(chunk_size=chunk_size)
+    )
+    for _, user_loans in groupby(loans, key=lambda loan: loan.user_id):
+        user_loans = list(user_loans)
+        yield user_loans[0].user, user_loans
+
+
+def overdue_digest_message(user, loans, connection=None):
+    if len(loans) == 1:
+        subject = f'Overdue Book: {loans[0].book.title}'
+    else:
+        subject = f'Overdue Books: {len(loans)} titles'
+    lines = [f'Dear {user.username},', '', 'The following books you borrowed are overdue:', '']
+    lines += [f'  - {loan.book.title} ({loan.overdue_days} days overdue)' for loan in loans]
+    lines += ['', 'Please return them to the library as soon as possible.']
+    return EmailMessage(subject, '\n'.join(lines), to=[user.email], connection=connection)
+
+
+def send_overdue_notices(queryset=None, now=None, batch_size=NOTICE_BATCH_SIZE, on_sent=None):
+    """
+    Email every borrower with overdue loans one digest and return
+    ``(emails_sent, loans_notified)``.
+
+    Messages go out ``batch_size`` at a time through one connection from
+    ``get_connection()``. Borrowers without an email address are skipped.
+    ``on_sent(user, loans)`` is called for each digest that was sent.
+    """
+    now = now or timezone.now()
+    emails_sent = loans_notified = 0
+    digests = (
+        (user, loans) for user, loans in overdue_digests(queryset, now)
+        if user.email
+    )
+    with get_connection() as connection:
+        for batch in chunked(digests, batch_size):
+            emails_sent += connection.send_messages([
+                overdue_digest_message(user, loans, connection) for user, loans in batch
+            ]) or 0
+            for user, loans in batch:
+                loans_notified += len(loans)
+                if on_sent:
+                    on_sent(user, loans)
+    return emails_sent, loans_notified
+
+
+def generate_overdue_notifications(now=None, chunk_size=NOTIFICATION_CHUNK_SIZE):
+    """
+    Store one ``Notification`` for every overdue loan that doesn't have one yet
+    and return how many were created.
+    """
+    pending = (
+        Transaction.objects.overdue(now)
+        .filter(notification__isnull=True)
+        .values_list('id', 'user_id', 'book__title')
+    )
+    created = 0
+    for chunk in keyset_batches(pending, chunk_size, 'id'):
+        while chunk:
+            try:
+                with transaction.atomic():
+                    Notification.objects.bulk_create([
+                        Notification(user_id=user_id, transaction_id=transaction_id, message=f"Book '{title}' is overdue.")
+                        for transaction_id, user_id, title in chunk
+                    ])
+            except IntegrityError:
+                # Another run notified some of these loans since they were read
+                notified = set(
+                    Notification.objects.filter(transaction_id__in=[transaction_id for transaction_id, _, _ in chunk])
+                    .values_list('transaction_id', flat=True)
+                )
+                if not notified:
+                    raise
+                chunk = [row for row in chunk if row[0] not in notified]
+            else:
+                # Push to open notification streams once the rows are visible
+                transaction.on_commit(partial(publish_notifications, [user_id for _, user_id, _ in chunk]))
+                created += len(chunk)
+                break
+    return created
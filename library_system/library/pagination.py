@@ -0,0 +1,137 @@
+"""
+Keyset (seek) pagination.
+
+Pages are addressed by the sort key of the last row seen instead of an
+OFFSET, so fetching page N costs the same as fetching page 1.
+"""
+import base64
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    ``DjangoJSONEncoder`` keeping datetimes to the microsecond: it cuts them
+    to milliseconds, and seeking from a rounded-down key skips the rows
+    between it and the true one.
+    """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate on the queryset's own ``order_by()`` fields.
+
+    The ordering must be non-null and end in a unique field (usually ``id``)
+    so that every row has a distinct position. Unordered querysets fall back
+    to ``ordering``.
+    """
+    ordering = ('id',)
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not queryset.ordered:
+            queryset = queryset.order_by(*self.ordering)
+        self.keys = [(field.lstrip('-'), field.startswith('-')) for field in queryset.query.order_by]
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.seek_filter(position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.next_position = self.get_position(results[-1]) if self.has_next else None
+        return results
+
+    def seek_filter(self, position):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y), honouring per-field direction
+        condition = Q()
+        for index, (field, descending) in enumerate(self.keys):
+            lookup = 'lt' if descending else 'gt'
+            branch = Q(**{f'{field}__{lookup}': position[index]})
+            for earlier, (previous, _) in enumerate(self.keys[:index]):
+                branch &= Q(**{previous: position[earlier]})
+            condition |= branch
+        return condition
+
+    def get_position(self, item):
+        if isinstance(item, dict):
+            return [item[field] for field, _ in self.keys]
+        return [getattr(item, field) for field, _ in self.keys]
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(request.query_params[self.page_size_query_param], strict=True, cutoff=self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.keys):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, position):
+        encoded = base64.urlsafe_b64encode(json.dumps(position, cls=CursorEncoder).encode('utf-8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class BookKeysetPagination(KeysetPagination):
+    ordering = ('title', 'id')
+
+
+class NotificationKeysetPagination(KeysetPagination):
+    ordering = ('-created_at', '-id')
+
+
+class TransactionKeysetPagination(KeysetPagination):
+    ordering = ('-date_checked_out', '-id')
@@ -0,0 +1,95 @@
+"""
+Password checks for the login view, off the request thread.
+
+A password hash is tens to hundreds of milliseconds of CPU. Hashed inline,
+a burst of logins starves every other request, and under ASGI it blocks
+the single thread all sync views share. ``averify_credentials`` fetches
+the user and awaits the hash on ``hashing_pool()``, a bounded per-process
+thread pool (hashlib and argon2-cffi release the GIL), so at most
+``LIBRARY_PASSWORD_HASH_WORKERS`` cores hash at once.
+
+The pooled check stands in for ``ModelBackend``. With any other
+``AUTHENTICATION_BACKENDS`` configured, ``averify_credentials`` goes
+through Django's ``aauthenticate`` so every backend is asked, at the cost
+of hashing on the sync thread as ``authenticate()`` does.
+
+New hashes use the first of ``PASSWORD_HASHERS``: ``TunedArgon2PasswordHasher``
+when argon2-cffi is installed. A hash made by another hasher, or with other
+costs, is replaced on the user's next successful login.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aauthenticate, user_login_failed
+from django.contrib.auth.hashers import Argon2PasswordHasher, check_password, get_hasher, identify_hasher, make_password
+from django.contrib.auth.models import User
+
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    """Argon2id with the ``LIBRARY_ARGON2_*`` costs instead of Django's."""
+
+    @property
+    def time_cost(self):
+        return getattr(settings, 'LIBRARY_ARGON2_TIME_COST', 2)
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'LIBRARY_ARGON2_MEMORY_COST', 19456)
+
+    @property
+    def parallelism(self):
+        return getattr(settings, 'LIBRARY_ARGON2_PARALLELISM', 1)
+
+
+def hash_workers():
+    """Threads hashing passwords per process (``LIBRARY_PASSWORD_HASH_WORKERS``), one per CPU by default."""
+    return getattr(settings, 'LIBRARY_PASSWORD_HASH_WORKERS', None) or os.cpu_count() or 1
+
+
+def hashing_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=hash_workers(), thread_name_prefix='password-hash')
+    return _pool
+
+
+def _outdated(encoded):
+    preferred = get_hasher('default')
+    hasher = identify_hasher(encoded)
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+async def averify_credentials(username, password, request=None):
+    """
+    The active user with ``username`` and ``password``, or ``None``.
+
+    The queries run through ``sync_to_async`` and the hashing on the pool,
+    so awaiting it holds no thread.
+    """
+    if list(settings.AUTHENTICATION_BACKENDS) != [MODEL_BACKEND]:
+        return await aauthenticate(request, username=username, password=password)
+    user = await sync_to_async(User._default_manager.filter(**{User.USERNAME_FIELD: username}).first)()
+    loop = asyncio.get_running_loop()
+    if user is None or not user.has_usable_password():
+        # Hash anyway, so the response time doesn't tell which usernames exist
+        await loop.run_in_executor(hashing_pool(), make_password, password)
+        valid = False
+    else:
+        valid = await loop.run_in_executor(hashing_pool(), check_password, password, user.password)
+    if not valid or not user.is_active:
+        await user_login_failed.asend(sender=__name__, credentials={'username': username}, request=request)
+        return None
+    if _outdated(user.password):
+        user.password = await loop.run_in_executor(hashing_pool(), make_password, password)
+        await sync_to_async(user.save)(update_fields=['password'])
+    return user
@@ -0,0 +1,171 @@
+"""
+Bulk provisioning of patrons from CSV or JSON Lines.
+
+Registering a term's patrons one ``POST /api/register/`` at a time hashes
+every password on the request thread and writes each ``User`` and
+``UserProfile`` separately. ``provision_patrons`` reads the file with the
+book importer's ``iter_records``, hashes each chunk's passwords across a
+process pool and inserts the chunk's users and their profiles with one
+``bulk_create`` each, in one transaction per chunk.
+
+Rows need a ``username`` and a ``password``; ``email`` is optional. A
+username that is already taken, or repeated in the file, is reported as a
+row error and never touches the existing account, including when it is
+registered by someone else while the file is being processed.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from .batching import chunked
+from .counters import adjust_counters
+from .importer import MAX_REPORTED_ERRORS, iter_records
+from .models import UserProfile
+
+TAKEN = {'username': 'A user with that username already exists.'}
+
+
+def provision_chunk_size():
+    """Patrons hashed and inserted per transaction (``LIBRARY_PROVISION_CHUNK_SIZE``)."""
+    return getattr(settings, 'LIBRARY_PROVISION_CHUNK_SIZE', 1000)
+
+
+def provision_processes():
+    """Processes hashing passwords for ``provision_patrons`` (``LIBRARY_PROVISION_PROCESSES``), 1 to hash in this process."""
+    return getattr(settings, 'LIBRARY_PROVISION_PROCESSES', 4)
+
+
+def validate_patron(record):
+    """Return ``(user, password, None)`` for a valid record or ``(None, None, errors)``."""
+    if not isinstance(record, dict):
+        return None, None, {'row': 'Not a valid record.'}
+
+    errors = {}
+    username = str(record.get('username') or '').strip()
+    limit = User._meta.get_field('username').max_length
+    if not username:
+        errors['username'] = 'This field is required.'
+    elif len(username) > limit:
+        errors['username'] = f'Ensure this field has no more than {limit} characters.'
+    else:
+        try:
+            User.username_validator(username)
+        except ValidationError as e:
+            errors['username'] = e.messages[0]
+
+    email = str(record.get('email') or '').strip()
+    if email:
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors['email'] = 'Enter a valid email address.'
+
+    password = str(record.get('password') or '')
+    if not password:
+        errors['password'] = 'This field is required.'
+
+    if errors:
+        return None, None, errors
+    return User(username=username, email=email), password, None
+
+
+def _taken(valid):
+    return set(User.objects.filter(username__in=[user.username for _, user, _ in valid]).values_list('username', flat=True))
+
+
+def _insert(users):
+    """Insert ``users`` and their profiles in one transaction."""
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        if users[0].pk is None:
+            # Backends that can't return ids from a bulk insert
+            ids = dict(User.objects.filter(username__in=[user.username for user in users]).values_list('username', 'id'))
+            for user in users:
+                user.pk = ids[user.username]
+        UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+        adjust_counters(total_users=len(users))
+
+
+def provision_records(records, chunk_size=None, processes=None):
+    """Create the patrons of ``(row_number, record)`` pairs and return the report counts."""
+    chunk_size = chunk_size or provision_chunk_size()
+    processes = processes or provision_processes()
+    report = {'rows': 0, 'created': 0, 'failed': 0, 'errors': []}
+    seen = set()
+
+    def fail(number, errors):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': number, 'errors': errors})
+
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=django.setup) if processes > 1 else None
+    try:
+        for chunk in chunked(records, chunk_size):
+            report['rows'] += len(chunk)
+            valid, failed = [], []
+            for number, record in chunk:
+                user, password, errors = validate_patron(record)
+                if errors:
+                    failed.append((number, errors))
+                elif user.username in seen:
+                    failed.append((number, {'username': 'Repeated in this file.'}))
+                else:
+                    seen.add(user.username)
+                    valid.append((number, user, password))
+
+            taken = _taken(valid)
+            failed.extend((number, TAKEN) for number, user, _ in valid if user.username in taken)
+            for number, errors in sorted(failed, key=lambda item: item[0]):
+                fail(number, errors)
+            valid = [item for item in valid if item[1].username not in taken]
+            if not valid:
+                continue
+
+            passwords = [password for _, _, password in valid]
+            hashes = pool.map(make_password, passwords, chunksize=max(len(passwords) // processes, 1)) if pool else map(make_password, passwords)
+            for (_, user, _), encoded in zip(valid, hashes):
+                user.password = encoded
+
+            while valid:
+                try:
+                    _insert([user for _, user, _ in valid])
+                except IntegrityError:
+                    # Someone registered one of the usernames since the check
+                    taken = _taken(valid)
+                    if not taken:
+                        raise
+                    for number, user, _ in valid:
+                        if user.username in taken:
+                            fail(number, TAKEN)
+                    valid = [item for item in valid if item[1].username not in taken]
+                else:
+                    report['created'] += len(valid)
+                    break
+    finally:
+        if pool:
+            pool.shutdown()
+    return report
+
+
+def provision_patrons(file, file_format, chunk_size=None, processes=None):
+    """
+    Create the patrons in ``file`` and return a report.
+
+    The report has row counts, throughput and up to ``MAX_REPORTED_ERRORS``
+    row-level errors.
+    """
+    started = time.perf_counter()
+    report = provision_records(iter_records(file, file_format), chunk_size, processes)
+
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows'] / elapsed) if elapsed else report['rows']
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    return report
@@ -0,0 +1,54 @@
+"""
+In-process publish/subscribe for pushing events to held connections.
+
+Subscribers are asyncio queues living on the ASGI event loop; publishers may
+be sync code on any thread. The broker class is looked up from the
+``LIBRARY_NOTIFICATION_BROKER`` setting so that a cross-process
+implementation with the same ``subscribe``/``unsubscribe``/``publish``
+methods can replace this one.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, channel):
+        """Return a queue that receives every message published to ``channel``."""
+        queue = asyncio.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers[channel].add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channel, message=None):
+        """Deliver ``message`` to the subscribers of ``channel``, from any thread."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, message)
+
+
+def _offer(queue, message):
+    # A subscriber that fell behind only needs to know something changed
+    if not queue.full():
+        queue.put_nowait(message)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(getattr(settings, 'LIBRARY_NOTIFICATION_BROKER', 'library.pubsub.InProcessBroker'))()
@@ -0,0 +1,122 @@
+"""
+Per-endpoint query budgets.
+
+Views declare how many SQL queries a request may run with a
+``query_budget`` attribute: an int, or a dict keyed by viewset action
+(``'list'``, ``'retrieve'``, ...) or, on plain views, by HTTP method
+(``'get'``, ``'post'``, ...). ``QueryBudgetMiddleware`` counts the queries
+each request runs and reports requests over budget, which usually means
+a per-row query crept into a list. With ``LIBRARY_QUERY_BUDGET_STRICT``
+(set in tests) it raises instead, so the regression fails the test.
+
+Views whose work comes in bounded chunks declare the budget of their fixed
+part and raise it per chunk with ``add_query_budget`` once they know how
+many chunks a request took.
+"""
+import logging
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Transaction control isn't work done for the request
+IGNORED_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK', 'BEGIN', 'COMMIT')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(IGNORED_STATEMENTS):
+            self.count += 1
+            self.statements.append(sql)
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries run on every database connection of this thread inside the block."""
+    counter = QueryCounter()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        yield counter
+
+
+def view_query_budget(view_func, method):
+    """The budget ``view_func`` declares for ``method`` requests, or ``None``."""
+    view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+    budget = getattr(view_class, 'query_budget', None)
+    if not isinstance(budget, dict):
+        return budget
+    # Viewsets map methods to actions; plain views are keyed by method
+    actions = getattr(view_func, 'actions', None) or {}
+    return budget.get(actions.get(method, method))
+
+
+def add_query_budget(request, queries):
+    """Raise the budget of ``request`` (a Django or DRF request) by ``queries``."""
+    request = getattr(request, '_request', request)
+    if getattr(request, 'query_budget', None) is not None:
+        request.query_budget += queries
+
+
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            # Async views query from worker threads this wrapper can't see
+            return self.get_response(request)
+        with count_queries() as counter:
+            response = self.get_response(request)
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and counter.count > budget:
+            self.over_budget(request, counter, budget)
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(counter.count)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = view_query_budget(view_func, request.method.lower())
+
+    def over_budget(self, request, counter, budget):
+        message = f'{request.method} {request.path} ran {counter.count} queries, over its budget of {budget}.'
+        if getattr(settings, 'LIBRARY_QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message + '\n' + '\n'.join(counter.statements))
+        logger.warning(message)
+
+
+class QueryBudgetTestMixin:
+    """
+    ``TestCase`` mixin for catching per-row queries.
+
+    ``assertNoPerRowQueries`` runs a request, adds rows, runs it again and
+    fails if the second run needed more queries.
+    """
+
+    def assertNoPerRowQueries(self, request, add_rows, rows=5):
+        with count_queries() as before:
+            request()
+        add_rows(rows)
+        with count_queries() as after:
+            request()
+        self.assertEqual(
+            after.count, before.count,
+            f'{after.count - before.count} more queries after adding {rows} rows:\n' + '\n'.join(after.statements),
+        )
@@ -0,0 +1,130 @@
+"""
+Full-text search over the book catalog.
+
+SQLite uses an external-content FTS5 table kept in sync with ``library_book``
+by triggers, PostgreSQL uses a GIN index over a ``tsvector`` expression.
+Both cover title, author and ISBN and return results ranked by relevance.
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'library_book_fts'
+
+# Must stay identical to the indexed expression or PostgreSQL won't use the index
+PG_DOCUMENT = "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(author, '') || ' ' || isbn)"
+PG_INDEX = 'library_book_search_gin'
+
+SQLITE_TRIGGERS = {
+    f'{FTS_TABLE}_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON library_book BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, title, author, isbn) VALUES (new.id, new.title, new.author, new.isbn);
+        END""",
+    f'{FTS_TABLE}_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON library_book BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, isbn) VALUES ('delete', old.id, old.title, old.author, old.isbn);
+        END""",
+    f'{FTS_TABLE}_au': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, author, isbn ON library_book BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, author, isbn) VALUES ('delete', old.id, old.title, old.author, old.isbn);
+            INSERT INTO {FTS_TABLE}(rowid, title, author, isbn) VALUES (new.id, new.title, new.author, new.isbn);
+        END""",
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def install_search_index(schema_editor=None):
+    """
+    Create the search index for the current database if it is missing.
+
+    Safe to run repeatedly. On SQLite, table rebuilds done by later migrations
+    drop the sync triggers, so they are re-created here and the index is
+    rebuilt from ``library_book`` whenever any of them had to be restored.
+    """
+    conn = schema_editor.connection if schema_editor else connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                f"title, author, isbn, content='library_book', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'library_book'")
+            existing = {row[0] for row in cursor.fetchall()}
+            missing = [name for name in SQLITE_TRIGGERS if name not in existing]
+            for name in missing:
+                cursor.execute(SQLITE_TRIGGERS[name])
+            if missing:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        elif conn.vendor == 'postgresql':
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {PG_INDEX} ON library_book USING GIN (({PG_DOCUMENT}))")
+
+
+def drop_search_index(schema_editor=None):
+    conn = schema_editor.connection if schema_editor else connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            for name in SQLITE_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+        elif conn.vendor == 'postgresql':
+            cursor.execute(f"DROP INDEX IF EXISTS {PG_INDEX}")
+
+
+def _tokens(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+def _fts5_query(tokens):
+    # Quote every token so words like AND/NEAR aren't parsed as FTS5 syntax;
+    # the last one is a prefix match so results show up while typing.
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _tsquery(tokens):
+    terms = list(tokens)
+    terms[-1] += ':*'
+    return ' & '.join(terms)
+
+
+def search_books(queryset, query):
+    """
+    Restrict ``queryset`` to books matching ``query`` and annotate ``rank``.
+
+    Lower rank is a better match, so callers should ``order_by('rank')``.
+    Queries with no searchable tokens match nothing.
+    """
+    tokens = _tokens(query)
+    if not tokens:
+        return queryset.none().annotate(rank=Value(0.0))
+
+    if connection.vendor == 'sqlite':
+        # Join through BookSearchEntry so bm25() is evaluated once per match
+        # inside the same FTS5 scan instead of in a correlated subquery.
+        match = _fts5_query(tokens)
+        return queryset.filter(
+            RawSQL(f"{FTS_TABLE} MATCH %s", [match], output_field=BooleanField()),
+            search_entry__isnull=False,
+        ).annotate(rank=RawSQL(f"bm25({FTS_TABLE}, 10.0, 5.0, 1.0)", [], output_field=FloatField()))
+
+    if connection.vendor == 'postgresql':
+        tsquery = _tsquery(tokens)
+        return queryset.filter(RawSQL(
+            f"{PG_DOCUMENT} @@ to_tsquery('simple', %s)",
+            [tsquery],
+            output_field=BooleanField(),
+        )).annotate(rank=RawSQL(
+            f"-ts_rank_cd({PG_DOCUMENT}, to_tsquery('simple', %s))",
+            [tsquery],
+            output_field=FloatField(),
+        ))
+
+    # No index available on this backend, fall back to a scan
+    for token in tokens:
+        queryset = queryset.filter(Q(title__icontains=token) | Q(author__icontains=token) | Q(isbn__startswith=token))
+    return queryset.annotate(rank=Value(0.0))
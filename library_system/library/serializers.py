@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Book, Transaction, UserProfile
+from django.utils import timezone
+from .models import Book, Notification, Transaction, UserProfile, loan_period
 from django.contrib.auth import authenticate
 
 
@@ -15,18 +16,110 @@ class TransactionSerializer(serializers.ModelSerializer):
     book = BookSerializer(read_only=True)  # Show book details when viewing transactions
     book_id = serializers.PrimaryKeyRelatedField(queryset=Book.objects.all(), write_only=True, source='book')
     user = serializers.StringRelatedField(read_only=True)  # Show username for the transaction
-    is_overdue = serializers.SerializerMethodField()  # Adds 'is_overdue' field to transactions
+    is_overdue = serializers.BooleanField(read_only=True)  # Annotated by Transaction.objects.with_overdue()
 
     class Meta:
         model = Transaction
         fields = ['id', 'book', 'book_id', 'user', 'date_checked_out', 'date_returned', 'is_overdue']
-
-    def get_is_overdue(self, obj):
-        """
-        Custom method to check if the book is overdue.
-        """
-        return obj.is_overdue()
     
+
+# Read-only fast path for list endpoints. Rows come from QuerySet.values()
+# and are turned into the same output as the ModelSerializers above without
+# building model instances or DRF field objects per row.
+class ValuesSerializer:
+    """
+    Serialize ``values()`` dicts.
+
+    ``fields`` is a list of ``(key, lookup)`` pairs, where ``lookup`` is a
+    ``values()`` lookup or a nested ``ValuesSerializer`` class whose lookups
+    are prefixed with ``key + '__'``. ``converters`` maps lookups to a
+    function applied to non-null values.
+    """
+    fields = []
+    converters = {}
+
+    def __init__(self, now=None):
+        self.now = now or timezone.now()
+        self.plan = self.compile()
+
+    @classmethod
+    def compile(cls, prefix=''):
+        """Return ``(key, lookup, converter, nested plan)`` steps, resolved once per serializer."""
+        plan = []
+        for key, lookup in cls.fields:
+            if isinstance(lookup, type) and issubclass(lookup, ValuesSerializer):
+                plan.append((key, None, None, lookup.compile(f'{prefix}{key}__')))
+            else:
+                plan.append((key, prefix + lookup, cls.converters.get(lookup), None))
+        return plan
+
+    @classmethod
+    def lookups(cls, prefix=''):
+        """The ``values()`` lookups needed to serialize a row."""
+        return [lookup for _, lookup, _, nested in cls._flatten(cls.compile(prefix))]
+
+    @staticmethod
+    def _flatten(plan):
+        for step in plan:
+            if step[3] is None:
+                yield step
+            else:
+                yield from ValuesSerializer._flatten(step[3])
+
+    def to_representation(self, row, plan=None):
+        data = {}
+        for key, lookup, converter, nested in self.plan if plan is None else plan:
+            if nested is not None:
+                data[key] = self.to_representation(row, nested)
+                continue
+            value = row[lookup]
+            data[key] = converter(value) if converter is not None and value is not None else value
+        return data
+
+    def many(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+
+_date = serializers.DateField().to_representation
+_datetime = serializers.DateTimeField().to_representation
+
+
+class FastBookSerializer(ValuesSerializer):
+    fields = [(field, field) for field in BookSerializer.Meta.fields]
+    converters = {'published_date': _date}
+
+
+class FastTransactionSerializer(ValuesSerializer):
+    """Same output as ``TransactionSerializer``, with ``is_overdue`` tested against one cutoff."""
+    fields = [
+        ('id', 'id'),
+        ('book', FastBookSerializer),
+        ('user', 'user__username'),
+        ('date_checked_out', 'date_checked_out'),
+        ('date_returned', 'date_returned'),
+    ]
+    converters = {'date_checked_out': _datetime, 'date_returned': _datetime}
+
+    def __init__(self, now=None):
+        super().__init__(now)
+        # Overdue means checked out before this instant and still open
+        self.overdue_cutoff = self.now - loan_period()
+
+    def to_representation(self, row, plan=None):
+        data = super().to_representation(row, plan)
+        if plan is None:
+            data['is_overdue'] = row['date_returned'] is None and row['date_checked_out'] < self.overdue_cutoff
+        return data
+
+
+class NotificationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Notification
+        fields = ['id', 'message', 'is_read', 'created_at']
+        read_only_fields = fields
+
+
 class UserProfileSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField()
 
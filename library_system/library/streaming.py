@@ -0,0 +1,90 @@
+"""
+Streaming responses for large result sets.
+
+Rows are pulled from a server-side iterator and encoded one at a time, so
+memory use stays flat no matter how many rows the query returns.
+"""
+import csv
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from .batching import chunked
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def export_watermark_lag():
+    """
+    How far an export's watermark trails its start (``LIBRARY_EXPORT_WATERMARK_LAG_SECONDS``).
+
+    ``updated_at`` is stamped before the writing transaction commits, so a
+    row may become visible with a stamp older than an export that missed it.
+    The lag must exceed the longest write transaction.
+    """
+    return timedelta(seconds=getattr(settings, 'LIBRARY_EXPORT_WATERMARK_LAG_SECONDS', 300))
+
+
+def iter_rows(queryset, fields, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield ``queryset`` rows as dicts of ``fields`` without caching them."""
+    return queryset.values(*fields).iterator(chunk_size=chunk_size)
+
+
+def iter_tuples(queryset, fields, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield ``queryset`` rows as tuples of ``fields`` without caching them."""
+    return queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def _attach(response, filename):
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def ndjson_response(rows, filename=None):
+    """Stream ``rows`` (an iterable of dicts) as newline-delimited JSON."""
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    response = StreamingHttpResponse(
+        (encoder.encode(row) + '\n' for row in rows),
+        content_type='application/x-ndjson',
+    )
+    return _attach(response, filename)
+
+
+class _Echo:
+    """File-like object whose ``write`` returns the line instead of buffering it."""
+
+    def write(self, value):
+        return value
+
+
+def csv_response(fields, rows, filename=None):
+    """Stream ``rows`` (an iterable of tuples) as CSV with a ``fields`` header."""
+    writer = csv.writer(_Echo())
+
+    def lines():
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+    return _attach(StreamingHttpResponse(lines(), content_type='text/csv'), filename)
+
+
+def columnar_response(fields, rows, batch_size=STREAM_CHUNK_SIZE, filename=None):
+    """
+    Stream ``rows`` (an iterable of tuples) as column-oriented record batches.
+
+    Each line is one JSON object holding up to ``batch_size`` rows as
+    ``{"rows": n, "columns": {field: [values...]}}``, the layout columnar
+    stores and dataframes load without pivoting every record.
+    """
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+    def batches():
+        for batch in chunked(rows, batch_size):
+            columns = dict(zip(fields, (list(column) for column in zip(*batch))))
+            yield encoder.encode({'rows': len(batch), 'columns': columns}) + '\n'
+
+    return _attach(StreamingHttpResponse(batches(), content_type='application/x-ndjson'), filename)
@@ -1,12 +1,56 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from unittest import mock
+from decimal import Decimal
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import get_hasher, identify_hasher, make_password
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from asgiref.sync import sync_to_async
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Book, Transaction
+from rest_framework.throttling import AnonRateThrottle
+from . import authentication
+from .authentication import ClaimsJWTAuthentication, user_refresh_token
+from .blacklist import BlacklistRefreshToken, TokenBlacklist
+from .counters import adjust_counters, counter_shards, read_counters, reconcile_counters
+from .circulation import MAX_BULK_ITEMS, AlreadyBorrowed, AlreadyReturned, NoCopiesAvailable, borrow_book, borrow_books, return_loan
+from .jobs import lease_chunk, plan_next_job, process_chunk, run_worker
+from .deletion import delete_books
+from .importer import import_books
+from .fines import advance_fine_ledger, fines_by_user, rebuild_fine_ledger, user_fines
+from .models import Book, FineLedger, ImportChunk, ImportJob, Notification, StatCounter, Transaction, UserProfile
+from .pubsub import InProcessBroker
+from .querybudget import QueryBudgetExceeded, QueryBudgetTestMixin
+from .urls import router
+from .search import search_books
+from .serializers import BookSerializer, FastBookSerializer, FastTransactionSerializer, TransactionSerializer
+from .notices import generate_overdue_notifications, send_overdue_notices
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from django.core import mail
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 
 
 class LibraryTestCase(TestCase):
@@ -78,7 +122,7 @@ class LibraryTestCase(TestCase):
         self.assertEqual(overdue_response.status_code, status.HTTP_200_OK)
 
         # Check that the transaction is overdue
-        self.assertTrue(overdue_response.data[0]['is_overdue'])
+        self.assertTrue(overdue_response.data['loans'][0]['is_overdue'])
 
         # Check that an email has been sent
         self.assertEqual(len(mail.outbox), 1)
@@ -90,6 +134,17 @@ class LibraryTestCase(TestCase):
         self.assertIn(self.book.title, email.body)
         self.assertEqual(email.to, [self.user.email])
 
+    def test_book_detail_url_updates_and_deletes(self):
+        url = f'/api/books/{self.book.id}/'
+        data = {'title': 'Renamed', 'author': 'Test Author', 'isbn': '1234567890123', 'published_date': '2023-01-01', 'copies_available': 2}
+        self.assertEqual(self.admin_client.put(url, data).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.admin_client.patch(url, {'copies_available': 3}).status_code, status.HTTP_200_OK)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.title, self.book.copies_available), ('Renamed', 3))
+        self.assertEqual(self.admin_client.get('/api/books/search/', {'q': 'Renamed'}).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.admin_client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Book.objects.filter(id=self.book.id).exists())
+
     def test_prevent_multiple_checkout_of_same_book(self):
         # Test that a user cannot check out the same book twice without returning it
         response = self.client.post('/api/transactions/', {'user': self.user.id, 'book': self.book.id})
@@ -99,3 +154,1570 @@ class LibraryTestCase(TestCase):
         duplicate_checkout_response = self.client.post('/api/transactions/', {'user': self.user.id, 'book': self.book.id})
         self.assertEqual(duplicate_checkout_response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(duplicate_checkout_response.data['detail'], 'You have already checked out this book.')
+
+
+class BookSearchTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', isbn='9780441013593', published_date='1965-08-01', copies_available=3)
+        self.messiah = Book.objects.create(title='Dune Messiah', author='Frank Herbert', isbn='9780593098233', published_date='1969-10-15', copies_available=1)
+        self.other = Book.objects.create(title='Children of Dune Fans', author='Dune Society', isbn='9780000000001', published_date='2001-01-01', copies_available=1)
+
+    def search(self, **params):
+        response = self.client.get('/api/books/search/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book['id'] for book in response.data['results']]
+
+    def test_search_matches_title_author_and_isbn(self):
+        self.assertEqual(set(self.search(q='herbert')), {self.dune.id, self.messiah.id})
+        self.assertEqual(self.search(q='9780593098233'), [self.messiah.id])
+        self.assertEqual(self.search(q='messiah frank'), [self.messiah.id])
+
+    def test_search_matches_prefix_of_last_word(self):
+        self.assertEqual(self.search(q='dune mess'), [self.messiah.id])
+
+    def test_search_ranks_title_matches_first(self):
+        results = self.search(q='dune')
+        self.assertEqual(set(results), {self.dune.id, self.messiah.id, self.other.id})
+        self.assertEqual(results[0], self.dune.id)
+
+    def test_search_ignores_query_syntax(self):
+        self.assertEqual(self.search(q='"dune" AND OR *'), [])
+        self.assertEqual(self.search(q='***'), [])
+
+    def test_search_index_follows_save_and_delete(self):
+        self.dune.title = 'Arrakis'
+        self.dune.save()
+        self.assertEqual(self.search(q='arrakis'), [self.dune.id])
+        self.assertNotIn(self.dune.id, self.search(q='dune'))
+
+        self.messiah.delete()
+        self.assertEqual(self.search(q='herbert'), [self.dune.id])
+
+    def test_search_pages_with_keyset_cursor(self):
+        seen = []
+        response = self.client.get('/api/books/search/', {'page_size': 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(book['title'] for book in response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, ['Children of Dune Fans', 'Dune', 'Dune Messiah'])
+
+    def test_ranked_search_pages_with_keyset_cursor(self):
+        ids = []
+        response = self.client.get('/api/books/search/', {'q': 'dune', 'page_size': 1})
+        while response.data['next']:
+            ids.extend(book['id'] for book in response.data['results'])
+            response = self.client.get(response.data['next'])
+        ids.extend(book['id'] for book in response.data['results'])
+        self.assertEqual(ids, self.search(q='dune'))
+
+    def test_search_rejects_tampered_cursor(self):
+        response = self.client.get('/api/books/search/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search_streams_ndjson(self):
+        response = self.client.get('/api/books/search/', {'q': 'herbert', 'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({row['isbn'] for row in rows}, {self.dune.isbn, self.messiah.isbn})
+        self.assertEqual(set(rows[0]), {'id', 'title', 'author', 'isbn', 'published_date', 'copies_available'})
+
+
+class BorrowTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', email='jane@example.com', password='password123')
+        self.book = Book.objects.create(title='Scarce Book', author='Author', isbn='1111111111111', published_date='2020-01-01', copies_available=1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_borrow_stops_at_zero_copies(self):
+        other = User.objects.create_user(username='other', password='password123')
+        self.assertEqual(self.client.post('/api/transactions/', {'book_id': self.book.id}).status_code, status.HTTP_201_CREATED)
+
+        self.client.force_authenticate(other)
+        response = self.client.post('/api/transactions/', {'book_id': self.book.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'No copies available for this book')
+
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 0)
+        self.assertEqual(Transaction.objects.filter(book=self.book).count(), 1)
+
+    def test_borrow_unknown_or_invalid_book(self):
+        self.assertEqual(self.client.post('/api/transactions/', {'book_id': 999}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.post('/api/transactions/', {'book_id': 'abc'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_borrow_uses_conditional_update_not_read_modify_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            borrow_book(self.user, self.book.id)
+        statements = [query['sql'] for query in queries.captured_queries]
+        updates = [sql for sql in statements if sql.startswith('UPDATE "library_book"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"copies_available" > 0', updates[0])
+        self.assertNotIn('"title"', updates[0])
+        self.assertFalse(any(sql.startswith('SELECT') for sql in statements))
+
+    def test_failed_borrow_leaves_no_transaction(self):
+        self.book.copies_available = 0
+        self.book.save()
+        with self.assertRaises(NoCopiesAvailable):
+            borrow_book(self.user, self.book.id)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_second_open_loan_is_refused_and_rolled_back(self):
+        self.book.copies_available = 2
+        self.book.save()
+        borrow_book(self.user, self.book.id)
+        with self.assertRaises(AlreadyBorrowed):
+            borrow_book(self.user, self.book.id)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 1)
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), 1)
+
+        return_loan(self.user, Transaction.objects.get(user=self.user).id)
+        borrow_book(self.user, self.book.id)
+        self.assertEqual(Transaction.objects.filter(user=self.user, date_returned__isnull=True).count(), 1)
+
+    def test_other_integrity_errors_are_not_reported_as_already_borrowed(self):
+        with mock.patch.object(Transaction.objects, 'create', side_effect=IntegrityError('FOREIGN KEY constraint failed')):
+            with self.assertRaises(IntegrityError):
+                borrow_book(self.user, self.book.id)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 1)
+
+    def test_database_rejects_negative_stock(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Book.objects.filter(id=self.book.id).update(copies_available=F('copies_available') - 2)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 1)
+
+    def test_explain_queries_uses_hot_path_indexes(self):
+        out = StringIO()
+        call_command('explain_queries', user_id=self.user.id, book_id=self.book.id, stdout=out)
+        if connection.vendor == 'sqlite':
+            for index in ('book_catalog_idx', 'transaction_open_loans_idx', 'notification_unread_idx'):
+                self.assertIn(index, out.getvalue())
+
+
+class ConcurrentBorrowTestCase(TransactionTestCase):
+    """Borrows racing on one title from several threads, each with its own connection."""
+
+    @contextlib.contextmanager
+    def on_disk(self):
+        """
+        Point new connections at an on-disk copy of the test database: an
+        in-memory SQLite database fails concurrent writers with "table is
+        locked" instead of queueing them on the busy timeout.
+        """
+        if connection.vendor != 'sqlite' or not connection.is_in_memory_db():
+            yield
+            return
+        connection.ensure_connection()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'race.sqlite3')
+            with contextlib.closing(sqlite3.connect(path)) as copy:
+                connection.connection.backup(copy)
+            name = connection.settings_dict['NAME']
+            connection.settings_dict['NAME'] = path
+            try:
+                yield
+            finally:
+                connection.settings_dict['NAME'] = name
+
+    def test_title_is_never_oversold(self):
+        copies, borrowers = 5, 20
+        book = Book.objects.create(title='Contended', author='Author', isbn='1212121212121', published_date='2020-01-01', copies_available=copies)
+        User.objects.bulk_create(User(username=f'racer{n}') for n in range(borrowers))
+        user_ids = list(User.objects.values_list('id', flat=True))
+
+        def attempt(user_id):
+            try:
+                borrow_book(User(id=user_id), book.id)
+                return 'borrowed'
+            except NoCopiesAvailable:
+                return 'refused'
+            finally:
+                connection.close()
+
+        def stock_and_loans():
+            try:
+                return Book.objects.get(id=book.id).copies_available, Transaction.objects.filter(book=book).count()
+            finally:
+                connection.close()
+
+        with self.on_disk(), ThreadPoolExecutor(max_workers=4) as pool:
+            outcomes = list(pool.map(attempt, user_ids))
+            left, loans = pool.submit(stock_and_loans).result()
+
+        self.assertEqual(outcomes.count('borrowed'), copies)
+        self.assertEqual(outcomes.count('refused'), borrowers - copies)
+        self.assertEqual((left, loans), (0, copies))
+
+
+class OneOpenLoanMigrationTestCase(TransactionTestCase):
+    """0014 closes the duplicate open loans racing baseline checkouts left behind."""
+
+    before = [('library', '0013_stat_counters')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_duplicate_open_loans_are_closed_before_the_constraint(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('library')
+        self.addCleanup(self.migrate, latest)
+        apps = self.migrate(self.before)
+        Book, Transaction = apps.get_model('library', 'Book'), apps.get_model('library', 'Transaction')
+        user = apps.get_model('auth', 'User').objects.create(username='racer')
+        book = Book.objects.create(title='Raced', author='Author', isbn='1313131313131', published_date='2020-01-01', copies_available=0)
+        loans = [Transaction.objects.create(user_id=user.id, book_id=book.id) for _ in range(3)]
+
+        self.migrate(latest)
+        still_open = Transaction.objects.filter(book_id=book.id, date_returned__isnull=True)
+        self.assertEqual(list(still_open.values_list('id', flat=True)), [loans[0].id])
+        self.assertEqual(Book.objects.get(id=book.id).copies_available, 2)
+
+
+class ReturnTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', email='jane@example.com', password='password123')
+        self.book = Book.objects.create(title='Returned Book', author='Author', isbn='2222222222222', published_date='2020-01-01', copies_available=1)
+        self.loan = borrow_book(self.user, self.book.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_return_query_count_is_fixed(self):
+        # guarded UPDATE on the loan, F() UPDATE on the book, one SELECT for the
+        # response, the open-loan counter, plus the savepoint pair wrapping them
+        with self.assertNumQueries(6):
+            response = self.client.post(f'/api/transactions/{self.loan.id}/return_book/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['data']['date_returned'])
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 1)
+
+    def test_non_numeric_loan_id_is_not_found(self):
+        response = self.client.post('/api/transactions/abc/return_book/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_second_return_is_rejected_without_restocking(self):
+        return_loan(self.user, self.loan.id)
+        with self.assertRaises(AlreadyReturned):
+            return_loan(self.user, self.loan.id)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.copies_available, 1)
+
+    def test_users_cannot_return_other_users_loans(self):
+        other = User.objects.create_user(username='other', password='password123')
+        self.client.force_authenticate(other)
+        response = self.client.post(f'/api/transactions/{self.loan.id}/return_book/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_authenticate(User.objects.create_superuser(username='desk', password='password123'))
+        response = self.client.post(f'/api/transactions/{self.loan.id}/return_book/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class BulkBookDeleteTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        self.patron = User.objects.create_user(username='patron', password='patron123')
+        self.books = [
+            Book.objects.create(title=f'Book {i}', author='Author', isbn=f'97800000001{i:02d}', published_date='2000-01-01', copies_available=2)
+            for i in range(5)
+        ]
+        long_ago = timezone.now() - timedelta(days=40)
+        for book in self.books[:3]:
+            returned = Transaction.objects.create(user=self.patron, book=book, date_checked_out=long_ago, date_returned=long_ago + timedelta(days=30))
+            FineLedger.objects.create(transaction=returned, user=self.patron, book_title=book.title, overdue_days=16, fine=32, is_final=True, updated_at=timezone.now())
+            open_loan = Transaction.objects.create(user=self.patron, book=book, date_checked_out=long_ago)
+            Notification.objects.create(user=self.patron, transaction=open_loan, message='Overdue')
+
+    def bulk_delete(self, **data):
+        return self.client.delete('/api/books/bulk_delete/', {'book_ids': [book.id for book in self.books[:4]], **data}, format='json')
+
+    def test_dry_run_reports_counts_without_deleting(self):
+        response = self.bulk_delete(dry_run=True)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['affected'], {
+            'open_loans': 3, 'library.Book': 4, 'library.Transaction': 6,
+            'library.FineLedger': 3, 'library.Notification': 3,
+        })
+        self.assertEqual(Book.objects.count(), 5)
+        self.assertEqual(Transaction.objects.count(), 6)
+
+    def test_delete_cascades_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            counts = delete_books([book.id for book in self.books[:4]], chunk_size=2)
+        self.assertEqual(counts['library.Transaction'], 6)
+        # Per chunk: open-loan count, the books, their loan ids, one DELETE
+        # per table and the stats counters
+        statements = [query['sql'].split()[0] for query in queries if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(statements, ['SELECT', 'SELECT', 'SELECT', 'DELETE', 'DELETE', 'DELETE', 'DELETE', 'UPDATE', 'UPDATE'] * 2)
+        self.assertEqual(list(Book.objects.values_list('id', flat=True)), [self.books[4].id])
+        self.assertFalse(Transaction.objects.exists() or FineLedger.objects.exists() or Notification.objects.exists())
+        self.assertEqual(list(search_books(Book.objects.all(), 'book').values_list('id', flat=True)), [self.books[4].id])
+
+    def test_leaf_tables_take_the_signal_free_fast_path(self):
+        with CaptureQueriesContext(connection) as queries:
+            delete_books([self.books[0].id])
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        # Tables without children are fast-deleted: one statement each, no rows loaded
+        for model in (Notification, FineLedger):
+            table = model._meta.db_table
+            self.assertEqual(len([sql for sql in deletes if sql.startswith(f'DELETE FROM "{table}"')]), 1, table)
+            self.assertFalse([sql for sql in selects if f'FROM "{table}"' in sql], table)
+        # and loans are collected by primary key only
+        loans = Transaction._meta.db_table
+        self.assertTrue(any(sql.startswith(f'SELECT "{loans}"."id" FROM "{loans}"') for sql in selects))
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_archive_keeps_history_and_hides_books(self):
+        response = self.bulk_delete(archive=True)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Book.objects.count(), 5)
+        self.assertEqual(Transaction.objects.count(), 6)
+        self.assertEqual(Book.objects.active().count(), 1)
+
+        self.client.force_authenticate(self.patron)
+        response = self.client.post('/api/transactions/', {'book_id': self.books[0].id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(f'/api/books/{self.books[0].id}/').status_code, status.HTTP_404_NOT_FOUND)
+        loan = Transaction.objects.filter(book=self.books[0], date_returned__isnull=True).get()
+        response = self.client.post(f'/api/transactions/{loan.id}/return_book/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class BulkCirculationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', email='jane@example.com', password='password123')
+        Book.objects.bulk_create(
+            Book(title=f'Stack Book {n}', author='Author', isbn=f'{n:013d}', published_date='2020-01-01', copies_available=1)
+            for n in range(50)
+        )
+        self.book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_bulk_borrow_runs_a_handful_of_queries(self):
+        with self.assertNumQueries(6):
+            response = self.client.post('/api/transactions/bulk_borrow/', {'book_ids': self.book_ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(all(item['status'] == 'borrowed' for item in response.data['results']))
+        self.assertEqual(Transaction.objects.filter(user=self.user, date_returned__isnull=True).count(), 50)
+        self.assertFalse(Book.objects.filter(copies_available__gt=0).exists())
+
+    def test_bulk_borrow_reports_per_item_errors(self):
+        Book.objects.filter(id=self.book_ids[1]).update(copies_available=0)
+        response = self.client.post('/api/transactions/bulk_borrow/', {'book_ids': [self.book_ids[0], self.book_ids[1], 999999]}, format='json')
+        results = response.data['results']
+        self.assertEqual(results[0]['status'], 'borrowed')
+        self.assertEqual(results[1]['error'], 'No copies available for this book')
+        self.assertEqual(results[2]['error'], 'Book does not exist')
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_bulk_borrow_refuses_books_already_held(self):
+        borrow_book(self.user, self.book_ids[0])
+        Book.objects.filter(id=self.book_ids[0]).update(copies_available=1)
+        results = borrow_books(self.user, self.book_ids[:2])
+        self.assertEqual(results[0]['error'], 'You have already checked out this book.')
+        self.assertEqual(results[1]['status'], 'borrowed')
+        self.assertEqual(Book.objects.get(id=self.book_ids[0]).copies_available, 1)
+
+    def test_bulk_requests_need_an_object_body(self):
+        response = self.client.post('/api/transactions/bulk_borrow/', self.book_ids[:2], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'error': 'book_ids must be a non-empty list.'})
+
+    def test_bulk_borrow_reports_repeated_conflicts_per_item(self):
+        borrow_book(self.user, self.book_ids[0])
+        with mock.patch('library.circulation._borrow_books', side_effect=IntegrityError):
+            results = borrow_books(self.user, self.book_ids[:2])
+        self.assertEqual(results, [
+            {'book_id': self.book_ids[0], 'error': 'You have already checked out this book.'},
+            {'book_id': self.book_ids[1], 'error': 'The book could not be borrowed, please try again.'},
+        ])
+
+    def test_bulk_return_runs_a_handful_of_queries(self):
+        loan_ids = [item['transaction_id'] for item in borrow_books(self.user, self.book_ids)]
+        with self.assertNumQueries(6):
+            response = self.client.post('/api/transactions/bulk_return/', {'transaction_ids': loan_ids}, format='json')
+        self.assertTrue(all(item['status'] == 'returned' for item in response.data['results']))
+        self.assertFalse(Transaction.objects.filter(date_returned__isnull=True).exists())
+        self.assertEqual(Book.objects.filter(copies_available=1).count(), 50)
+
+    def test_bulk_return_reports_already_returned(self):
+        loan_ids = [item['transaction_id'] for item in borrow_books(self.user, self.book_ids[:2])]
+        return_loan(self.user, loan_ids[0])
+        response = self.client.post('/api/transactions/bulk_return/', {'transaction_ids': loan_ids + [999999]}, format='json')
+        results = response.data['results']
+        self.assertEqual(results[0]['error'], 'Book already returned')
+        self.assertEqual(results[1]['status'], 'returned')
+        self.assertEqual(results[2]['error'], 'Transaction does not exist')
+        self.assertEqual(Book.objects.get(id=self.book_ids[0]).copies_available, 1)
+
+    def test_bulk_requests_validate_id_lists(self):
+        response = self.client.post('/api/transactions/bulk_borrow/', {'book_ids': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/transactions/bulk_return/', {'transaction_ids': ['x']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/transactions/bulk_borrow/', {'book_ids': list(range(MAX_BULK_ITEMS + 1))}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class OverdueTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', email='jane@example.com', password='password123')
+        self.book = Book.objects.create(title='Late Book', author='Author', isbn='3333333333333', published_date='2020-01-01', copies_available=5)
+        self.now = timezone.now()
+        self.late = self.loan(days_ago=20)
+        # One open loan per user and book
+        self.on_time = self.loan(days_ago=3, book=Book.objects.create(title='Current Book', author='Author', isbn='3333333333334', published_date='2020-01-01', copies_available=5))
+        self.returned = self.loan(days_ago=30, returned=True)
+
+    def loan(self, days_ago, returned=False, book=None):
+        loan = Transaction.objects.create(user=self.user, book=book or self.book, date_returned=self.now if returned else None)
+        Transaction.objects.filter(id=loan.id).update(date_checked_out=self.now - timedelta(days=days_ago, minutes=1))
+        return Transaction.objects.get(id=loan.id)
+
+    def test_annotations_match_python_fallback(self):
+        annotated = {loan.id: loan for loan in Transaction.objects.with_overdue(self.now)}
+        for loan in (self.late, self.on_time, self.returned):
+            self.assertEqual(annotated[loan.id].is_overdue, loan.is_overdue)
+            self.assertEqual(annotated[loan.id].overdue_days, loan.overdue_days)
+        self.assertEqual(annotated[self.late.id].overdue_days, 6)
+
+    def test_overdue_filters_in_the_database(self):
+        self.assertEqual(list(Transaction.objects.overdue(self.now).values_list('id', flat=True)), [self.late.id])
+
+    @override_settings(LIBRARY_LOAN_PERIOD_DAYS=2)
+    def test_loan_period_is_configurable(self):
+        overdue = dict(Transaction.objects.overdue(self.now).values_list('id', 'overdue_days'))
+        self.assertEqual(overdue, {self.late.id: 18, self.on_time.id: 1})
+
+    def test_notifications_and_fines_use_one_query(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        generate_overdue_notifications(self.now)
+        with self.assertNumQueries(1):
+            response = client.get('/api/notifications/')
+        self.assertEqual([item['message'] for item in response.data['results']], ["Book 'Late Book' is overdue."])
+        advance_fine_ledger(self.now)
+        with self.assertNumQueries(1):
+            response = client.get('/api/fines/')
+        self.assertEqual(response.data['total_fine'], 12)
+
+    def test_admin_changelist_filters_overdue(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='admin123'))
+        response = self.client.get('/admin/library/transaction/', {'overdue': 'yes'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([loan.id for loan in response.context['cl'].result_list], [self.late.id])
+
+
+class FineTestCase(TestCase):
+
+    def setUp(self):
+        self.jane = User.objects.create_user(username='jane', password='password123')
+        self.john = User.objects.create_user(username='john', password='password123')
+        self.book = Book.objects.create(title='Late Book', author='Author', isbn='4444444444444', published_date='2020-01-01', copies_available=5)
+        self.other_book = Book.objects.create(title='Later Book', author='Author', isbn='4444444444445', published_date='2020-01-01', copies_available=5)
+        self.now = timezone.now()
+        self.loan(self.jane, self.book, days_ago=20)        # 6 days overdue
+        self.loan(self.jane, self.other_book, days_ago=40)  # 26 days overdue
+        self.loan(self.john, self.book, days_ago=15)        # 1 day overdue
+        self.loan(self.john, self.other_book, days_ago=2)   # not overdue
+
+    def loan(self, user, book, days_ago):
+        loan = Transaction.objects.create(user=user, book=book)
+        Transaction.objects.filter(id=loan.id).update(date_checked_out=self.now - timedelta(days=days_ago, minutes=1))
+
+    def test_user_fines_in_one_query(self):
+        with self.assertNumQueries(1):
+            total, loans = user_fines(self.jane, self.now)
+        self.assertEqual(total, 64)
+        self.assertEqual([(loan['book__title'], loan['overdue_days'], loan['fine']) for loan in loans], [('Later Book', 26, 52), ('Late Book', 6, 12)])
+
+    @override_settings(LIBRARY_FINE_PER_DAY='0.50', LIBRARY_FINE_CAP=10)
+    def test_rate_and_cap_are_configurable(self):
+        total, loans = user_fines(self.jane, self.now)
+        self.assertEqual([loan['fine'] for loan in loans], [Decimal('10'), Decimal('3')])
+        self.assertEqual(total, Decimal('13'))
+
+    def test_fines_by_user_for_every_patron_at_once(self):
+        with self.assertNumQueries(1):
+            totals = {row['user_id']: (row['overdue_loans'], row['total_fine']) for row in fines_by_user(self.now)}
+        self.assertEqual(totals, {self.jane.id: (2, 64), self.john.id: (1, 2)})
+
+    def test_user_without_overdue_loans_owes_nothing(self):
+        self.assertEqual(user_fines(User.objects.create_user(username='new'), self.now), (0, []))
+
+    def test_fine_view(self):
+        advance_fine_ledger(self.now)
+        client = APIClient()
+        client.force_authenticate(self.jane)
+        response = client.get('/api/fines/')
+        self.assertEqual(response.data['total_fine'], 64)
+        self.assertIn(
+            {'transaction_id': Transaction.objects.get(user=self.jane, book=self.book).id, 'book_title': 'Late Book', 'fine': '12.00 units fine for 6 overdue days.', 'is_final': False},
+            response.data['details'],
+        )
+
+    def test_fine_view_lists_every_loan_of_a_title(self):
+        first = Transaction.objects.get(user=self.jane, book=self.book)
+        return_loan(self.jane, first.id)
+        self.loan(self.jane, self.book, days_ago=16)  # borrowed again, 2 days overdue
+        advance_fine_ledger(self.now)
+        client = APIClient()
+        client.force_authenticate(self.jane)
+        response = client.get('/api/fines/')
+        late_book = [line for line in response.data['details'] if line['book_title'] == 'Late Book']
+        self.assertEqual(len(late_book), 2)
+        self.assertEqual(response.data['total_fine'], sum(FineLedger.objects.filter(user=self.jane).values_list('fine', flat=True)))
+
+    @override_settings(LIBRARY_FINE_PER_DAY=0, LIBRARY_FINE_CAP=10)
+    def test_zero_rate_with_a_cap(self):
+        total, loans = user_fines(self.jane, self.now)
+        self.assertEqual([loan['fine'] for loan in loans], [0, 0])
+        self.assertEqual(total, 0)
+
+
+class FineLedgerTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', password='password123')
+        self.books = [
+            Book.objects.create(title=f'Ledger Book {n}', author='Author', isbn=f'55555555555{n:02d}', published_date='2020-01-01', copies_available=5)
+            for n in range(4)
+        ]
+        self.now = timezone.now()
+        self.late = self.loan(self.books[0], days_ago=20)
+        self.very_late = self.loan(self.books[1], days_ago=40)
+        self.on_time = self.loan(self.books[2], days_ago=3)
+        self.returned_late = self.loan(self.books[3], days_ago=30, returned_days_ago=10)
+
+    def loan(self, book, days_ago, returned_days_ago=None):
+        loan = Transaction.objects.create(user=self.user, book=book)
+        Transaction.objects.filter(id=loan.id).update(
+            date_checked_out=self.now - timedelta(days=days_ago, minutes=1),
+            date_returned=None if returned_days_ago is None else self.now - timedelta(days=returned_days_ago),
+        )
+        return loan
+
+    def ledger(self):
+        return {row.transaction_id: (row.overdue_days, row.fine, row.is_final) for row in FineLedger.objects.all()}
+
+    def test_advance_only_touches_changed_loans(self):
+        self.assertEqual(advance_fine_ledger(self.now), 2)
+        self.assertEqual(self.ledger(), {self.late.id: (6, 12, False), self.very_late.id: (26, 52, False)})
+
+        # Nothing changed within the same day
+        self.assertEqual(advance_fine_ledger(self.now + timedelta(hours=1)), 0)
+
+        # A day later every open overdue loan moves on, returned history is never touched
+        self.assertEqual(advance_fine_ledger(self.now + timedelta(days=1)), 2)
+        self.assertEqual(self.ledger()[self.late.id], (7, 14, False))
+
+    def test_return_finalizes_the_fine(self):
+        advance_fine_ledger(self.now)
+        return_loan(self.user, self.late.id)
+        overdue_days, fine, is_final = self.ledger()[self.late.id]
+        self.assertTrue(is_final)
+        self.assertEqual(fine, 12)
+
+        advance_fine_ledger(self.now + timedelta(days=5))
+        self.assertEqual(self.ledger()[self.late.id], (overdue_days, fine, True))
+
+    def test_incremental_ledger_matches_full_recomputation(self):
+        for day in range(3):
+            advance_fine_ledger(self.now + timedelta(days=day))
+        return_loan(self.user, self.very_late.id)
+        Transaction.objects.filter(id=self.late.id).update(date_returned=self.now + timedelta(days=2, hours=1))
+        advance_fine_ledger(self.now + timedelta(days=3))
+        incremental = self.ledger()
+
+        rebuild_fine_ledger(self.now + timedelta(days=3))
+        full = self.ledger()
+        # Only the rebuild backfills loans returned before the ledger existed
+        self.assertEqual(full.pop(self.returned_late.id), (6, 12, True))
+        self.assertEqual(incremental, full)
+
+    def test_fine_view_is_a_single_ledger_read(self):
+        advance_fine_ledger(self.now)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            response = client.get('/api/fines/')
+        self.assertEqual(response.data['total_fine'], 64)
+
+
+class OverdueNoticeTestCase(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.books = [
+            Book.objects.create(title=f'Notice Book {n}', author='Author', isbn=f'66666666666{n:02d}', published_date='2020-01-01', copies_available=5)
+            for n in range(3)
+        ]
+        self.users = [User.objects.create_user(username=f'reader{n}', email=f'reader{n}@example.com') for n in range(5)]
+        for user in self.users:
+            for book in self.books[:2]:
+                self.loan(user, book, days_ago=20)
+            self.loan(user, self.books[2], days_ago=1)
+
+    def loan(self, user, book, days_ago):
+        loan = Transaction.objects.create(user=user, book=book)
+        Transaction.objects.filter(id=loan.id).update(date_checked_out=self.now - timedelta(days=days_ago))
+
+    def test_one_digest_per_borrower(self):
+        emails_sent, loans_notified = send_overdue_notices(now=self.now)
+        self.assertEqual((emails_sent, loans_notified), (5, 10))
+        self.assertEqual(len(mail.outbox), 5)
+        email = mail.outbox[0]
+        self.assertEqual(email.subject, 'Overdue Books: 2 titles')
+        self.assertIn('Notice Book 0 (6 days overdue)', email.body)
+        self.assertNotIn('Notice Book 2', email.body)
+
+    def test_single_query_and_reused_connection_in_batches(self):
+        connection = get_connection()
+        with mock.patch('library.notices.get_connection', return_value=connection) as opened, \
+                mock.patch.object(connection, 'send_messages', wraps=connection.send_messages) as sent, \
+                self.assertNumQueries(1):
+            send_overdue_notices(now=self.now, batch_size=2)
+        opened.assert_called_once_with()
+        self.assertEqual([len(call.args[0]) for call in sent.call_args_list], [2, 2, 1])
+
+    def test_borrowers_without_email_are_skipped(self):
+        User.objects.filter(id=self.users[0].id).update(email='')
+        self.assertEqual(send_overdue_notices(now=self.now), (4, 8))
+
+    def test_check_overdue_reports_a_bounded_summary(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        with mock.patch('library.views.MAX_REPORTED_LOANS', 3):
+            response = client.post('/api/transactions/check_overdue/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['emails_sent'], response.data['loans_notified']), (5, 10))
+        self.assertEqual(len(response.data['loans']), 3)
+        self.assertTrue(response.data['loans_truncated'])
+
+    def test_management_command(self):
+        out = StringIO()
+        call_command('send_overdue_notices', batch_size=3, stdout=out)
+        self.assertIn('Sent 5 overdue notices covering 10 loans.', out.getvalue())
+
+
+class NotificationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', password='password123')
+        self.other = User.objects.create_user(username='john', password='password123')
+        self.book = Book.objects.create(title='Inbox Book', author='Author', isbn='7777777777777', published_date='2020-01-01', copies_available=5)
+        second = Book.objects.create(title='Second Book', author='Author', isbn='7777777777778', published_date='2020-01-01', copies_available=5)
+        self.now = timezone.now()
+        for user, book in ((self.user, self.book), (self.user, second), (self.other, self.book)):
+            loan = Transaction.objects.create(user=user, book=book)
+            Transaction.objects.filter(id=loan.id).update(date_checked_out=self.now - timedelta(days=20))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch_job_notifies_each_overdue_loan_once(self):
+        self.assertEqual(generate_overdue_notifications(self.now, chunk_size=2), 3)
+        self.assertEqual(generate_overdue_notifications(self.now), 0)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 2)
+
+    def test_count_leaves_out_loans_notified_meanwhile(self):
+        rows = list(Transaction.objects.order_by('id').values_list('id', 'user_id', 'book__title'))
+        Notification.objects.create(user_id=rows[0][1], transaction_id=rows[0][0], message='Sent by another run')
+        with mock.patch('library.notices.keyset_batches', return_value=[rows]):
+            self.assertEqual(generate_overdue_notifications(self.now), 2)
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_pages_notifications_created_within_one_millisecond(self):
+        for n in range(5):
+            book = Book.objects.create(title=f'Burst {n}', author='Author', isbn=f'77777777770{n:02d}', published_date='2020-01-01', copies_available=5)
+            loan = Transaction.objects.create(user=self.user, book=book)
+            Transaction.objects.filter(id=loan.id).update(date_checked_out=self.now - timedelta(days=20))
+        generate_overdue_notifications(self.now)
+        instant = self.now.replace(microsecond=500000)
+        for n, notification_id in enumerate(Notification.objects.filter(user=self.user).order_by('id').values_list('id', flat=True)):
+            Notification.objects.filter(id=notification_id).update(created_at=instant + timedelta(microseconds=n * 100))
+
+        response = self.client.get('/api/notifications/', {'page_size': 2})
+        seen = [notification['id'] for notification in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [notification['id'] for notification in response.data['results']]
+        self.assertEqual(seen, list(Notification.objects.filter(user=self.user).order_by('-id').values_list('id', flat=True)))
+        self.assertEqual(len(seen), 7)
+
+    def test_mark_read_and_unread_count(self):
+        generate_overdue_notifications(self.now)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/notifications/unread_count/')
+        self.assertEqual(response.data['unread_count'], 2)
+
+        notification = Notification.objects.filter(user=self.user).first()
+        self.assertEqual(self.client.post(f'/api/notifications/{notification.id}/mark_read/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/notifications/unread_count/').data['unread_count'], 1)
+        unread = self.client.get('/api/notifications/', {'unread': 'true'}).data['results']
+        self.assertEqual(len(unread), 1)
+
+        with self.assertNumQueries(1):
+            self.client.post('/api/notifications/mark_all_read/')
+        self.assertEqual(self.client.get('/api/notifications/unread_count/').data['unread_count'], 0)
+        self.assertFalse(Notification.objects.filter(user=self.other, is_read=True).exists())
+
+    def test_users_cannot_mark_other_users_notifications(self):
+        generate_overdue_notifications(self.now)
+        notification = Notification.objects.get(user=self.other)
+        self.assertEqual(self.client.post(f'/api/notifications/{notification.id}/mark_read/').status_code, status.HTTP_404_NOT_FOUND)
+        notification.refresh_from_db()
+        self.assertFalse(notification.is_read)
+
+
+class NotificationStreamTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jane', password='password123')
+        self.book = Book.objects.create(title='Pushed Book', author='Author', isbn='8888888888888', published_date='2020-01-01', copies_available=5)
+        self.token = 'Bearer ' + str(user_refresh_token(self.user).access_token)
+
+    async def test_broker_wakes_subscribers_from_other_threads(self):
+        broker = InProcessBroker()
+        queue = broker.subscribe('channel')
+        await sync_to_async(broker.publish, thread_sensitive=False)('channel', 'hello')
+        self.assertEqual(await asyncio.wait_for(queue.get(), timeout=1), 'hello')
+        broker.unsubscribe('channel', queue)
+        broker.publish('channel', 'nobody listening')
+        self.assertTrue(queue.empty())
+
+    async def test_stream_requires_authentication(self):
+        response = await AsyncClient().get('/api/notifications/stream/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(LIBRARY_NOTIFICATION_STREAM_POLL=5)
+    async def test_stream_pushes_new_notifications(self):
+        response = await AsyncClient().get('/api/notifications/stream/', headers={'Authorization': self.token})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        self.assertEqual(await anext(events), b'retry: 5000\n\n')
+
+        # The stream is now parked on the broker; creating a notification wakes it
+        waiting = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0.05)
+        await sync_to_async(self.create_overdue_notification)()
+        event = (await asyncio.wait_for(waiting, timeout=2)).decode()
+        self.assertIn('event: notification', event)
+        self.assertIn("Book 'Pushed Book' is overdue.", event)
+        await events.aclose()
+
+    def create_overdue_notification(self):
+        loan = Transaction.objects.create(user=self.user, book=self.book)
+        Transaction.objects.filter(id=loan.id).update(date_checked_out=timezone.now() - timedelta(days=20))
+        with self.captureOnCommitCallbacks(execute=True):
+            generate_overdue_notifications()
+
+
+class BulkBookUploadTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        Book.objects.create(title='Old Title', author='Author', isbn='9990000000001', published_date='2000-01-01', copies_available=1)
+
+    def upload(self, name, content, **params):
+        upload = SimpleUploadedFile(name, content.encode())
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return self.client.post(f'/api/books/bulk_upload/?{query}', {'file': upload}, format='multipart')
+
+    def test_csv_upsert_with_row_errors(self):
+        content = (
+            'title,author,isbn,published_date,copies_available\n'
+            'New Title,Author,9990000000001,2001-02-03,4\n'
+            'Fresh Book,Writer,9990000000002,2010-05-06,2\n'
+            ',Writer,9990000000003,2010-05-06,2\n'
+            'Bad Date,Writer,9990000000004,06/05/2010,-1\n'
+        )
+        before = Book.objects.get(isbn='9990000000001').updated_at
+        response = self.upload('feed.csv', content, chunk_size=2, sync='true')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['rows'], response.data['imported'], response.data['failed']), (4, 2, 2))
+        self.assertEqual(response.data['errors'][0], {'row': 3, 'errors': {'title': 'This field is required.'}})
+        self.assertEqual(set(response.data['errors'][1]['errors']), {'published_date', 'copies_available'})
+
+        updated = Book.objects.get(isbn='9990000000001')
+        self.assertEqual((updated.title, updated.copies_available), ('New Title', 4))
+        self.assertGreater(updated.updated_at, before)
+        self.assertEqual(Book.objects.count(), 2)
+
+    def test_undecodable_file_is_rejected(self):
+        upload = SimpleUploadedFile('feed.csv', 'title,author\nCaf\u00e9,Author\n'.encode('latin-1'))
+        response = self.client.post('/api/books/bulk_upload/?sync=true', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('not valid UTF-8', response.data['error'])
+
+    def test_jsonl_import_and_search_index_follows(self):
+        rows = [
+            {'title': 'Streamed Book', 'author': 'Feed', 'isbn': '9990000000005', 'published_date': '2020-01-01', 'copies_available': 1},
+            {'title': 'Repeated Isbn', 'author': 'Feed', 'isbn': '9990000000005', 'published_date': '2020-01-01', 'copies_available': 3},
+        ]
+        content = '\n'.join(json.dumps(row) for row in rows) + '\n\nnot json\n'
+        response = self.upload('feed.jsonl', content, sync='true')
+        self.assertEqual((response.data['imported'], response.data['failed']), (2, 1))
+        self.assertEqual(Book.objects.get(isbn='9990000000005').copies_available, 3)
+        self.assertEqual(list(search_books(Book.objects.all(), 'repeated').values_list('isbn', flat=True)), ['9990000000005'])
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(self.upload('feed.xlsx', 'x').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.upload('feed.txt', 'title\n', file_format='csv', sync='true').status_code, status.HTTP_201_CREATED)
+
+
+class ImportJobTestCase(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, LIBRARY_IMPORT_RANGE_SIZE=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        self.content = (
+            'title,author,isbn,published_date,copies_available\n'
+            'One,Author,9990000000011,2001-01-01,1\n'
+            '"Two\nLines",Author,9990000000012,2001-01-01,2\n'
+            'Three,Author,9990000000013,2001-01-01,3\n'
+            'Four,Author,9990000000014,not a date,4\n'
+            'Five,Author,9990000000015,2001-01-01,5\n'
+        )
+
+    def enqueue(self, content=None):
+        upload = SimpleUploadedFile('feed.csv', content or self.content.encode())
+        response = self.client.post('/api/books/bulk_upload/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(response.data['status_url'].endswith(f"/api/jobs/{response.data['job_id']}/"))
+        return ImportJob.objects.get(id=response.data['job_id'])
+
+    def test_upload_is_queued_and_imported_by_worker(self):
+        job = self.enqueue()
+        self.assertEqual(job.status, ImportJob.QUEUED)
+        self.assertFalse(Book.objects.exists())
+
+        self.assertEqual(run_worker(worker_id='test', exit_when_idle=True), 3)
+
+        self.assertEqual(Book.objects.count(), 4)
+        self.assertEqual(Book.objects.get(isbn='9990000000012').title, 'Two\nLines')
+        response = self.client.get(f'/api/jobs/{job.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], ImportJob.DONE)
+        self.assertEqual((response.data['total_rows'], response.data['rows_done']), (5, 5))
+        self.assertEqual((response.data['imported'], response.data['failed'], response.data['percent']), (4, 1, 100.0))
+        self.assertEqual(response.data['ranges']['done'], 3)
+        self.assertEqual(response.data['errors'], [{'row': 4, 'errors': {'published_date': 'Date has wrong format. Use YYYY-MM-DD.'}}])
+
+    def test_workers_lease_distinct_ranges(self):
+        job = self.enqueue()
+        plan_next_job()
+        self.assertEqual(
+            list(job.chunks.order_by('first_row').values_list('first_row', 'last_row')),
+            [(1, 2), (3, 4), (5, 5)],
+        )
+        first, second = lease_chunk('worker-1'), lease_chunk('worker-2')
+        self.assertNotEqual(first.id, second.id)
+        self.assertTrue(process_chunk(second, 'worker-2'))
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), ['Three'])
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_done), (ImportJob.RUNNING, 2))
+
+    def test_expired_lease_is_taken_over(self):
+        self.enqueue()
+        plan_next_job()
+        stalled = lease_chunk('dead-worker')
+        later = timezone.now() + timedelta(hours=1)
+        taken_over = lease_chunk('live-worker', now=later)
+        self.assertEqual(taken_over.id, stalled.id)
+
+        # The stalled worker's late result no longer counts
+        self.assertFalse(process_chunk(stalled, 'dead-worker'))
+        self.assertTrue(process_chunk(taken_over, 'live-worker'))
+        self.assertEqual(ImportChunk.objects.get(id=stalled.id).status, ImportChunk.DONE)
+
+    def test_blank_csv_lines_are_planned_as_they_are_read(self):
+        content = self.content.replace('\nThree', '\n\n\nThree') + '\n'
+        job = self.enqueue(content=content.encode())
+        plan_next_job()
+        self.assertEqual(
+            list(job.chunks.order_by('first_row').values_list('first_row', 'last_row')),
+            [(1, 2), (3, 4), (5, 5)],
+        )
+        run_worker(worker_id='test', exit_when_idle=True)
+
+        response = self.client.get(f'/api/jobs/{job.id}/')
+        self.assertEqual((response.data['total_rows'], response.data['rows_done']), (5, 5))
+        self.assertEqual((response.data['imported'], response.data['failed']), (4, 1))
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), ['Five', 'One', 'Three', 'Two\nLines'])
+        self.assertEqual(response.data['errors'], [{'row': 4, 'errors': {'published_date': 'Date has wrong format. Use YYYY-MM-DD.'}}])
+
+    def test_finished_job_deletes_its_file(self):
+        job = self.enqueue()
+        storage = job.file.storage
+        self.assertTrue(storage.exists(job.file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            run_worker(worker_id='test', exit_when_idle=True)
+        self.assertFalse(storage.exists(job.file.name))
+
+    def test_unreadable_file_is_deleted_when_its_job_fails(self):
+        job = self.enqueue(content=b'title,author\n\xff\xfe,Author\n')
+        with self.captureOnCommitCallbacks(execute=True):
+            plan_next_job()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertFalse(job.file.storage.exists(job.file.name))
+
+    def test_queued_upload_keeps_its_chunk_size(self):
+        upload = SimpleUploadedFile('feed.csv', self.content.encode())
+        response = self.client.post('/api/books/bulk_upload/?chunk_size=1', {'file': upload}, format='multipart')
+        job = ImportJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.chunk_size, 1)
+        plan_next_job()
+        with mock.patch('library.jobs.import_row_range', return_value={'imported': 0, 'failed': 0, 'errors': []}) as import_row_range:
+            process_chunk(lease_chunk('test'), 'test')
+        self.assertEqual(import_row_range.call_args.kwargs['chunk_size'], 1)
+
+    def test_progress_requires_admin(self):
+        job = self.enqueue()
+        self.client.force_authenticate(User.objects.create_user(username='patron', password='patron123'))
+        self.assertEqual(self.client.get(f'/api/jobs/{job.id}/').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        self.patron = User.objects.create_user(username='patron', password='patron123')
+        self.books = [
+            Book.objects.create(title=f'Export {i}', author='Author, Jr.', isbn=f'97800000002{i:02d}', published_date='2000-01-01', copies_available=2)
+            for i in range(3)
+        ]
+
+    def export(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_formats(self):
+        response, body = self.export('/api/books/export/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = body.splitlines()
+        self.assertEqual(lines[0], 'id,title,author,isbn,published_date,copies_available,archived_at,updated_at')
+        self.assertEqual(lines[1].split(',')[:3], [str(self.books[0].id), 'Export 0', '"Author'])
+        self.assertEqual(len(lines), 4)
+
+        _, body = self.export('/api/books/export/', export_format='ndjson')
+        self.assertEqual([json.loads(line)['isbn'] for line in body.splitlines()], [book.isbn for book in self.books])
+
+        _, body = self.export('/api/books/export/', export_format='columnar')
+        batch = json.loads(body)
+        self.assertEqual(batch['rows'], 3)
+        self.assertEqual(batch['columns']['title'], ['Export 0', 'Export 1', 'Export 2'])
+
+    def test_watermark_trails_the_export_by_the_lag(self):
+        response, _ = self.export('/api/books/export/')
+        watermark = parse_datetime(response['X-Export-Watermark'])
+        self.assertLessEqual(watermark, timezone.now() - timedelta(seconds=300))
+        # A book stamped before the export but committed after it is in the next pull
+        Book.objects.filter(id=self.books[0].id).update(updated_at=timezone.now() - timedelta(seconds=1))
+        _, body = self.export('/api/books/export/', export_format='ndjson', updated_since=response['X-Export-Watermark'])
+        self.assertIn(self.books[0].id, [json.loads(line)['id'] for line in body.splitlines()])
+
+    @override_settings(LIBRARY_EXPORT_WATERMARK_LAG_SECONDS=0)
+    def test_updated_since_watermark(self):
+        response, _ = self.export('/api/transactions/export/')
+        watermark = response['X-Export-Watermark']
+
+        borrow_book(self.patron, self.books[1].id)
+        _, body = self.export('/api/books/export/', export_format='ndjson', updated_since=watermark)
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], [self.books[1].id])
+        _, body = self.export('/api/transactions/export/', export_format='ndjson', updated_since=watermark)
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([(row['book_id'], row['date_returned']) for row in rows], [(self.books[1].id, None)])
+
+        _, body = self.export('/api/books/export/', export_format='ndjson', updated_since=timezone.now().isoformat())
+        self.assertEqual(body, '')
+
+    def test_rejects_bad_params_and_patrons(self):
+        self.assertEqual(self.client.get('/api/books/export/', {'export_format': 'xml'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/books/export/', {'updated_since': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(self.patron)
+        self.assertEqual(self.client.get('/api/transactions/export/').status_code, status.HTTP_403_FORBIDDEN)
+
+
+class FastSerializerTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='reader123')
+        self.book = Book.objects.create(title='Fast Book', author='Author', isbn='9780000000301', published_date='1999-12-31', copies_available=3)
+        late_book = Book.objects.create(title='Late Book', author='Writer', isbn='9780000000302', published_date='2001-01-01', copies_available=1)
+        now = timezone.now()
+        for book, checked_out, returned in [(self.book, 2, None), (late_book, 30, None), (self.book, 30, 1)]:
+            # date_checked_out is auto_now_add, so backdate it afterwards
+            loan = Transaction.objects.create(user=self.user, book=book, date_returned=returned and now - timedelta(days=returned))
+            Transaction.objects.filter(id=loan.id).update(date_checked_out=now - timedelta(days=checked_out))
+
+    def test_output_matches_model_serializers(self):
+        books = Book.objects.order_by('id')
+        self.assertEqual(
+            FastBookSerializer().many(books.values(*FastBookSerializer.lookups())),
+            BookSerializer(books, many=True).data,
+        )
+        loans = Transaction.objects.with_overdue().order_by('id')
+        fast = FastTransactionSerializer().many(loans.values(*FastTransactionSerializer.lookups()))
+        self.assertEqual(fast, TransactionSerializer(loans, many=True).data)
+        self.assertEqual([loan['is_overdue'] for loan in fast], [False, True, False])
+
+    def test_list_endpoint_uses_one_query(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['book']['title'], 'Fast Book')
+        # Keyset pages need no count query, however many rows there are
+        self.assertEqual(len(queries), 1)
+
+
+@override_settings(LIBRARY_QUERY_BUDGET_STRICT=True)
+class QueryBudgetTestCase(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='admin123')
+        self.patron = User.objects.create_user(username='patron', password='patron123')
+        UserProfile.objects.create(user=self.patron)
+        self.added = 0
+        self.add_loans(1)
+
+    def client_for(self, user):
+        # Real JWT authentication, as issued at login
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {user_refresh_token(user).access_token}')
+        return client
+
+    def add_loans(self, rows):
+        for _ in range(rows):
+            self.added += 1
+            user = User.objects.create_user(username=f'reader{self.added}', password='reader123')
+            UserProfile.objects.create(user=user)
+            book = Book.objects.create(title=f'Budget {self.added}', author='Author', isbn=f'97800000004{self.added:02d}', published_date='2000-01-01', copies_available=1)
+            for borrower in (user, self.patron):
+                loan = Transaction.objects.create(user=borrower, book=book)
+                Notification.objects.create(user=borrower, transaction=loan, message='Overdue')
+
+    def test_list_endpoints_have_no_per_row_queries(self):
+        endpoints = [
+            (self.patron, '/api/books/'),
+            (self.patron, '/api/books/search/?q=budget'),
+            (self.patron, '/api/transactions/'),
+            (self.patron, '/api/notifications/'),
+            (self.patron, '/api/profiles/'),
+            (self.admin, '/api/books/borrowed/'),
+            (self.admin, '/api/admin/stats/'),
+        ]
+        for user, url in endpoints:
+            with self.subTest(url=url):
+                client = self.client_for(user)
+
+                def request():
+                    self.assertEqual(client.get(url).status_code, status.HTTP_200_OK)
+
+                self.assertNoPerRowQueries(request, self.add_loans)
+
+    def test_detail_endpoints_stay_within_budget(self):
+        client = self.client_for(self.patron)
+        loan = Transaction.objects.filter(user=self.patron).first()
+        self.assertEqual(client.get(f'/api/transactions/{loan.id}/').status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get('/api/user/profile/').status_code, status.HTTP_200_OK)
+        self.assertEqual(client.post(f'/api/transactions/{loan.id}/return_book/').status_code, status.HTTP_200_OK)
+
+    def test_every_action_of_a_budgeted_viewset_has_a_budget(self):
+        for _, viewset, _ in router.registry:
+            if not isinstance(getattr(viewset, 'query_budget', None), dict):
+                continue
+            actions = {name for name in ('list', 'retrieve', 'create', 'update', 'partial_update', 'destroy') if hasattr(viewset, name)}
+            actions |= {extra.__name__ for extra in viewset.get_extra_actions()}
+            with self.subTest(viewset=viewset.__name__):
+                self.assertEqual(actions - set(viewset.query_budget), set())
+
+    def test_bulk_budgets_grow_with_the_chunks(self):
+        self.add_loans(2)
+        client = self.client_for(self.admin)
+        book_ids = list(Book.objects.values_list('id', flat=True))
+        with mock.patch('library.views.DELETE_CHUNK_SIZE', 1):
+            response = client.delete('/api/books/bulk_delete/', {'book_ids': book_ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Book.objects.exists())
+
+    def test_over_budget_request_fails(self):
+        client = self.client_for(self.patron)
+        with mock.patch('library.views.BookViewSet.query_budget', {'list': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get('/api/books/')
+
+
+class TransactionListTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.patron = User.objects.create_user(username='patron', password='patron123')
+        self.other = User.objects.create_user(username='other', password='other123')
+        self.book = Book.objects.create(title='Scoped Book', author='Author', isbn='9780000000501', published_date='2000-01-01', copies_available=9)
+        late_book = Book.objects.create(title='Late Book', author='Author', isbn='9780000000502', published_date='2000-01-01', copies_available=9)
+        now = timezone.now()
+        self.loans = {}
+        for name, user, book, checked_out, returned in [
+            ('returned', self.patron, self.book, 40, 20), ('overdue', self.patron, late_book, 30, None),
+            ('active', self.patron, self.book, 1, None), ('others', self.other, self.book, 2, None),
+        ]:
+            loan = Transaction.objects.create(user=user, book=book, date_returned=returned and now - timedelta(days=returned))
+            Transaction.objects.filter(id=loan.id).update(date_checked_out=now - timedelta(days=checked_out))
+            self.loans[name] = loan.id
+
+    def loan_ids(self, **params):
+        response = self.client.get('/api/transactions/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [loan['id'] for loan in response.data['results']]
+
+    def test_patrons_see_only_their_loans_newest_first(self):
+        self.client.force_authenticate(self.patron)
+        self.assertEqual(self.loan_ids(), [self.loans['active'], self.loans['overdue'], self.loans['returned']])
+        self.assertEqual(self.client.get(f"/api/transactions/{self.loans['others']}/").status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='admin123'))
+        self.assertEqual(len(self.loan_ids()), 4)
+
+    def test_status_filters(self):
+        self.client.force_authenticate(self.patron)
+        self.assertEqual(self.loan_ids(status='active'), [self.loans['active'], self.loans['overdue']])
+        self.assertEqual(self.loan_ids(status='returned'), [self.loans['returned']])
+        self.assertEqual(self.loan_ids(status='overdue'), [self.loans['overdue']])
+        self.assertEqual(self.client.get('/api/transactions/', {'status': 'lost'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_keyset_pages(self):
+        self.client.force_authenticate(self.patron)
+        response = self.client.get('/api/transactions/', {'page_size': 2})
+        seen = [loan['id'] for loan in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [loan['id'] for loan in response.data['results']]
+        self.assertEqual(seen, [self.loans['active'], self.loans['overdue'], self.loans['returned']])
+
+    def test_keyset_pages_rows_within_one_millisecond(self):
+        self.client.force_authenticate(self.other)
+        instant = timezone.now().replace(microsecond=250000)
+        books = Book.objects.bulk_create(
+            Book(title=f'Burst {n}', author='Author', isbn=f'97800000006{n:02d}', published_date='2000-01-01', copies_available=1)
+            for n in range(7)
+        )
+        burst = Transaction.objects.bulk_create(
+            Transaction(user=self.other, book=book, date_checked_out=instant + timedelta(microseconds=n * 100))
+            for n, book in enumerate(books)
+        )
+        response = self.client.get('/api/transactions/', {'page_size': 2})
+        seen = [loan['id'] for loan in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [loan['id'] for loan in response.data['results']]
+        self.assertEqual(seen[:7], [loan.id for loan in reversed(burst)])
+        self.assertEqual(len(seen), 8)
+
+
+class StatCounterTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='admin123')
+        self.patron = User.objects.create_user(username='patron', password='password123')
+        self.books = [
+            Book.objects.create(title=f'Counted {n}', author='Author', isbn=f'{n:013d}', published_date='2020-01-01', copies_available=1)
+            for n in range(4)
+        ]
+        # Fixtures are created behind the counters' back
+        reconcile_counters()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def stats(self):
+        response = self.client.get('/api/admin/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_write_paths_keep_counters_exact(self):
+        patron = APIClient()
+        patron.force_authenticate(self.patron)
+        self.client.post('/api/books/', {'title': 'New', 'author': 'Author', 'isbn': '9990000000001', 'published_date': '2020-01-01', 'copies_available': 1})
+        APIClient().post('/api/register/', {'username': 'newcomer', 'password': 'password123', 'email': 'new@example.com'})
+        loan = patron.post('/api/transactions/', {'book_id': self.books[0].id}).data['id']
+        patron.post('/api/transactions/', {'book_id': self.books[0].id})  # Out of stock, rolled back
+        patron.post('/api/transactions/bulk_borrow/', {'book_ids': [self.books[1].id, self.books[2].id]}, format='json')
+        patron.post(f'/api/transactions/{loan}/return_book/')
+        self.client.delete('/api/books/bulk_delete/', {'book_ids': [self.books[1].id]}, format='json')
+        self.client.delete(f'/api/books/{self.books[3].id}/delete/')
+        import_books(BytesIO(b'title,author,isbn,published_date,copies_available\nFeed,Author,9990000000001,2020-01-01,2\nFeed,Author,9990000000002,2020-01-01,2\n'), 'csv')
+        self.client.delete(f'/api/users/{self.patron.id}/delete/')
+
+        stats = self.stats()
+        self.assertEqual((stats['total_books'], stats['total_users'], stats['total_books_borrowed']), (4, 2, 0))
+        self.assertEqual(reconcile_counters(), {'total_books': 0, 'total_users': 0, 'total_books_borrowed': 0})
+
+    def test_stats_read_counters_and_reconcile_corrects_drift(self):
+        Book.objects.create(title='Uncounted', author='Author', isbn='9990000000009', published_date='2020-01-01', copies_available=1)
+        with self.assertNumQueries(1):
+            stats = self.stats()
+        self.assertEqual(stats['total_books'], 4)
+        self.assertGreaterEqual(stats['stale_seconds'], 0)
+
+        StatCounter.objects.update(reconciled_at=timezone.now() - timedelta(minutes=10))
+        self.assertGreaterEqual(self.stats()['stale_seconds'], 600)
+
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('total_books was off by -1', out.getvalue())
+        stats = self.stats()
+        self.assertEqual(stats['total_books'], 5)
+        self.assertLess(stats['stale_seconds'], 600)
+
+    def test_missing_counters_are_counted_on_first_read(self):
+        StatCounter.objects.all().delete()
+        # Counting them is the over-budget scan the counters normally avoid
+        with self.assertLogs('library.querybudget', 'WARNING'):
+            self.assertEqual(self.stats()['total_users'], 2)
+        self.assertEqual(StatCounter.objects.count(), 3 * counter_shards())
+
+    def test_adjustments_spread_over_shards_and_reconcile_collapses_them(self):
+        with mock.patch('library.counters.random.randrange', side_effect=[1, 2, 2]):
+            adjust_counters(total_books_borrowed=1)
+            adjust_counters(total_books_borrowed=1)
+            adjust_counters(total_books_borrowed=-1)
+        shards = dict(StatCounter.objects.filter(name='total_books_borrowed').values_list('shard', 'value'))
+        self.assertEqual((shards[0], shards[1], shards[2]), (0, 1, 0))
+        self.assertEqual(self.stats()['total_books_borrowed'], 1)
+
+        self.assertEqual(reconcile_counters(), {'total_books': 0, 'total_users': 0, 'total_books_borrowed': -1})
+        self.assertEqual(StatCounter.objects.filter(name='total_books_borrowed').exclude(shard=0).exclude(value=0).count(), 0)
+
+    def test_shards_follow_the_setting_on_reconcile(self):
+        with override_settings(LIBRARY_COUNTER_SHARDS=2):
+            reconcile_counters()
+            self.assertEqual(StatCounter.objects.count(), 6)
+        # Until the next reconcile, adjustments to a missing shard land on shard 0
+        with mock.patch('library.counters.random.randrange', return_value=5):
+            adjust_counters(total_books=1)
+        self.assertEqual(StatCounter.objects.get(name='total_books', shard=0).value, 5)
+        reconcile_counters()
+        self.assertEqual(StatCounter.objects.count(), 3 * counter_shards())
+
+
+class ClaimsAuthenticationTestCase(TestCase):
+
+    def setUp(self):
+        authentication._users.clear()
+        authentication._changed.clear()
+        self.user = User.objects.create_user(username='reader', email='reader@example.com', password='reader123')
+        self.client = APIClient()
+
+    def login(self):
+        response = self.client.post('/api/login/', {'username': 'reader', 'password': 'reader123'})
+        return response.json()['tokens']
+
+    def authenticate(self, access):
+        return ClaimsJWTAuthentication().get_user(AccessToken(access))
+
+    def test_login_token_authenticates_from_claims(self):
+        access = self.login()['access']
+        with self.assertNumQueries(0):
+            user = self.authenticate(access)
+            self.assertEqual((user.pk, user.username, user.is_staff), (self.user.id, 'reader', False))
+            self.assertEqual(user, self.user)
+        # Fields outside the claims are loaded on first access
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'reader@example.com')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/notifications/').status_code, status.HTTP_200_OK)
+
+    def test_tokens_without_claims_use_the_user_cache(self):
+        access = str(RefreshToken.for_user(self.user).access_token)
+        with self.assertNumQueries(1):
+            self.authenticate(access)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(access).email, 'reader@example.com')
+
+    def test_update_and_delete_invalidate_older_tokens(self):
+        access = self.login()['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.client.put(f'/api/users/{self.user.id}/update/', {'username': 'renamed'})
+        self.assertEqual(self.authenticate(access).username, 'renamed')
+
+        self.client.delete(f'/api/users/{self.user.id}/delete/')
+        self.assertEqual(self.client.get('/api/notifications/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_refresh_reads_current_roles(self):
+        refresh = self.login()['refresh']
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.post('/api/token/refresh/', {'refresh': refresh})
+        self.assertTrue(AccessToken(response.data['access'])['is_staff'])
+
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        response = self.client.post('/api/token/refresh/', {'refresh': response.data['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_outstanding_tokens_are_the_ones_issued(self):
+        issued = [
+            self.login()['refresh'],
+            self.client.post('/api/token/', {'username': 'reader', 'password': 'reader123'}).data['refresh'],
+        ]
+        for refresh in issued:
+            self.assertIn('username', RefreshToken(refresh))
+            self.assertEqual(OutstandingToken.objects.get(jti=RefreshToken(refresh)['jti']).token, refresh)
+
+
+class CaseInsensitiveBackend(ModelBackend):
+    """Lets patrons sign in with their username in any case."""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        return super().authenticate(request, username=username and username.lower(), password=password, **kwargs)
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        return await super().aauthenticate(request, username=username and username.lower(), password=password, **kwargs)
+
+
+class LoginTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', email='reader@example.com', password='reader123')
+        self.client = APIClient()
+
+    def login(self, password='reader123', **kwargs):
+        return self.client.post('/api/login/', {'username': 'reader', 'password': password}, **kwargs)
+
+    def test_jwt_only_login_writes_no_session(self):
+        response = self.login(format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['user'], {'username': 'reader', 'email': 'reader@example.com'})
+        self.assertFalse(Session.objects.exists())
+
+        with override_settings(LIBRARY_LOGIN_SESSIONS=True):
+            self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        self.assertEqual(Session.objects.count(), 1)
+
+    def test_wrong_password_and_inactive_users_are_refused(self):
+        response = self.login('wrong')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'error': 'Invalid username or password'})
+
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertEqual(self.login().status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post('/api/login/', {'username': 'reader'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_jwt_only_login_updates_last_login(self):
+        self.assertIsNone(self.user.last_login)
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['library.tests.CaseInsensitiveBackend'])
+    def test_configured_authentication_backends_are_asked(self):
+        response = self.client.post('/api/login/', {'username': 'READER', 'password': 'reader123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['user']['username'], 'reader')
+
+    def test_drf_default_throttles_apply(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        throttled = {**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_CLASSES': ['rest_framework.throttling.AnonRateThrottle']}
+        with override_settings(REST_FRAMEWORK=throttled), mock.patch.object(AnonRateThrottle, 'THROTTLE_RATES', {'anon': '2/min'}):
+            self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+            self.assertEqual(self.login('wrong').status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.login()
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response.json(), {'error': 'Request was throttled.'})
+        self.assertIn('Retry-After', response)
+
+    def test_malformed_bodies_are_answered_with_an_error(self):
+        for body in ('{"username": ', '["reader", "reader123"]'):
+            response = self.client.post('/api/login/', body, content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('error', response.json())
+
+    def test_outdated_hashes_are_replaced_on_login(self):
+        User.objects.filter(id=self.user.id).update(password=make_password('reader123', hasher='pbkdf2_sha1'))
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertEqual(identify_hasher(self.user.password).algorithm, get_hasher('default').algorithm)
+
+        upgraded = self.user.password
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, upgraded)
+
+
+@override_settings(LIBRARY_TOKEN_BLACKLIST_CACHE='default')
+class TokenBlacklistTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.blacklist = TokenBlacklist()
+        patcher = mock.patch('library.blacklist.token_blacklist', self.blacklist)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='reader', password='reader123')
+        self.client = APIClient()
+        self.tokens = self.client.post('/api/login/', {'username': 'reader', 'password': 'reader123'}).json()['tokens']
+
+    def logout(self, refresh):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.tokens["access"]}')
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/logout/', {'refresh': refresh})
+
+    def test_valid_tokens_are_checked_without_a_query(self):
+        BlacklistRefreshToken(self.tokens['refresh'])
+        with self.assertNumQueries(0):
+            BlacklistRefreshToken(self.tokens['refresh'])
+
+    def test_other_processes_see_logouts_through_the_shared_log(self):
+        other_process = TokenBlacklist()
+        jti = RefreshToken(self.tokens['refresh'], verify=False)['jti']
+        self.assertFalse(other_process.contains(jti))
+
+        self.assertEqual(self.logout(self.tokens['refresh']).status_code, status.HTTP_200_OK)
+        # Only the filter's "maybe" is confirmed against the database
+        with self.assertNumQueries(1):
+            self.assertTrue(other_process.contains(jti))
+        with self.assertRaises(TokenError):
+            BlacklistRefreshToken(self.tokens['refresh'])
+        response = self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_rotated_tokens_are_refused(self):
+        BlacklistRefreshToken(self.tokens['refresh'])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(OutstandingToken.objects.filter(jti=RefreshToken(response.data['refresh'])['jti']).exists())
+
+        response = self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_filter_is_rebuilt_when_the_log_is_lost(self):
+        BlacklistRefreshToken(self.tokens['refresh'])
+        self.logout(self.tokens['refresh'])
+        cache.clear()
+        self.assertTrue(self.blacklist.contains(RefreshToken(self.tokens['refresh'], verify=False)['jti']))
+
+    @override_settings(LIBRARY_TOKEN_BLACKLIST_CACHE=None, LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS=60)
+    def test_filter_works_without_the_shared_cache(self):
+        other_process = TokenBlacklist()
+        jti = RefreshToken(self.tokens['refresh'], verify=False)['jti']
+        self.assertFalse(self.blacklist.contains(jti))
+        self.assertFalse(other_process.contains(jti))
+        with self.assertNumQueries(0):
+            BlacklistRefreshToken(self.tokens['refresh'])
+
+        self.assertEqual(self.logout(self.tokens['refresh']).status_code, status.HTTP_200_OK)
+        # This process knows at once, others once they next read new entries
+        with self.assertRaises(TokenError):
+            BlacklistRefreshToken(self.tokens['refresh'])
+        with self.assertNumQueries(0):
+            self.assertFalse(other_process.contains(jti))
+        with self.settings(LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS=0), self.assertNumQueries(2):
+            self.assertTrue(other_process.contains(jti))
+
+    def test_prune_tokens_deletes_expired_tokens_in_chunks(self):
+        tokens = [user_refresh_token(self.user) for _ in range(3)]
+        for token in tokens[1:]:
+            token.blacklist()
+        expired = [token['jti'] for token in tokens[:2]]
+        OutstandingToken.objects.filter(jti__in=expired).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        out = StringIO()
+        call_command('prune_tokens', '--chunk-size', '1', stdout=out)
+        self.assertIn('2 expired tokens pruned.', out.getvalue())
+        self.assertFalse(OutstandingToken.objects.filter(jti__in=expired).exists())
+        self.assertEqual(list(BlacklistedToken.objects.values_list('token__jti', flat=True)), [tokens[2]['jti']])
+
+
+class ProvisioningTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='admin123')
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        reconcile_counters()
+
+    def test_bulk_register_creates_users_and_profiles_in_chunks(self):
+        content = (
+            'username,email,password\n'
+            'ada,ada@example.com,secret-1\n'
+            'grace,,secret-2\n'
+            'admin,admin@example.com,secret-3\n'
+            'ada,other@example.com,secret-4\n'
+            'bad name!,bad-email,\n'
+        )
+        upload = SimpleUploadedFile('patrons.csv', content.encode())
+        response = self.client.post('/api/users/bulk_register/?chunk_size=2', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['rows'], response.data['created'], response.data['failed']), (5, 2, 3))
+        self.assertEqual([error['row'] for error in response.data['errors']], [3, 4, 5])
+        self.assertEqual(set(response.data['errors'][2]['errors']), {'username', 'email', 'password'})
+
+        ada = User.objects.get(username='ada')
+        self.assertEqual(ada.email, 'ada@example.com')
+        self.assertTrue(ada.check_password('secret-1'))
+        self.assertEqual(UserProfile.objects.filter(user__username__in=['ada', 'grace']).count(), 2)
+        self.assertTrue(User.objects.get(username='admin').check_password('admin123'))
+        self.assertEqual(read_counters()['total_users'], 3)
+
+        self.client.force_authenticate(ada)
+        upload = SimpleUploadedFile('patrons.csv', content.encode())
+        response = self.client.post('/api/users/bulk_register/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_usernames_registered_meanwhile_are_reported_per_row(self):
+        upload = SimpleUploadedFile('patrons.csv', b'username,password\nadmin,secret-1\nada,secret-2\n')
+        # The first check misses admin, as if it registered right after
+        with mock.patch('library.provisioning._taken', side_effect=[set(), {'admin'}]):
+            response = self.client.post('/api/users/bulk_register/', {'file': upload}, format='multipart')
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 1))
+        self.assertEqual(response.data['errors'], [{'row': 1, 'errors': {'username': 'A user with that username already exists.'}}])
+        self.assertTrue(UserProfile.objects.filter(user__username='ada').exists())
+
+    def test_undecodable_file_is_rejected(self):
+        upload = SimpleUploadedFile('patrons.csv', 'username,password\nJos\u00e9,secret\n'.encode('latin-1'))
+        response = self.client.post('/api/users/bulk_register/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_command_hashes_passwords_across_processes(self):
+        content = ''.join(json.dumps({'username': f'patron{n}', 'password': f'secret-{n}'}) + '\n' for n in range(3))
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as feed:
+            feed.write(content)
+            feed.flush()
+            out = StringIO()
+            call_command('provision_patrons', feed.name, '--processes', '2', '--chunk-size', '2', stdout=out)
+        self.assertIn('created:     3', out.getvalue())
+        for n in range(3):
+            self.assertTrue(User.objects.get(username=f'patron{n}').check_password(f'secret-{n}'))
+        self.assertEqual(UserProfile.objects.count(), 3)
@@ -1,9 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from .events import notification_stream
 from .views import (
     BookViewSet, TransactionViewSet, UserProfileViewSet, UserRegisterView, UserLoginView, DeleteUserView, 
     UpdateUserView, UserLogoutView, BookSearchView, NotificationViewSet, FineView, AdminStatsView, 
-    MostBorrowedBooksView, BulkBookUploadView, BulkBookDeleteView
+    MostBorrowedBooksView, BulkBookUploadView, BulkBookDeleteView, ImportJobView, BookExportView,
+    TransactionExportView, BulkUserRegisterView
 )
 
 # Create a default router to register viewsets
@@ -15,6 +17,16 @@ router.register(r'notifications', NotificationViewSet, basename='notifications')
 
 # Define the URL patterns
 urlpatterns = [
+    # Routes without a pk go ahead of the router, whose books/<pk>/ and
+    # notifications/<pk>/ detail routes would otherwise swallow them
+    path('books/search/', BookSearchView.as_view(), name='book_search'),  # Search books by title or ISBN
+    path('books/borrowed/', MostBorrowedBooksView.as_view(), name='borrowed_books'),  # Get the most borrowed books (Admin only)
+    path('books/bulk_delete/', BulkBookDeleteView.as_view(), name='bulk_delete_books'),  # Admin only
+    path('books/bulk_upload/', BulkBookUploadView.as_view(), name='bulk_upload_books'),  # Admin only
+    path('books/export/', BookExportView.as_view(), name='export_books'),  # Full-table export for analytics (Admin only)
+    path('transactions/export/', TransactionExportView.as_view(), name='export_transactions'),  # Admin only
+    path('notifications/stream/', notification_stream, name='notification_stream'),  # Server-Sent Events, serve via ASGI
+
     # Include the default router's URLs
     path('', include(router.urls)),
 
@@ -26,17 +38,13 @@ urlpatterns = [
     # User management (delete and update user)
     path('users/<int:userId>/delete/', DeleteUserView.as_view(), name='delete_user'),
     path('users/<int:userId>/update/', UpdateUserView.as_view(), name='update_user'),
+    path('users/bulk_register/', BulkUserRegisterView.as_view(), name='bulk_register_users'),  # Admin only
 
     # Book operations
     path('books/<int:pk>/', BookViewSet.as_view({'get': 'retrieve'}), name='retrieve_book'),  # Get a specific book
     path('books/<int:pk>/update/', BookViewSet.as_view({'put': 'update'}), name='update_book'),  # Update a book
     path('books/<int:pk>/delete/', BookViewSet.as_view({'delete': 'destroy'}), name='delete_book'),  # Delete a book
-    path('books/search/', BookSearchView.as_view(), name='book_search'),  # Search books by title or ISBN
-    path('books/borrowed/', MostBorrowedBooksView.as_view(), name='borrowed_books'),  # Get the most borrowed books (Admin only)
-
-    # Bulk book operations (Admin only)
-    path('books/bulk_delete/', BulkBookDeleteView.as_view(), name='bulk_delete_books'),
-    path('books/bulk_upload/', BulkBookUploadView.as_view(), name='bulk_upload_books'),
+    path('jobs/<int:pk>/', ImportJobView.as_view(), name='import_job'),  # Progress of a queued import (Admin only)
 
     # Transaction operations (borrow and return books)
     path('transactions/<int:pk>/return_book/', TransactionViewSet.as_view({'post': 'return_book'}), name='return_book'),
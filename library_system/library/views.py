@@ -1,20 +1,46 @@
+import json
+import math
+from collections.abc import Mapping
+
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import logout
-from .models import Book, Transaction, UserProfile
-from .serializers import BookSerializer, TransactionSerializer, UserSerializer, UserProfileSerializer, UserLoginSerializer
+from .authentication import forget_user, login_sessions, user_refresh_token
+from .blacklist import BlacklistRefreshToken
+from .counters import adjust_counters, read_counters
+from .circulation import MAX_BULK_ITEMS, AlreadyBorrowed, CirculationError, borrow_book, borrow_books, return_loan, return_loans
+from .deletion import DELETE_CHUNK_SIZE, archive_books, delete_books
+from .fines import ledger_fines
+from .importer import ImportFormatError, detect_format, import_books, import_chunk_size
+from .jobs import enqueue_import, job_progress
+from .models import Book, ImportJob, Notification, Transaction, UserProfile
+from .notices import MAX_REPORTED_LOANS, send_overdue_notices
+from .passwords import averify_credentials
+from .provisioning import provision_chunk_size, provision_patrons
+from .querybudget import add_query_budget
+from .pagination import BookKeysetPagination, NotificationKeysetPagination, TransactionKeysetPagination
+from .search import search_books
+from .streaming import columnar_response, csv_response, export_watermark_lag, iter_rows, iter_tuples, ndjson_response
+from .serializers import BookSerializer, FastBookSerializer, FastTransactionSerializer, NotificationSerializer, TransactionSerializer, UserSerializer, UserProfileSerializer, UserLoginSerializer
 from rest_framework.exceptions import ValidationError, PermissionDenied
 from rest_framework.views import APIView
-from django.core.mail import send_mail
 from django.shortcuts import get_object_or_404
-from rest_framework.parsers import FileUploadParser
-from django.contrib.auth import authenticate, login
-from rest_framework_simplejwt.tokens import RefreshToken
+from django.urls import reverse
+from rest_framework.parsers import FileUploadParser, MultiPartParser
+from django.contrib.auth import alogin
+from django.contrib.auth.models import update_last_login
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.settings import api_settings as drf_settings
+from asgiref.sync import sync_to_async
 from rest_framework_simplejwt.exceptions import TokenError
 
 # User Registration
@@ -24,8 +50,10 @@ class UserRegisterView(APIView):
     def post(self, request):
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
-            user = serializer.save()
-            UserProfile.objects.create(user=user)
+            with transaction.atomic():
+                user = serializer.save()
+                UserProfile.objects.create(user=user)
+                adjust_counters(total_users=1)
             return Response({ 
                 'message': 'User created successfully.',
                 'data': serializer.data
@@ -33,26 +61,52 @@ class UserRegisterView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 # User Login
-class UserLoginView(APIView):
-    permission_classes = [AllowAny]
-
-    def post(self, request):
-        username = request.data.get('username')
-        password = request.data.get('password')
+# A plain async view, so under ASGI the password hash is awaited on the
+# hashing pool instead of holding the thread every sync view shares. It is
+# not on DRF's stack: DRF's default throttles are applied by hand below,
+# and errors are answered as {'error': ...} here rather than by DRF's
+# exception handler (an unexpected exception is Django's 500).
+@method_decorator(csrf_exempt, name='dispatch')
+class UserLoginView(View):
+
+    async def post(self, request):
+        wait = await sync_to_async(self.throttle_wait)(request)
+        if wait is not False:
+            response = JsonResponse({'error': 'Request was throttled.'}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            if wait is not None:
+                response['Retry-After'] = str(math.ceil(wait))
+            return response
+
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except ValueError:
+                return JsonResponse({'error': 'Invalid JSON.'}, status=status.HTTP_400_BAD_REQUEST)
+            if not isinstance(data, Mapping):
+                return JsonResponse({'error': 'Expected a JSON object.'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+        username = data.get('username')
+        password = data.get('password')
 
         if not username or not password:
-            return Response({'error': 'Username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'error': 'Username and password are required.'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Authenticate the user
-        user = authenticate(request, username=username, password=password)
+        user = await averify_credentials(username, password, request)
 
         if user is not None:
-            login(request, user)
+            if login_sessions():
+                # Also updates last_login
+                await alogin(request, user)
+            else:
+                await sync_to_async(update_last_login)(None, user)
 
             # Create JWT tokens
-            refresh = RefreshToken.for_user(user)
+            # The access token carries the claims ClaimsJWTAuthentication reads
+            refresh = await sync_to_async(user_refresh_token)(user)
 
-            return Response({
+            return JsonResponse({
                 'message': 'Login successful.',
                 'user': {
                     'username': user.username,
@@ -64,7 +118,15 @@ class UserLoginView(APIView):
                 }
             }, status=status.HTTP_200_OK)
         else:
-            return Response({'error': 'Invalid username or password'}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({'error': 'Invalid username or password'}, status=status.HTTP_400_BAD_REQUEST)
+
+    def throttle_wait(self, request):
+        """``False`` if DRF's default throttles allow ``request``, else the longest wait they ask (or ``None``)."""
+        refused = [throttle for throttle in (cls() for cls in drf_settings.DEFAULT_THROTTLE_CLASSES) if not throttle.allow_request(request, self)]
+        if not refused:
+            return False
+        waits = [wait for wait in (throttle.wait() for throttle in refused) if wait is not None]
+        return max(waits, default=None)
 
 # Delete User (Admin or user themselves)
 class DeleteUserView(APIView):
@@ -77,7 +139,12 @@ class DeleteUserView(APIView):
         if request.user != user and not request.user.is_superuser:
             raise PermissionDenied("You do not have permission to delete this user.")
 
-        user.delete()
+        with transaction.atomic():
+            # Their loans go with them
+            open_loans = Transaction.objects.filter(user=user, date_returned__isnull=True).count()
+            user.delete()
+            adjust_counters(total_users=-1, total_books_borrowed=-open_loans)
+        forget_user(userId)
         return Response({'message': 'User deleted successfully.'}, status=status.HTTP_204_NO_CONTENT)
 
 
@@ -95,14 +162,30 @@ class UpdateUserView(APIView):
         serializer = UserSerializer(user, data=request.data, partial=True)  # Partial allows updating some fields
         if serializer.is_valid():
             serializer.save()
+            forget_user(user.id)
             return Response({'message': 'User updated successfully.', 'data': serializer.data}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+# Lists are served from values() rows by a fast read-only serializer
+class FastListMixin:
+    fast_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.fast_serializer_class()
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer.lookups())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.many(page))
+        return Response(serializer.many(queryset))
+
+
 # BookViewSet: Handles adding, updating, retrieving, and deleting books
-class BookViewSet(viewsets.ModelViewSet):
-    queryset = Book.objects.all()
+class BookViewSet(FastListMixin, viewsets.ModelViewSet):
+    queryset = Book.objects.active()
     serializer_class = BookSerializer
+    fast_serializer_class = FastBookSerializer
+    query_budget = {'list': 3, 'retrieve': 2, 'create': 3, 'update': 3, 'partial_update': 2, 'destroy': 5}
 
     def get_permissions(self):
         # Only admins can create, update, or delete books
@@ -111,6 +194,17 @@ class BookViewSet(viewsets.ModelViewSet):
         # Authenticated users can list and retrieve books
         return [IsAuthenticated()]
 
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            serializer.save()
+            adjust_counters(total_books=1)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            open_loans = instance.transaction_set.filter(date_returned__isnull=True).count()
+            instance.delete()
+            adjust_counters(total_books=-1, total_books_borrowed=-open_loans)
+
 
 class UserLogoutView(APIView):
     permission_classes = [IsAuthenticated]  # Ensure only authenticated users can log out
@@ -123,66 +217,102 @@ class UserLogoutView(APIView):
                 return Response({"error": "Refresh token is required."}, status=status.HTTP_400_BAD_REQUEST)
             
             # Blacklist the refresh token
-            token = RefreshToken(refresh_token)
+            token = BlacklistRefreshToken(refresh_token)
             token.blacklist()
 
             return Response({"message": "Logout successful."}, status=status.HTTP_200_OK)
         except TokenError as e:
             return Response({"error": "Invalid token."}, status=status.HTTP_400_BAD_REQUEST)
 
-# Search Books by name or ISBN
+# Search Books by full-text query, name or ISBN
 class BookSearchView(APIView):
     permission_classes = [AllowAny]
+    pagination_class = BookKeysetPagination
+    query_budget = {'get': 2}
 
     def get(self, request):
+        query = request.query_params.get('q')
         name = request.query_params.get('name')
         isbn = request.query_params.get('isbn')
-        queryset = Book.objects.all()
+        queryset = Book.objects.active()
 
+        if query:
+            # Ranked lookup through the catalog search index
+            queryset = search_books(queryset, query).order_by('rank', 'id')
+        else:
+            queryset = queryset.order_by('title', 'id')
         if name:
             queryset = queryset.filter(title__icontains=name)
         if isbn:
             queryset = queryset.filter(isbn=isbn)
 
-        serializer = BookSerializer(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # Export clients can opt into one streamed NDJSON body instead of pages
+        if request.query_params.get('stream') == 'ndjson':
+            return ndjson_response(iter_rows(queryset, BookSerializer.Meta.fields))
+
+        # The ordering fields (e.g. rank) ride along so the cursor can be built
+        serializer = FastBookSerializer()
+        rows = queryset.values(*serializer.lookups(), *(['rank'] if query else []))
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(rows, request, view=self)
+        return paginator.get_paginated_response(serializer.many(page))
 
 
 # Notification View
 class NotificationViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
+    pagination_class = NotificationKeysetPagination
+    lookup_value_regex = r'\d+'
+    query_budget = {'list': 2, 'mark_read': 2, 'mark_all_read': 2, 'unread_count': 2}
 
     def list(self, request):
-        # Example logic to fetch notifications (like overdue books)
-        overdue_transactions = Transaction.objects.filter(user=request.user, date_returned__isnull=True)
-        notifications = []
-        for transaction in overdue_transactions:
-            if transaction.is_overdue():
-                notifications.append(f"Book '{transaction.book.title}' is overdue.")
+        # Notifications are stored by generate_notifications, newest first
+        queryset = Notification.objects.filter(user=request.user).order_by('-created_at', '-id')
+        if request.query_params.get('unread') in ('1', 'true'):
+            queryset = queryset.filter(is_read=False)
 
-        return Response(notifications, status=status.HTTP_200_OK)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = NotificationSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
-        # Placeholder for logic to mark notification as read
+        if not Notification.objects.filter(id=pk, user=request.user).update(is_read=True):
+            return Response({"error": "Notification does not exist."}, status=status.HTTP_404_NOT_FOUND)
         return Response({"message": "Notification marked as read."}, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['post'])
+    def mark_all_read(self, request):
+        updated = Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+        return Response({"message": f"{updated} notifications marked as read."}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def unread_count(self, request):
+        # Answered from the partial notification_unread_idx alone
+        count = Notification.objects.filter(user=request.user, is_read=False).count()
+        return Response({"unread_count": count}, status=status.HTTP_200_OK)
+
 
 # Fine View
 class FineView(APIView):
     permission_classes = [IsAuthenticated]
+    query_budget = {'get': 2}
 
     def get(self, request):
-        fines = {}
-        transactions = Transaction.objects.filter(user=request.user, date_returned__isnull=True)
-        total_fine = 0
-
-        for transaction in transactions:
-            if transaction.is_overdue():
-                overdue_days = transaction.overdue_days()
-                fine = overdue_days * 2  # Assume a fine of 2 units per overdue day
-                total_fine += fine
-                fines[transaction.book.title] = f'{fine} units fine for {overdue_days} overdue days.'
+        # Fines are read from the ledger maintained by update_fine_ledger and
+        # finalized on return, never recomputed from loan history here
+        total_fine, entries = ledger_fines(request.user)
+        # One line per loan: the same title can be borrowed, and fined, more than once
+        fines = [
+            {
+                'transaction_id': entry['transaction_id'],
+                'book_title': entry['book_title'],
+                'fine': f"{entry['fine']:.2f} units fine for {entry['overdue_days']} overdue days.",
+                'is_final': entry['is_final'],
+            }
+            for entry in entries
+        ]
 
         return Response({
             'total_fine': total_fine,
@@ -193,84 +323,257 @@ class FineView(APIView):
 # Admin Stats View
 class AdminStatsView(APIView):
     permission_classes = [IsAdminUser]
+    query_budget = {'get': 2}
 
     def get(self, request):
-        # Example logic for retrieving stats
-        num_books = Book.objects.count()
-        num_users = User.objects.count()
-        num_borrowed_books = Transaction.objects.filter(date_returned__isnull=True).count()
-        stats = {
-            "total_books": num_books,
-            "total_users": num_users,
-            "total_books_borrowed": num_borrowed_books,
-        }
+        # Served from the StatCounter rows, not three COUNT(*) scans;
+        # stale_seconds is the time since they were last reconciled
+        stats = read_counters()
         return Response(stats, status=status.HTTP_200_OK)
 
 
 # Most Borrowed Books View (Admin)
 class MostBorrowedBooksView(APIView):
     permission_classes = [IsAdminUser]
+    query_budget = {'get': 2}
 
     def get(self, request):
         most_borrowed_books = Transaction.objects.values('book').annotate(count=models.Count('book')).order_by('-count')[:10]
         return Response(most_borrowed_books, status=status.HTTP_200_OK)
 
 
+# Full-table exports for analytics (Admin only)
+class ExportView(APIView):
+    permission_classes = [IsAdminUser]
+    # The rows are read while the response streams, after the budget is checked
+    query_budget = {'get': 0}
+    model = None
+    fields = ()
+    filename = None
+
+    def get(self, request):
+        export_format = request.query_params.get('export_format', 'csv')
+        if export_format not in ('csv', 'ndjson', 'columnar'):
+            return Response({'error': f"Unsupported export_format '{export_format}', use csv, ndjson or columnar."}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.model.objects.all()
+        updated_since = request.query_params.get('updated_since')
+        if updated_since:
+            try:
+                # An unencoded '+' in the UTC offset arrives as a space
+                since = parse_datetime(updated_since.replace(' ', '+'))
+            except ValueError:
+                since = None
+            if since is None:
+                return Response({'error': 'updated_since must be an ISO 8601 datetime.'}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            queryset = queryset.filter(updated_at__gte=since)
+
+        # Rows changed after this instant are picked up by the next export
+        # from it. It trails now by the lag, so rows stamped before now whose
+        # transaction commits after this snapshot aren't lost; consumers get
+        # the rows of the overlap again and upsert them by id.
+        watermark = timezone.now() - export_watermark_lag()
+        rows = iter_tuples(queryset.order_by('updated_at', 'id'), self.fields)
+        if export_format == 'csv':
+            response = csv_response(self.fields, rows, filename=f'{self.filename}.csv')
+        elif export_format == 'ndjson':
+            response = ndjson_response((dict(zip(self.fields, row)) for row in rows), filename=f'{self.filename}.ndjson')
+        else:
+            response = columnar_response(self.fields, rows, filename=f'{self.filename}.columnar.ndjson')
+        response['X-Export-Watermark'] = watermark.isoformat()
+        return response
+
+
+class BookExportView(ExportView):
+    model = Book
+    fields = ('id', 'title', 'author', 'isbn', 'published_date', 'copies_available', 'archived_at', 'updated_at')
+    filename = 'books'
+
+
+class TransactionExportView(ExportView):
+    model = Transaction
+    fields = ('id', 'user_id', 'book_id', 'date_checked_out', 'date_returned', 'updated_at')
+    filename = 'transactions'
+
+
 # Bulk Book Operations
 class BulkBookUploadView(APIView):
     permission_classes = [IsAdminUser]
-    parser_classes = [FileUploadParser]
+    # Queuing the job, plus the ISBN count, upsert and counter update of each imported chunk
+    query_budget = {'post': 1}
+    queries_per_chunk = 3
+    parser_classes = [MultiPartParser, FileUploadParser]
 
     def post(self, request):
-        file = request.FILES['file']
-        # Logic to handle bulk upload of books using file
-        return Response({"message": "Books uploaded successfully."}, status=status.HTTP_201_CREATED)
+        file = request.FILES.get('file')
+        if file is None:
+            return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            file_format = detect_format(file.name, request.query_params.get('file_format'))
+            # Unset, the importer's LIBRARY_IMPORT_CHUNK_SIZE applies
+            chunk_size = request.query_params.get('chunk_size')
+            chunk_size = max(int(chunk_size), 1) if chunk_size else None
+        except (ImportFormatError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.query_params.get('sync') != 'true':
+            # Store the file and let the import workers process it in row ranges
+            job = enqueue_import(file, file_format, user=request.user, chunk_size=chunk_size)
+            return Response({
+                "message": "Import queued.",
+                "job_id": job.id,
+                "status_url": request.build_absolute_uri(reverse('import_job', args=[job.id])),
+            }, status=status.HTTP_202_ACCEPTED)
+
+        # Parse, validate and upsert the file chunk by chunk (CSV or JSON Lines)
+        try:
+            report = import_books(file, file_format, chunk_size=chunk_size)
+        except ImportFormatError as e:
+            # Chunks before the unreadable row stay imported, as in a queued import
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        add_query_budget(request, self.queries_per_chunk * math.ceil(report['rows'] / (chunk_size or import_chunk_size())))
+        return Response({"message": "Books uploaded successfully.", **report}, status=status.HTTP_201_CREATED)
+
+
+# Register patrons in bulk from a CSV or JSON Lines file (Admin only)
+class BulkUserRegisterView(APIView):
+    permission_classes = [IsAdminUser]
+    # Per chunk: the taken usernames, the users, their profiles and the counter update
+    query_budget = {'post': 0}
+    queries_per_chunk = 4
+    parser_classes = [MultiPartParser, FileUploadParser]
+
+    def post(self, request):
+        file = request.FILES.get('file')
+        if file is None:
+            return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            file_format = detect_format(file.name, request.query_params.get('file_format'))
+            chunk_size = int(request.query_params.get('chunk_size', provision_chunk_size()))
+        except (ImportFormatError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Hashed in this process: a request shouldn't start a process pool,
+        # so large files go through manage.py provision_patrons instead
+        try:
+            report = provision_patrons(file, file_format, chunk_size=max(chunk_size, 1), processes=1)
+        except ImportFormatError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        add_query_budget(request, self.queries_per_chunk * math.ceil(report['rows'] / max(chunk_size, 1)))
+        return Response({"message": "Users registered successfully.", **report}, status=status.HTTP_201_CREATED)
+
+
+class ImportJobView(APIView):
+    permission_classes = [IsAdminUser]
+    query_budget = {'get': 4}
+
+    def get(self, request, pk):
+        job = get_object_or_404(ImportJob, pk=pk)
+        return Response(job_progress(job))
 
 
 class BulkBookDeleteView(APIView):
     permission_classes = [IsAdminUser]
+    # Per chunk: the open loans, the books and their loan ids, one DELETE per
+    # table of the cascade and the counter updates
+    query_budget = {'delete': 0}
+    queries_per_chunk = 9
 
     def delete(self, request):
         book_ids = request.data.get('book_ids', [])
         if not book_ids:
             return Response({"error": "No book IDs provided."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            book_ids = [int(book_id) for book_id in book_ids]
+        except (TypeError, ValueError):
+            return Response({"error": "book_ids must only contain integer ids."}, status=status.HTTP_400_BAD_REQUEST)
+
+        dry_run = self._flag(request, 'dry_run')
+        add_query_budget(request, self.queries_per_chunk * math.ceil(len(set(book_ids)) / DELETE_CHUNK_SIZE))
+        if self._flag(request, 'archive'):
+            # Keep the books and their loan history, just withdraw them from the catalog
+            affected = archive_books(book_ids, chunk_size=DELETE_CHUNK_SIZE, dry_run=dry_run)
+            message = "Books archived successfully."
+        else:
+            # Chunked, so the collector never holds more than one chunk's loans
+            affected = delete_books(book_ids, chunk_size=DELETE_CHUNK_SIZE, dry_run=dry_run)
+            message = "Books deleted successfully."
+
+        if dry_run:
+            return Response({"dry_run": True, "affected": affected}, status=status.HTTP_200_OK)
+        return Response({"message": message, "affected": affected}, status=status.HTTP_204_NO_CONTENT)
 
-        Book.objects.filter(id__in=book_ids).delete()
-        return Response({"message": "Books deleted successfully."}, status=status.HTTP_204_NO_CONTENT)
+    def _flag(self, request, key):
+        value = request.data.get(key, request.query_params.get(key, False))
+        return value is True or str(value).lower() in ('true', '1')
 
 
 # Transaction ViewSet
 # TransactionViewSet: Handles borrowing and returning books
-class TransactionViewSet(viewsets.ModelViewSet):
+class TransactionViewSet(FastListMixin, viewsets.ModelViewSet):
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    fast_serializer_class = FastTransactionSerializer
+    pagination_class = TransactionKeysetPagination
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2, 'retrieve': 2, 'create': 5, 'update': 3, 'partial_update': 2, 'destroy': 5,
+        'return_book': 6, 'bulk_borrow': 6, 'bulk_return': 5, 'check_overdue': 1,
+    }
+    lookup_value_regex = r'\d+'  # return_book hands the pk straight to return_loan
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.request.user.is_staff:
+            # Patrons only ever see their own loans
+            queryset = queryset.filter(user=self.request.user)
+        # Everything TransactionSerializer reads, in one joined query. The
+        # overdue annotation is built per request so its "now" is current.
+        return queryset.with_overdue().select_related('book', 'user').only(
+            'date_checked_out', 'date_returned', 'book__title', 'book__author', 'book__isbn',
+            'book__published_date', 'book__copies_available', 'user__username',
+        )
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action != 'list':
+            return queryset
+        loan_status = self.request.query_params.get('status')
+        if loan_status == 'active':
+            return queryset.filter(date_returned__isnull=True)
+        if loan_status == 'returned':
+            return queryset.filter(date_returned__isnull=False)
+        if loan_status == 'overdue':
+            return queryset.overdue()
+        if loan_status:
+            raise ValidationError({'error': 'status must be one of active, returned or overdue.'})
+        return queryset
 
     def create(self, request, *args, **kwargs):
         """
         Handles borrowing a book (creates a transaction).
         """
-        book_id = request.data.get('book_id')
-        user = request.user
-
-        # Get the book object
+        book_id = request.data.get('book_id', request.data.get('book'))
         try:
-            book = Book.objects.get(id=book_id)
-        except Book.DoesNotExist:
-            return Response({'error': 'Book does not exist'}, status=status.HTTP_404_NOT_FOUND)
+            book_id = int(book_id)
+        except (TypeError, ValueError):
+            return Response({'error': 'A valid book_id is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Check if the book is available for borrowing
-        if book.copies_available <= 0:
-            return Response({'error': 'No copies available for this book'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Create the transaction (borrow the book)
-        transaction = Transaction.objects.create(user=user, book=book, date_checked_out=timezone.now())
-        book.copies_available -= 1  # Decrease available copies
-        book.save()
+        # Decrement stock and create the transaction atomically (borrow the book)
+        try:
+            transaction = borrow_book(request.user, book_id)
+        except AlreadyBorrowed as e:
+            # Refused by the one-open-loan constraint, reported like DRF's own errors
+            return Response({'detail': str(e)}, status=e.status_code)
+        except CirculationError as e:
+            return Response({'error': str(e)}, status=e.status_code)
 
         serializer = TransactionSerializer(transaction)
         return Response({
             'message': 'Book borrowed successfully.',
+            'id': transaction.id,
             'data': serializer.data
         }, status=status.HTTP_201_CREATED)
 
@@ -279,16 +582,11 @@ class TransactionViewSet(viewsets.ModelViewSet):
         """
         Handles returning a book (updates a transaction).
         """
-        transaction = self.get_object()
-
-        if transaction.date_returned is not None:
-            return Response({'error': 'Book has already been returned.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Mark the book as returned and increase available copies
-        transaction.date_returned = timezone.now()
-        transaction.book.copies_available += 1
-        transaction.book.save()
-        transaction.save()
+        # Mark the book as returned and increase available copies in one DB transaction
+        try:
+            transaction = return_loan(request.user, pk)
+        except CirculationError as e:
+            return Response({'error': str(e)}, status=e.status_code)
 
         serializer = self.get_serializer(transaction)
         return Response({
@@ -296,16 +594,90 @@ class TransactionViewSet(viewsets.ModelViewSet):
             'data': serializer.data
         }, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['post'])
+    def bulk_borrow(self, request):
+        """
+        Handles borrowing a stack of books in one request (circulation desk).
+        """
+        book_ids, error = self._id_list(request, 'book_ids')
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = borrow_books(request.user, book_ids)
+        return Response({
+            'message': f"{sum('error' not in item for item in results)} of {len(results)} books borrowed.",
+            'results': results
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def bulk_return(self, request):
+        """
+        Handles returning a stack of books in one request (circulation desk).
+        """
+        transaction_ids, error = self._id_list(request, 'transaction_ids')
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = return_loans(request.user, transaction_ids)
+        return Response({
+            'message': f"{sum('error' not in item for item in results)} of {len(results)} books returned.",
+            'results': results
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def check_overdue(self, request):
+        """
+        Emails every borrower a digest of their overdue books (admins only).
+        """
+        # Digests are streamed; only the first MAX_REPORTED_LOANS loans are kept for the response
+        reported = []
+
+        def record(user, loans):
+            reported.extend({
+                'id': loan.id,
+                'user': user.username,
+                'book': loan.book.title,
+                'date_checked_out': loan.date_checked_out,
+                'overdue_days': loan.overdue_days,
+                'is_overdue': loan.is_overdue,
+            } for loan in loans[:MAX_REPORTED_LOANS - len(reported)])
+
+        emails_sent, loans_notified = send_overdue_notices(on_sent=record)
+        return Response({
+            'emails_sent': emails_sent,
+            'loans_notified': loans_notified,
+            'loans': reported,
+            'loans_truncated': loans_notified > len(reported),
+        }, status=status.HTTP_200_OK)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            if instance.date_returned is None:
+                adjust_counters(total_books_borrowed=-1)
+
+    def _id_list(self, request, key):
+        # A JSON array or scalar body has no keys to look up
+        ids = request.data.get(key) if isinstance(request.data, Mapping) else None
+        if not isinstance(ids, list) or not ids:
+            return None, f'{key} must be a non-empty list.'
+        if len(ids) > MAX_BULK_ITEMS:
+            return None, f'At most {MAX_BULK_ITEMS} {key} can be processed per request.'
+        try:
+            return [int(item) for item in ids], None
+        except (TypeError, ValueError):
+            return None, f'{key} must only contain integer ids.'
 
 
 # UserProfile ViewSet
 class UserProfileViewSet(viewsets.ModelViewSet):
-    queryset = UserProfile.objects.all()
+    queryset = UserProfile.objects.select_related('user').only('date_of_membership', 'is_active', 'user__username')
     serializer_class = UserProfileSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {'list': 3, 'retrieve': 2, 'create': 2, 'update': 2, 'partial_update': 2, 'destroy': 2}
 
     def retrieve(self, request, *args, **kwargs):
         # Allow users to retrieve only their profile
-        instance = UserProfile.objects.get(user=request.user)
+        instance = self.get_queryset().get(user=request.user)
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
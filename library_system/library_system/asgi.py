@@ -3,6 +3,10 @@ ASGI config for library_system project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it with an ASGI server (e.g. ``uvicorn library_system.asgi:application``)
+to serve the ``/api/notifications/stream/`` Server-Sent Events endpoint,
+which holds one connection per idle client instead of a worker.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
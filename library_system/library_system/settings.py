@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'library.querybudget.QueryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'library_system.urls'
@@ -74,7 +76,8 @@ TEMPLATES = [
 WSGI_APPLICATION = 'library_system.wsgi.application'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Builds request.user from the token claims instead of querying User
+        'library.authentication.ClaimsJWTAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,  # Pagination size
@@ -87,6 +90,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock at BEGIN so concurrent checkouts queue on the
+            # busy timeout instead of failing with "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -110,6 +119,21 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing (see library.passwords)
+# https://docs.djangoproject.com/en/5.1/topics/auth/passwords/
+
+PASSWORD_HASHERS = [
+    'library.passwords.TunedArgon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+if find_spec('argon2') is None:
+    # Without argon2-cffi new hashes use PBKDF2
+    PASSWORD_HASHERS.remove('library.passwords.TunedArgon2PasswordHasher')
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
@@ -127,6 +151,46 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files (queued import feeds)
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Circulation rules
+LIBRARY_LOAN_PERIOD_DAYS = 14  # Loans still open after this many days are overdue
+LIBRARY_FINE_PER_DAY = 2  # Units fined per overdue day
+LIBRARY_FINE_CAP = None  # Most a single loan can be fined, None for no cap
+
+# Bulk book import
+LIBRARY_IMPORT_CHUNK_SIZE = 2000  # Rows validated and upserted per transaction
+LIBRARY_IMPORT_RANGE_SIZE = 50000  # Rows per range leased by one import worker
+LIBRARY_IMPORT_LEASE_SECONDS = 300  # A range not finished in this time is handed to another worker
+
+# Bulk patron provisioning (see library.provisioning)
+LIBRARY_PROVISION_CHUNK_SIZE = 1000  # Patrons hashed and inserted per transaction
+LIBRARY_PROVISION_PROCESSES = 4  # Processes hashing passwords in manage.py provision_patrons; the endpoint hashes in-process
+
+# Analytics exports
+LIBRARY_EXPORT_WATERMARK_LAG_SECONDS = 300  # X-Export-Watermark trails the export by this much; keep it above the longest write transaction
+
+# Admin stats counters (see library.counters)
+LIBRARY_COUNTER_SHARDS = 8  # Rows each counter is spread over so concurrent checkouts don't queue on one; applied by reconcile_counters
+
+# Query budgets declared by views (see library.querybudget)
+LIBRARY_QUERY_BUDGET_STRICT = False  # Raise instead of logging when a request goes over budget (tests)
+
+# Notification push stream
+LIBRARY_NOTIFICATION_BROKER = 'library.pubsub.InProcessBroker'  # Swap for a cross-process broker with the same interface
+LIBRARY_NOTIFICATION_STREAM_POLL = 15  # Seconds between index checks on an idle stream
+
+# Authentication (see library.authentication and library.passwords)
+LIBRARY_AUTH_USER_CACHE_SECONDS = 60  # Reuse users loaded for tokens without claims this long, per process
+LIBRARY_LOGIN_SESSIONS = False  # Also start a Django session on login; JWT clients never use it
+LIBRARY_PASSWORD_HASH_WORKERS = None  # Threads hashing login passwords per process, None for one per CPU
+LIBRARY_ARGON2_TIME_COST = 2  # Argon2id passes; changing a cost rehashes each password on its next login
+LIBRARY_ARGON2_MEMORY_COST = 19456  # Argon2id memory in KiB (19 MiB)
+LIBRARY_ARGON2_PARALLELISM = 1  # Argon2id lanes; 1 keeps a login on one core
+LIBRARY_TOKEN_BLACKLIST_CACHE = None  # Cache alias shared by all processes (Redis, Memcached) that spreads new blacklist entries at once
+LIBRARY_TOKEN_BLACKLIST_POLL_SECONDS = 5  # Without that cache, read other processes' new blacklist entries this often
+
 # Email settings (you need to configure your email backend)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # For development purposes
 # Default primary key field type
@@ -144,4 +208,7 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': 'your-secret-signing-key',  # Change this to your actual secret key
+    # Issue tokens carrying the claims ClaimsJWTAuthentication reads
+    'TOKEN_OBTAIN_SERIALIZER': 'library.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'library.authentication.ClaimsTokenRefreshSerializer',
 }
\ No newline at end of file